@@ -8,18 +8,8 @@ import argparse
 
 import shtab  # for completion magic
 
-TXT_FILE = {
-    "bash": "_shtab_greeter_compgen_TXTFiles", "zsh": "_files -g '(*.txt|*.TXT)'",
-    "tcsh": "f:*.txt"}
-PREAMBLE = {
-    "bash": """
-# $1=COMP_WORDS[1]
-_shtab_greeter_compgen_TXTFiles() {
-  compgen -d -- $1  # recurse into subdirs
-  compgen -f -X '!*?.txt' -- $1
-  compgen -f -X '!*?.TXT' -- $1
-}
-""", "zsh": "", "tcsh": ""}
+# `*.txt` files (& directories), filtered natively by each shell
+TXT_FILE = shtab.FileMatching("*.txt", "*.TXT")
 
 
 def process(args):
@@ -36,7 +26,7 @@ def get_main_parser():
     subparsers.dest = "subcommand"
 
     parser = subparsers.add_parser("completion", help="print tab completion")
-    shtab.add_argument_to(parser, "shell", parent=main_parser, preamble=PREAMBLE) # magic!
+    shtab.add_argument_to(parser, "shell", parent=main_parser) # magic!
 
     parser = subparsers.add_parser("process", help="parse files")
     # `*.txt` file tab completion
@@ -0,0 +1,1290 @@
+"""bash backend (`complete_bash`; layouts: default, table & assoc)"""
+import logging
+import sys
+from hashlib import sha256
+from string import Template
+from typing import Any, Dict, List
+
+from . import CHOICE_FUNCTIONS
+from .core import (
+    apply_limits,
+    build_model,
+    complete2pattern,
+    get_cached,
+    get_choices_files,
+    get_file_matching,
+    get_layout,
+    get_limited,
+    get_served,
+    get_sorted_choices,
+    index_choices,
+    iter_joined,
+    iter_template,
+    mark_breakdown,
+    mark_completer,
+    mark_iter_completer,
+    shell_quote,
+    wordify,
+)
+
+log = logging.getLogger(__name__)
+
+BASH_SECTIONS = "subparsers", "option_strings", "compgens", "choices", "nargs"
+# data arrays of the table & assoc layouts (see `get_bash_table` & `get_bash_assoc`)
+BASH_TABLE_SECTIONS = ("words", "options", "positionals", "transitions", "nargs", "compgens",
+                       "choices")
+BASH_ASSOC_SECTIONS = "subparsers", "options", "option_strings", "compgens", "choices", "nargs"
+
+
+def get_bash_commands(root_parser, root_prefix, choice_functions=None, recursive=True):
+    """
+    Recursive subcommand parser traversal, returning lists of information on
+    commands (formatted for output to the completions script).
+    printing bash helper syntax.
+
+    recursive  : include subcommands' information (not just their names)
+
+    Returns:
+      subparsers  : list of subparsers for each parser
+      option_strings  : list of options strings for each parser
+      compgens  : list of shtab `.complete` functions corresponding to actions
+      choices  : list of choices corresponding to actions
+      nargs  : list of number of args allowed for each action (if not 0 or 1)
+    """
+    command = build_model(root_parser)
+    return tuple(
+        list(
+            iter_bash_commands(command, root_prefix, section, choice_functions=choice_functions,
+                               recursive=recursive)) for section in BASH_SECTIONS)
+
+
+def iter_bash_commands(root_parser, root_prefix, section, choice_functions=None, recursive=True):
+    """
+    Lazy version of one `section` (in `BASH_SECTIONS`) of `get_bash_commands`,
+    yielding its lines without building the others.
+    """
+    choice_type2fn = {k: v["bash"] for k, v in CHOICE_FUNCTIONS.items()}
+    if choice_functions:
+        choice_type2fn.update(choice_functions)
+
+    def recurse(command, prefix):
+        """recurse through subparsers, yielding `section` lines"""
+        # positional arguments
+        discovered_subparsers = []
+        for positional in command.positionals:
+            i = positional.index
+            if section == "compgens":
+                if positional.complete is not None:
+                    # shtab `.complete = ...` functions
+                    comp_pattern = complete2pattern(positional.complete, "bash", choice_type2fn)
+                    yield f"{prefix}_pos_{i}_COMPGEN={comp_pattern}"
+
+                if positional.choice_type is not None:
+                    # special completion type
+                    # NOTE: overrides `.complete` attribute
+                    log.debug("Choice.%s:%s:%s", positional.choice_type, prefix, positional.dest)
+                    yield f"{prefix}_pos_{i}_COMPGEN={choice_type2fn[positional.choice_type]}"
+
+            elif section == "choices" and positional.choices:
+                # choices (including subparsers)
+                log.debug("choices:%s:%s", prefix, positional.choices)
+                choices_str = "' '".join(positional.choices)
+                yield f"{prefix}_pos_{i}_choices=('{choices_str}')"
+
+            # skip default `nargs` values
+            elif section == "nargs" and positional.nargs not in (None, "1", "?"):
+                yield f"{prefix}_pos_{i}_nargs={positional.nargs}"
+
+            if positional.subcommands:
+                # subparser, so append to list of subparsers (recursed below)
+                discovered_subparsers.extend(command.commands)
+
+        if section == "subparsers" and discovered_subparsers:
+            subparsers_str = "' '".join(discovered_subparsers)
+            yield f"{prefix}_subparsers=('{subparsers_str}')"
+            log.debug("subcommands:%s:%s", prefix, discovered_subparsers)
+
+        # optional arguments
+        if section == "option_strings":
+            options_strings_str = "' '".join(option_string for opt in command.options
+                                             for option_string in opt.option_strings)
+            yield f"{prefix}_option_strings=('{options_strings_str}')"
+        else:
+            for optional in command.options:
+                if section == "compgens":
+                    if optional.complete is None and optional.choice_type is None:
+                        continue
+                elif section == "choices":
+                    if not optional.choices:
+                        continue
+                # Check for nargs.
+                elif section != "nargs" or optional.nargs is None or optional.nargs == 1:
+                    continue
+                for option_string in optional.option_strings:
+                    name = f"{prefix}_{wordify(option_string)}"
+                    if section == "compgens":
+                        if optional.complete is not None:
+                            # shtab `.complete = ...` functions
+                            comp_pattern_str = complete2pattern(optional.complete, "bash",
+                                                                choice_type2fn)
+                            yield f"{name}_COMPGEN={comp_pattern_str}"
+
+                        if optional.choice_type is not None:
+                            # special completion type
+                            # NOTE: overrides `.complete` attribute
+                            log.debug("Choice.%s:%s:%s", optional.choice_type, prefix,
+                                      optional.dest)
+                            yield f"{name}_COMPGEN={choice_type2fn[optional.choice_type]}"
+
+                    elif section == "choices":
+                        # simple choices
+                        this_choices_str = "' '".join(optional.choices)
+                        yield f"{name}_choices=('{this_choices_str}')"
+
+                    else:
+                        yield f"{name}_nargs={optional.nargs}"
+
+        # recurse
+        for cmd, subcommand in command.commands.items():
+            if section == "subparsers":
+                log.debug("subcommand:%s", cmd)
+            if recursive:
+                yield from recurse(subcommand, f"{prefix}_{wordify(cmd)}")
+
+    return recurse(build_model(root_parser), root_prefix)
+
+
+def get_bash_table(root_parser, choice_functions=None, owners=None):
+    """
+    Compile the parser into a state table (one state per distinct
+    (sub)parser, one action ID per argument; action 0 being a placeholder).
+
+    owners  : if given, filled with the top-level command ("prog cmd", or
+      "prog" for the root parser) which first needed each of the `"words"`,
+      `"states"` & `"actions"` (lists indexed by word, state & action ID)
+
+    Returns:
+      words  : list of option strings & choices (referenced by slices)
+      options  : list of option strings slices (`"start count"` of `words`) per state
+      positionals  : list of (space-separated) positional action IDs per state
+      transitions  : `{"state word": "s<state>" or "a<action>"}` for subcommands
+        & option strings
+      nargs  : `{action: nargs}` (if not the default)
+      compgens  : `{action: function}`
+      choices  : `{action: choices slice}`
+    """
+    choice_type2fn = {k: v["bash"] for k, v in CHOICE_FUNCTIONS.items()}
+    if choice_functions:
+        choice_type2fn.update(choice_functions)
+
+    words: List[str] = []
+    slices: Dict[tuple, str] = {} # deduplicate identical slices
+    options: List[str] = []
+    positionals: List[str] = []
+    transitions: Dict[str, str] = {}
+    nargs: Dict[int, Any] = {}
+    compgens: Dict[int, str] = {}
+    choices: Dict[int, str] = {}
+    states: Dict[int, int] = {}   # id(command) -> state
+    num_actions = 1
+    word_owners: List[str] = []
+    state_owners: List[str] = []
+    action_owners: List[str] = []
+    owner = ""
+
+    def get_slice(strings):
+        try:
+            return slices[strings]
+        except KeyError:
+            res = slices[strings] = f"{len(words)} {len(strings)}"
+            words.extend(strings)
+            word_owners.extend([owner] * len(strings))
+            return res
+
+    def add_action(arg, positional):
+        nonlocal num_actions
+        action = num_actions
+        num_actions += 1
+        action_owners.append(owner)
+        if arg.nargs not in ((None, "1", "?") if positional else (None, 1)):
+            nargs[action] = arg.nargs
+        if arg.choice_type is not None:
+            compgens[action] = choice_type2fn[arg.choice_type]
+        elif arg.complete is not None:
+            comp_pattern = complete2pattern(arg.complete, "bash", choice_type2fn)
+            if comp_pattern:
+                compgens[action] = comp_pattern
+        if arg.choices:
+            choices[action] = get_slice(arg.choices)
+        return action
+
+    pending = [build_model(root_parser)]
+    states[id(pending[0])] = 0
+    state_owners.append(pending[0].name)
+    action_owners.append(pending[0].name) # placeholder
+    while pending:
+        command = pending.pop(0)
+        state = states[id(command)]
+        owner = state_owners[state]
+        options.append(
+            get_slice(tuple(opt_str for opt in command.options for opt_str in opt.option_strings)))
+        for optional in command.options:
+            action = add_action(optional, False)
+            for option_string in optional.option_strings:
+                transitions[f"{state} {option_string}"] = f"a{action}"
+
+        # placeholder (0) for suppressed positionals
+        state_positionals = [0] * (max((i.index for i in command.positionals), default=-1) + 1)
+        for positional in command.positionals:
+            state_positionals[positional.index] = add_action(positional, True)
+        positionals.append(" ".join(map(str, state_positionals)))
+
+        for cmd, subcommand in command.commands.items():
+            if id(subcommand) not in states:
+                states[id(subcommand)] = len(states)
+                state_owners.append(f"{owner} {cmd}" if state == 0 else owner)
+                pending.append(subcommand)
+            transitions[f"{state} {cmd}"] = f"s{states[id(subcommand)]}"
+
+    if owners is not None:
+        owners.update(words=word_owners, states=state_owners, actions=action_owners)
+    return words, options, positionals, transitions, nargs, compgens, choices
+
+
+def get_bash_assoc(root_parser, choice_functions=None, owners=None):
+    """
+    Traverse the parser, returning mappings keyed by (sub)parser prefix (""
+    for the root parser, otherwise a short numeric ID) or by `"prefix/action"`
+    (`action` being `pos_<index>` for positionals or the first option string
+    for optionals). Subparsers with identical completions (e.g. aliases, or
+    leaf commands with the same arguments) share the same prefix.
+
+    owners  : if given, filled with `{prefix: top-level command}` ("prog cmd",
+      or "prog" for the root parser) which first needed each prefix
+
+    Returns:
+      subparsers  : `{"prefix/subcommand": subcommand prefix}`
+      options  : `{"prefix/option_string": action}`
+      option_strings  : `{"prefix/": quoted option strings}`
+      compgens  : `{"prefix/action": function}`
+      choices  : `{"prefix/action": quoted choices}`
+      nargs  : `{"prefix/action": nargs}` (if not the default)
+    """
+    choice_type2fn = {k: v["bash"] for k, v in CHOICE_FUNCTIONS.items()}
+    if choice_functions:
+        choice_type2fn.update(choice_functions)
+
+    subparsers: Dict[str, str] = {}
+    options: Dict[str, str] = {}
+    option_strings: Dict[str, str] = {}
+    compgens: Dict[str, str] = {}
+    choices: Dict[str, str] = {}
+    nargs: Dict[str, Any] = {}
+    prefixes: Dict[int, str] = {}     # id(command) -> prefix
+    signatures: Dict[tuple, str] = {} # completion data -> prefix
+
+    def get_action(arg, positional):
+        """(compgen, quoted choices, nargs) with `None` for defaults"""
+        compgen = None
+        if arg.choice_type is not None:
+            compgen = choice_type2fn[arg.choice_type]
+        elif arg.complete is not None:
+            compgen = complete2pattern(arg.complete, "bash", choice_type2fn) or None
+        default_nargs = (None, "1", "?") if positional else (None, 1)
+        return (compgen, " ".join(map(shell_quote, arg.choices)) if arg.choices else None,
+                None if arg.nargs in default_nargs else arg.nargs)
+
+    def add_action(key, action):
+        for mapping, value in zip((compgens, choices, nargs), action):
+            if value is not None:
+                mapping[key] = value
+
+    prefix_owners: Dict[str, str] = {}
+
+    def visit(command, owner, root=False):
+        """post-order traversal, returning the `command`'s prefix"""
+        try:
+            return prefixes[id(command)]
+        except KeyError:
+            pass
+        commands = tuple((cmd, visit(subcommand, f"{owner} {cmd}" if root else owner))
+                         for cmd, subcommand in command.commands.items())
+        optionals = tuple((opt.option_strings, get_action(opt, False)) for opt in command.options)
+        positionals = tuple((pos.index, get_action(pos, True)) for pos in command.positionals)
+        signature = commands, optionals, positionals
+        if root:
+            prefix = ""
+        elif signature in signatures:
+            prefix = prefixes[id(command)] = signatures[signature]
+            return prefix
+        else:
+            prefix = prefixes[id(command)] = signatures[signature] = str(len(signatures) + 1)
+        prefix_owners[prefix] = owner
+
+        option_strings[f"{prefix}/"] = " ".join(
+            shell_quote(opt_str) for opt_strs, _ in optionals for opt_str in opt_strs)
+        for opt_strs, action in optionals:
+            for option_string in opt_strs:
+                options[f"{prefix}/{option_string}"] = opt_strs[0]
+            add_action(f"{prefix}/{opt_strs[0]}", action)
+        for index, action in positionals:
+            add_action(f"{prefix}/pos_{index}", action)
+        for cmd, subprefix in commands:
+            subparsers[f"{prefix}/{cmd}"] = subprefix
+        return prefix
+
+    command = build_model(root_parser)
+    visit(command, command.name, root=True)
+    if owners is not None:
+        owners.update(prefix_owners)
+    return subparsers, options, option_strings, compgens, choices, nargs
+
+
+def format_bash_item(value, key=None):
+    """Returns a (quoted) bash array item (`[key]=value` if `key` is given)"""
+    value = shell_quote(str(value))
+    return value if key is None else f"[{shell_quote(str(key))}]={value}"
+
+
+def format_bash_array(values):
+    """Returns the (quoted) items of a bash array (or associative array if a `dict`)"""
+    if isinstance(values, dict):
+        return " ".join(format_bash_item(v, k) for k, v in values.items())
+    return " ".join(map(format_bash_item, values))
+
+
+# shell functions shared by all bash layouts
+BASH_HELPERS = """\
+# $1=COMP_WORDS[1]
+_shtab_compgen_files() {
+  compgen -f -- $1  # files
+}
+
+# $1=COMP_WORDS[1]
+_shtab_compgen_dirs() {
+  compgen -d -- $1  # recurse into subdirs
+}
+
+# Functions named `*_compreply` append to `COMPREPLY` directly
+# (rather than printing) so that they can be called without forking.
+
+# $1=prefix, $2=glob suffix
+# append paths matching "$1$2" (without trailing slashes) to `COMPREPLY`
+_shtab_glob_compreply() {
+  local prefix="$1" home="" path
+  if [[ $prefix == "~/"* ]]; then
+    home=$HOME
+    prefix="$HOME/${prefix:2}"
+  fi
+  local restore_unset=() restore_set=()
+  shopt -q nullglob || restore_unset+=(nullglob)
+  shopt -q dotglob || restore_unset+=(dotglob)
+  ! shopt -q failglob || restore_set+=(failglob)
+  shopt -s nullglob dotglob
+  [ ${#restore_set[@]} -eq 0 ] || shopt -u failglob
+  for path in "$prefix"$2; do
+    path="${path%/}"
+    COMPREPLY+=("${home:+"~"}${path#"$home"}")
+  done
+  [ ${#restore_unset[@]} -eq 0 ] || shopt -u "${restore_unset[@]}"
+  [ ${#restore_set[@]} -eq 0 ] || shopt -s "${restore_set[@]}"
+  return 0
+}
+
+# $1=COMP_WORDS[1]
+_shtab_files_compreply() {
+  _shtab_glob_compreply "$1" "*"
+}
+
+# $1=COMP_WORDS[1]
+_shtab_dirs_compreply() {
+  _shtab_glob_compreply "$1" "*/"
+}
+
+# $1=`compgen -A` action, $2=prefix
+# append the action's names (e.g. users) starting with the prefix to `COMPREPLY`
+# (without forking: on bash<5.3, `compgen` writes to a file in the private
+# directory also used by the `shtab.serve` socket)
+_shtab_action_compreply() {
+  local -a results
+  if (( BASH_VERSINFO[0] * 100 + BASH_VERSINFO[1] >= 503 )); then
+    compgen -V results -A "$1" -- "$2" || return 0 # no matches
+  else
+    local dir="${XDG_RUNTIME_DIR:-${TMPDIR:-/tmp}}/shtab-$UID"
+    [ -d "$dir" ] || mkdir -m 700 "$dir" 2>/dev/null
+    if [ -O "$dir" ]; then
+      compgen -A "$1" -- "$2" > "$dir/compgen.$$" || return 0 # no matches
+      mapfile -t results < "$dir/compgen.$$"
+    else
+      local IFS=$'\\n' # items may contain spaces, so delimit using newline
+      results=( $(compgen -A "$1" -- "$2" || :) )
+    fi
+  fi
+  COMPREPLY+=("${results[@]}")
+  return 0
+}
+
+# $1=COMP_WORDS[1]
+_shtab_env_vars_compreply() {
+  _shtab_action_compreply export "$1"
+}
+
+# $1=COMP_WORDS[1]
+_shtab_users_compreply() {
+  _shtab_action_compreply user "$1"
+}
+
+# $1=COMP_WORDS[1]
+_shtab_groups_compreply() {
+  _shtab_action_compreply group "$1"
+}
+
+# $1=COMP_WORDS[1]
+_shtab_hostnames_compreply() {
+  _shtab_action_compreply hostname "$1"
+}
+
+# $1=COMP_WORDS[1]
+_shtab_commands_compreply() {
+  _shtab_action_compreply command "$1"
+}
+
+# $1=COMP_WORDS[1]
+_shtab_services_compreply() {
+  _shtab_action_compreply service "$1"
+}
+
+# $1=COMP_WORDS[1]
+_shtab_jobs_compreply() {
+  _shtab_action_compreply job "$1"
+}
+
+# $1=prefix, $2=also append directories (0/1), $3...=name patterns
+# append paths starting with the prefix whose name matches any pattern to
+# `COMPREPLY` (listing the directory once, like `_shtab_glob_compreply`; unlike
+# `compgen -f -X`, patterns match names rather than whole paths)
+_shtab_matching_compreply() {
+  local prefix="$1" dirs="$2" home="" path pattern
+  shift 2
+  if [[ $prefix == "~/"* ]]; then
+    home=$HOME
+    prefix="$HOME/${prefix:2}"
+  fi
+  local restore_unset=() restore_set=()
+  shopt -q nullglob || restore_unset+=(nullglob)
+  shopt -q dotglob || restore_unset+=(dotglob)
+  ! shopt -q failglob || restore_set+=(failglob)
+  shopt -s nullglob dotglob
+  [ ${#restore_set[@]} -eq 0 ] || shopt -u failglob
+  for path in "$prefix"*; do
+    for pattern in "$@"; do
+      if [[ ${path##*/} == $pattern ]]; then
+        COMPREPLY+=("${home:+"~"}${path#"$home"}")
+        continue 2
+      fi
+    done
+    [[ $dirs == 0 || ! -d $path ]] || COMPREPLY+=("${home:+"~"}${path#"$home"}")
+  done
+  [ ${#restore_unset[@]} -eq 0 ] || shopt -u "${restore_unset[@]}"
+  [ ${#restore_set[@]} -eq 0 ] || shopt -s "${restore_set[@]}"
+  return 0
+}
+
+# $1=prefix, $2...=words
+# append words starting with the prefix to `COMPREPLY`
+_shtab_words_compreply() {
+  local prefix="$1" word
+  shift
+  for word in "$@"; do
+    [[ $word != "$prefix"* ]] || COMPREPLY+=("$word")
+  done
+  return 0
+}
+
+# $1=prefix, $2=name of an array sorted by (`LC_ALL=C`) byte order, $3=its length,
+# $4=maximum number of words (optional)
+# append words starting with the prefix to `COMPREPLY` (using binary search)
+_shtab_sorted_compreply() {
+  local LC_ALL=C prefix="$1" lo=0 hi=$3 mid word end=$3
+  while (( lo < hi )); do
+    mid=$(( (lo + hi) / 2 ))
+    word="$2[$mid]"
+    if [[ ${!word} < $prefix ]]; then
+      lo=$(( mid + 1 ))
+    else
+      hi=$mid
+    fi
+  done
+  [ -z "${4-}" ] || (( lo + $4 >= end )) || end=$(( lo + $4 ))
+  while (( lo < end )); do
+    word="$2[$lo]"
+    [[ ${!word} == "$prefix"* ]] || break
+    COMPREPLY+=("${!word}")
+    (( lo += 1 ))
+  done
+  return 0
+}
+
+# Generate the completions (using the caller's `completing_word`,
+# `previous_word`, `pos_only`, `current_option_strings`,
+# `current_action_compgen` & `current_action_choices`)
+_shtab_compreply() {
+  if [[ $pos_only = 0 && "${completing_word}" == -* ]]; then
+    # optional argument started: use option strings
+    _shtab_words_compreply "${completing_word}" "${current_option_strings[@]}"
+  elif [[ "${previous_word}" == ">" || "${previous_word}" == ">>" ||
+          "${previous_word}" =~ ^[12]">" || "${previous_word}" =~ ^[12]">>" ]]; then
+    # handle redirection operators
+    _shtab_files_compreply "${completing_word}"
+  else
+    # use choices & compgen
+    if [[ "${current_action_compgen}" == *_compreply ]]; then
+      "${current_action_compgen}" "${completing_word}"
+    elif [ -n "${current_action_compgen}" ]; then
+      local IFS=$'\\n' # items may contain spaces, so delimit using newline
+      COMPREPLY=( $("${current_action_compgen}" "${completing_word}") )
+      unset IFS
+    fi
+    _shtab_words_compreply "${completing_word}" "${current_action_choices[@]}"
+  fi
+  return 0
+}
+"""
+
+
+def get_bash_cached_functions(command):
+    """Returns bash wrapper functions for `get_cached(command)`"""
+    functions = []
+    for complete in get_cached(command):
+        fn = complete.complete.get("bash")
+        if not fn:
+            continue
+        name = complete["bash"]
+        refresh = name[:-len("_compreply")] + "_refresh"
+        if fn.endswith("_compreply"):
+            call = (f'COMPREPLY=(); {fn} "$1"; (( ! ${{#COMPREPLY[@]}} )) || '
+                    'printf "%s\\n" "${COMPREPLY[@]}"')
+        else:
+            call = f'{fn} "$1"'
+        functions.append(
+            Template("""\
+# $1=COMP_WORDS[1], $2=cache file, $3=timestamp
+# set `results` & store them (preceded by the timestamp) in the cache file
+# (replaced atomically, so concurrent completions never read partial results)
+${refresh}() {
+  mapfile -t results < <(${call})
+  [ -d "${2%/*}" ] || mkdir -p "${2%/*}"
+  if printf '%s\\n' "$3" "${results[@]}" > "$2.$BASHPID"; then
+    mv -f "$2.$BASHPID" "$2"
+  else
+    rm -f "$2.$BASHPID"
+  fi
+}
+
+# $1=COMP_WORDS[1]
+# `${fn}` results, cached for ${ttl}s (stale results are refreshed
+# in the background)
+${name}() {
+  local key="${1//%/%25}" now
+  local file="${XDG_CACHE_HOME:-$HOME/.cache}/shtab/${prog}/${fn_word}:${key//\\//%2F}"
+  local -a results
+  printf -v now '%(%s)T' -1
+  if [ -f "$file" ] && mapfile -t results < "$file" && (( ${#results[@]} )); then
+    (( now - results[0] < ${ttl} )) || (${refresh} "$1" "$file" "$now" &>/dev/null &)
+    results=("${results[@]:1}")
+  else
+    ${refresh} "$1" "$file" "$now" 2>/dev/null
+  fi
+  COMPREPLY+=("${results[@]}")
+}
+""").safe_substitute(name=name, refresh=refresh, call=call, fn=fn, fn_word=wordify(fn),
+                     ttl=complete.ttl, prog=wordify(command.name)))
+    return "".join(f"\n{function}" for function in functions)
+
+
+def get_bash_served_functions(command):
+    """Returns bash client functions for `get_served(command)`"""
+    served = get_served(command)
+    if not served:
+        return ""
+    from .serve import TIMEOUT, get_id
+
+    client = f"_shtab_serve_{get_id()}"
+    functions = [
+        Template("""\
+# $1=`.complete` callable key, $2=COMP_WORDS[1]
+# append the `shtab.serve` daemon's results to `COMPREPLY`
+# (bash cannot connect to Unix sockets, so a relay coprocess is started)
+${client}_compreply() {
+  local count
+  local -a results
+  if [[ -z ${${client}_PID-} ]] || ! kill -0 "${${client}_PID}" 2>/dev/null; then
+    coproc ${client} { exec ${python} -m shtab.serve --connect 2>/dev/null; }
+  fi
+  printf 'complete\\t%s\\t%s\\n' "$1" "${2//[$'\\t\\n']/ }" >&"${${client}[1]}" || return 0
+  if ! read -r -t ${timeout} count <&"${${client}[0]}"; then
+    kill "${${client}_PID}" 2>/dev/null # out of sync
+    return 0
+  fi
+  (( count )) || return 0
+  mapfile -t -n "$count" -u "${${client}[0]}" results
+  COMPREPLY+=("${results[@]}")
+}
+""").safe_substitute(client=client, python=shell_quote(sys.executable), timeout=TIMEOUT)]
+    for complete in served:
+        functions.append(f"""\
+# $1=COMP_WORDS[1]
+{complete["bash"]}() {{
+  {client}_compreply {shell_quote(complete.key)} "$1"
+}}
+""")
+    return "".join(f"\n{function}" for function in functions)
+
+
+def get_bash_choices_functions(command):
+    """Returns bash loader functions for `get_choices_files(command)`"""
+    return "".join(
+        Template("""
+# $1=COMP_WORDS[1]
+# append choices (loaded once from ${path}) starting with $1 to `COMPREPLY`
+${name}_compreply() {
+  [ -n "${${name}+set}" ] || mapfile -t ${name} 2>/dev/null < ${quoted_path}
+  _shtab_sorted_compreply "$1" ${name} ${#${name}[@]}
+}
+""").safe_substitute(name=complete["bash"][:-len("_compreply")], path=complete.path,
+                     quoted_path=shell_quote(complete.path))
+        for complete in get_choices_files(command))
+
+
+def get_bash_sorted_functions(command):
+    """Returns bash arrays & functions for `get_sorted_choices(command)`"""
+    functions = []
+    for complete in get_sorted_choices(command):
+        choices = " ".join(map(shell_quote, complete.choices))
+        functions.append(
+            Template("""
+${name}=(${choices})
+
+# $1=COMP_WORDS[1]
+${name}_compreply() {
+  _shtab_sorted_compreply "$1" ${name} ${#${name}[@]}
+}
+""").safe_substitute(name=complete["bash"][:-len("_compreply")], choices=choices))
+    return "".join(functions)
+
+
+def get_bash_limited_functions(command):
+    """Returns bash arrays & functions for `get_limited(command)`"""
+    functions = []
+    for complete in get_limited(command):
+        name = complete["bash"][:-len("_compreply")]
+        lines = []
+        if complete.min_prefix:
+            lines.append(f"(( ${{#1}} >= {complete.min_prefix} )) || return 0")
+        if complete.limit is not None:
+            lines.append(f"local -x SHTAB_LIMIT={complete.limit} # for custom functions")
+        fn = complete.complete.get("bash")
+        if fn and fn.endswith("_compreply"):
+            lines.append(f'{fn} "$1"')
+        elif fn:
+            lines.extend([
+                "local IFS=$'\\n' # items may contain spaces, so delimit using newline",
+                f'COMPREPLY+=( $({fn} "$1") )', "unset IFS"])
+        if complete.choices:
+            lines.append(f'_shtab_sorted_compreply "$1" {name}_choices ${{#{name}_choices[@]}}' +
+                         ("" if complete.limit is None else f" {complete.limit}"))
+        if complete.limit is not None:
+            lines.append(f'(( ${{#COMPREPLY[@]}} <= {complete.limit} )) ||'
+                         f' COMPREPLY=("${{COMPREPLY[@]:0:{complete.limit}}}")')
+        choices = (f"{name}_choices=({' '.join(map(shell_quote, complete.choices))})\n\n"
+                   if complete.choices else "")
+        body = "".join(f"  {line}\n" for line in lines)
+        functions.append(f"""
+{choices}# $1=COMP_WORDS[1]
+{name}_compreply() {{
+{body}  return 0
+}}
+""")
+    return "".join(functions)
+
+
+def get_bash_matching_functions(command):
+    """Returns bash functions for `get_file_matching(command)`"""
+    return "".join(f"""
+# $1=COMP_WORDS[1]
+{complete["bash"]}() {{
+  _shtab_matching_compreply "$1" {int(complete.dirs)} {format_bash_array(complete.patterns)}
+}}
+""" for complete in get_file_matching(command))
+
+
+def get_bash_helpers(command):
+    """Returns `BASH_HELPERS` & any functions needed by `command`'s `.complete` values"""
+    return (BASH_HELPERS + get_bash_cached_functions(command) +
+            get_bash_served_functions(command) + get_bash_choices_functions(command) +
+            get_bash_sorted_functions(command) + get_bash_limited_functions(command) +
+            get_bash_matching_functions(command))
+
+
+@mark_completer("bash")
+def complete_bash(parser, root_prefix=None, preamble="", choice_functions=None, layout=None):
+    """
+    Returns bash syntax autocompletion script.
+
+    See `complete` for arguments.
+    """
+    layout = get_layout("bash", layout)
+    if layout == "table":
+        return complete_bash_table(parser, root_prefix=root_prefix, preamble=preamble,
+                                   choice_functions=choice_functions)
+    if layout == "assoc":
+        return complete_bash_assoc(parser, root_prefix=root_prefix, preamble=preamble,
+                                   choice_functions=choice_functions)
+    return "".join(
+        iter_complete_bash(parser, root_prefix=root_prefix, preamble=preamble,
+                           choice_functions=choice_functions, layout=layout))
+
+
+@mark_iter_completer("bash")
+def iter_complete_bash(parser, root_prefix=None, preamble="", choice_functions=None, layout=None):
+    """
+    Yields chunks of `complete_bash` (the default layout is streamed one line
+    of data at a time).
+    """
+    layout = get_layout("bash", layout)
+    if layout != "default":
+        yield complete_bash(parser, root_prefix=root_prefix, preamble=preamble,
+                            choice_functions=choice_functions, layout=layout)
+        return
+    command = index_choices(apply_limits(parser))
+    root_prefix = wordify(f"_shtab_{root_prefix or command.name}")
+    yield from iter_format_bash(
+        command, root_prefix, preamble,
+        tuple(
+            iter_bash_commands(command, root_prefix, section, choice_functions=choice_functions)
+            for section in BASH_SECTIONS))
+
+
+@mark_breakdown("bash")
+def get_bash_breakdown(parser, root_prefix=None, choice_functions=None, layout=None):
+    """
+    Returns the data size (bytes) by section (`BASH_SECTIONS`, or
+    `BASH_TABLE_SECTIONS` & `BASH_ASSOC_SECTIONS` for the table & assoc
+    layouts) & by top-level command: `{"sections": {section: size},
+    "commands": {"prog cmd": size}}`. Data shared by several commands
+    (table & assoc layouts) is counted for the first command needing it.
+    """
+    layout = get_layout("bash", layout)
+    command = index_choices(apply_limits(parser))
+    if layout != "default":
+        names = [command.name] + [f"{command.name} {cmd}" for cmd in command.commands]
+        commands = dict.fromkeys(names, 0)
+        if layout == "table":
+            sections = dict.fromkeys(BASH_TABLE_SECTIONS, 0)
+            owners = {}
+            data = get_bash_table(command, choice_functions=choice_functions, owners=owners)
+            table = dict(zip(BASH_TABLE_SECTIONS, data))
+            items = {
+                "words": zip(owners["words"], map(format_bash_item, table["words"])),
+                "options": zip(owners["states"], map(format_bash_item, table["options"])),
+                "positionals": zip(owners["states"], map(format_bash_item, table["positionals"])),
+                "transitions": ((owners["states"][int(key.split(" ", 1)[0])],
+                                 format_bash_item(value, key))
+                                for key, value in table["transitions"].items())}
+            for section in ("nargs", "compgens", "choices"):
+                items[section] = ((owners["actions"][key], format_bash_item(value, key))
+                                  for key, value in table[section].items())
+        else:
+            sections = dict.fromkeys(BASH_ASSOC_SECTIONS, 0)
+            owners = {}
+            assoc = get_bash_assoc(command, choice_functions=choice_functions, owners=owners)
+            items = {
+                section: ((owners[key.split("/", 1)[0]], format_bash_item(value, key))
+                          for key, value in mapping.items())
+                for section, mapping in zip(BASH_ASSOC_SECTIONS, assoc)}
+        for section, owned_items in items.items():
+            for owner, item in owned_items:
+                size = len(item.encode()) + 1 # separator
+                sections[section] += size
+                commands[owner] += size
+        return {"sections": sections, "commands": commands}
+
+    root_prefix = wordify(f"_shtab_{root_prefix or command.name}")
+    parts = [(command.name, command, root_prefix, False)] + [
+        (f"{command.name} {cmd}", subcommand, f"{root_prefix}_{wordify(cmd)}", True)
+        for cmd, subcommand in command.commands.items()]
+    sections = dict.fromkeys(BASH_SECTIONS, 0)
+    commands = dict.fromkeys((name for name, *_ in parts), 0)
+    for name, subcommand, prefix, recursive in parts:
+        for section in BASH_SECTIONS:
+            size = sum(
+                len(line.encode()) + 1 for line in iter_bash_commands(
+                    subcommand, prefix, section, choice_functions=choice_functions,
+                    recursive=recursive))
+            sections[section] += size
+            commands[name] += size
+    return {"sections": sections, "commands": commands}
+
+
+def format_bash(command, root_prefix, preamble, commands, data_files=None):
+    """Returns bash syntax autocompletion script (see `iter_format_bash`)"""
+    return "".join(iter_format_bash(command, root_prefix, preamble, commands, data_files))
+
+
+def iter_format_bash(command, root_prefix, preamble, commands, data_files=None):
+    """
+    Yields chunks of the bash autocompletion script for `complete_bash`.
+
+    commands  : `get_bash_commands(...)` output (or lazy `iter_bash_commands`
+      sections)
+    data_files  : `{prefix: filename}` of (subcommands') `get_bash_commands`
+      output to `source` (relative to the script's directory) when the
+      subcommand is first encountered
+    """
+    subparsers, option_strings, compgens, choices, nargs = commands
+    load_data = load_data_function = ""
+    if data_files:
+        data_files = "\n".join(f"{prefix}_DATA={shell_quote(filename)}"
+                               for prefix, filename in data_files.items())
+        load_data = f'        {root_prefix}_load_data "$prefix"\n'
+        load_data_function = Template("""\
+# data files are relative to this script
+${root_prefix}_DATA_DIR=.
+[[ "${BASH_SOURCE[0]}" != */* ]] || ${root_prefix}_DATA_DIR="${BASH_SOURCE[0]%/*}"
+
+# $1=prefix
+# source the (sub)parser's data file (if not already sourced)
+${root_prefix}_load_data() {
+  local data_var="$1_DATA"
+  if [ -n "${!data_var-}" ]; then
+    source "${${root_prefix}_DATA_DIR}/${!data_var}"
+    unset "$data_var"
+  fi
+}
+
+""").safe_substitute(root_prefix=root_prefix)
+    else:
+        data_files = ""
+
+    # References:
+    # - https://www.gnu.org/software/bash/manual/html_node/
+    #   Programmable-Completion.html
+    # - https://opensource.com/article/18/3/creating-bash-completion-script
+    # - https://stackoverflow.com/questions/12933362
+    yield from iter_template(
+        """\
+# AUTOMATICALLY GENERATED by `shtab`
+
+${subparsers}
+
+${option_strings}
+
+${compgens}
+
+${choices}
+
+${nargs}
+${data_files}
+${preamble}
+${helpers}
+${load_data_function}# set default values (called for the initial parser & any subparsers)
+_set_parser_defaults() {
+  local subparsers_var="${prefix}_subparsers[@]"
+  sub_parsers=("${!subparsers_var}")
+
+  local current_option_strings_var="${prefix}_option_strings[@]"
+  current_option_strings=("${!current_option_strings_var}")
+
+  completed_positional_actions=0
+
+  _set_new_action "pos_${completed_positional_actions}" true
+}
+
+# $1=action identifier
+# $2=positional action (bool)
+# set all identifiers for an action's parameters
+_set_new_action() {
+  current_action="${prefix}_${1//[^[:word:]]/_}"
+
+  local current_action_compgen_var=${current_action}_COMPGEN
+  current_action_compgen="${!current_action_compgen_var-}"
+
+  local current_action_choices_var="${current_action}_choices[@]"
+  current_action_choices=("${!current_action_choices_var}")
+
+  local current_action_nargs_var="${current_action}_nargs"
+  if [ -n "${!current_action_nargs_var-}" ]; then
+    current_action_nargs="${!current_action_nargs_var}"
+  else
+    current_action_nargs=1
+  fi
+
+  current_action_args_start_index=$(( $word_index + 1 - $pos_only ))
+
+  current_action_is_positional=$2
+}
+
+# Notes:
+# `COMPREPLY`: what will be rendered after completion is triggered
+# `completing_word`: currently typed word to generate completions for
+# `${!var}`: evaluates the content of `var` and expand its content as a variable
+#     hello="world"
+#     x="hello"
+#     ${!x} -> ${hello} -> "world"
+# Only builtins are used (no subshells) unless calling custom `.complete`
+# functions (which print completions rather than appending to `COMPREPLY`).
+${root_prefix}() {
+  local completing_word="${COMP_WORDS[COMP_CWORD]}"
+  local previous_word="${COMP_WORDS[COMP_CWORD-1]}"
+  local completed_positional_actions
+  local current_action
+  local current_action_args_start_index
+  local current_action_choices
+  local current_action_compgen
+  local current_action_is_positional
+  local current_action_nargs
+  local current_option_strings
+  local sub_parsers
+  COMPREPLY=()
+
+  local prefix=${root_prefix}
+  local word_index=0
+  local pos_only=0 # "--" delimeter not encountered yet
+  _set_parser_defaults
+  word_index=1
+
+  # determine what arguments are appropriate for the current state
+  # of the arg parser
+  while [ $word_index -ne $COMP_CWORD ]; do
+    local this_word="${COMP_WORDS[$word_index]}"
+
+    if [[ $pos_only = 1 || " $this_word " != " -- " ]]; then
+      if [[ -n ${sub_parsers[*]} && " ${sub_parsers[@]} " == *" ${this_word} "* ]]; then
+        # valid subcommand: add it to the prefix & reset the current action
+        prefix="${prefix}_${this_word//[^[:word:]]/_}"
+${load_data}        _set_parser_defaults
+      fi
+
+      if [[ " ${current_option_strings[@]} " == *" ${this_word} "* ]]; then
+        # a new action should be acquired (due to recognised option string or
+        # no more input expected from current action);
+        # the next positional action can fill in here
+        _set_new_action $this_word false
+      fi
+
+      if [[ "$current_action_nargs" != "*" ]] && \\
+         [[ "$current_action_nargs" != "+" ]] && \\
+         [[ "$current_action_nargs" != "?" ]] && \\
+         [[ "$current_action_nargs" != *"..." ]] && \\
+         (( $word_index + 1 - $current_action_args_start_index - $pos_only >= \\
+            $current_action_nargs )); then
+        $current_action_is_positional && let "completed_positional_actions += 1"
+        _set_new_action "pos_${completed_positional_actions}" true
+      fi
+    else
+      pos_only=1 # "--" delimeter encountered
+    fi
+
+    let "word_index+=1"
+  done
+
+  _shtab_compreply
+  return 0
+}
+
+complete -o filenames -F ${root_prefix} ${prog}""",
+        subparsers=iter_joined(subparsers),
+        option_strings=iter_joined(option_strings),
+        compgens=iter_joined(compgens),
+        choices=iter_joined(choices),
+        nargs=iter_joined(nargs),
+        data_files=data_files,
+        preamble=("\n# Custom Preamble\n" + preamble +
+                  "\n# End Custom Preamble\n" if preamble else ""),
+        helpers=get_bash_helpers(command),
+        load_data_function=load_data_function,
+        load_data=load_data,
+        root_prefix=root_prefix,
+        prog=command.name,
+    )
+
+
+def complete_bash_split(parser, root_prefix=None, preamble="", choice_functions=None):
+    """
+    Returns `{filename: content}`: a small bash autocompletion script (named
+    after the program) plus a data file per top-level subcommand (in a
+    `<root_prefix>.d` directory, named by content hash). Data files are
+    `source`d (relative to the script's directory) the first time their
+    subcommand is completed.
+
+    See `complete` for arguments.
+    """
+    command = apply_limits(parser)
+    root_prefix = wordify(f"_shtab_{root_prefix or command.name}")
+    data_files = {}
+    files = {}
+    for cmd, subcommand in command.commands.items():
+        prefix = f"{root_prefix}_{wordify(cmd)}"
+        sections = get_bash_commands(subcommand, prefix, choice_functions=choice_functions)
+        blocks = ["\n".join(lines) for lines in sections if lines]
+        content = "\n\n".join(["# AUTOMATICALLY GENERATED by `shtab`", *blocks]) + "\n"
+        filename = f"{root_prefix}.d/{sha256(content.encode()).hexdigest()[:16]}.bash"
+        data_files[prefix] = filename
+        files[filename] = content
+    root = format_bash(
+        command, root_prefix, preamble,
+        get_bash_commands(command, root_prefix, choice_functions=choice_functions,
+                          recursive=False), data_files=data_files)
+    return {command.name: root + "\n", **files}
+
+
+def complete_bash_table(parser, root_prefix=None, preamble="", choice_functions=None):
+    """
+    Returns bash syntax autocompletion script using a (`bash>=4.2`) state
+    table, with a fixed driver doing `O(1)` work per word.
+
+    See `complete` for arguments.
+    """
+    command = index_choices(apply_limits(parser))
+    root_prefix = wordify(f"_shtab_{root_prefix or command.name}")
+    words, options, positionals, transitions, nargs, compgens, choices = get_bash_table(
+        command, choice_functions=choice_functions)
+
+    def format_array(name, values, assoc=False):
+        declare = "declare -gA" if assoc else "declare -ga"
+        return f"{declare} {root_prefix}_{name}=({format_bash_array(values)})"
+
+    return Template("""\
+# AUTOMATICALLY GENERATED by `shtab`
+
+${words}
+${options}
+${positionals}
+${transitions}
+${nargs}
+${compgens}
+${choices}
+
+${preamble}
+${helpers}
+# $1=action ID
+# $2=positional action (bool)
+# set all parameters for an action
+${root_prefix}_set_action() {
+  current_action=$1
+  current_action_nargs=${${root_prefix}_nargs[$1]-1}
+  current_action_args_start_index=$(( word_index + 1 - pos_only ))
+  current_action_is_positional=$2
+}
+
+# Notes:
+# `COMPREPLY`: what will be rendered after completion is triggered
+# `completing_word`: currently typed word to generate completions for
+# `${root_prefix}_transitions["$state $word"]`: next state (`s<state>`)
+#     or action (`a<action>`)
+# `${root_prefix}_*[action]`: action parameters
+# `${root_prefix}_{options,choices}`: "start count" slices of `${root_prefix}_words`
+${root_prefix}() {
+  local completing_word="${COMP_WORDS[COMP_CWORD]}"
+  local previous_word="${COMP_WORDS[COMP_CWORD-1]}"
+  local completed_positional_actions=0
+  local current_action
+  local current_action_args_start_index
+  local current_action_choices
+  local current_action_compgen
+  local current_action_is_positional
+  local current_action_nargs
+  local current_option_strings
+  local -a positionals=(${${root_prefix}_positionals[0]})
+  local -a slice
+  local next
+  local state=0
+  COMPREPLY=()
+
+  local word_index=0
+  local pos_only=0 # "--" delimeter not encountered yet
+  ${root_prefix}_set_action ${positionals[0]-0} true
+  word_index=1
+
+  # determine what arguments are appropriate for the current state
+  # of the arg parser
+  while [ $word_index -ne $COMP_CWORD ]; do
+    local this_word="${COMP_WORDS[$word_index]}"
+
+    if [[ $pos_only = 1 || " $this_word " != " -- " ]]; then
+      next="${${root_prefix}_transitions["$state $this_word"]-}"
+      case "$next" in
+        s*)
+          # valid subcommand: change state & reset the current action
+          state=${next#s}
+          positionals=(${${root_prefix}_positionals[state]})
+          completed_positional_actions=0
+          ${root_prefix}_set_action ${positionals[0]-0} true
+          ;;
+        a*)
+          # recognised option string
+          ${root_prefix}_set_action ${next#a} false
+          ;;
+      esac
+
+      if [[ "$current_action_nargs" != "*" ]] && \\
+         [[ "$current_action_nargs" != "+" ]] && \\
+         [[ "$current_action_nargs" != "?" ]] && \\
+         [[ "$current_action_nargs" != *"..." ]] && \\
+         (( word_index + 1 - current_action_args_start_index - pos_only >= \\
+            current_action_nargs )); then
+        $current_action_is_positional && let "completed_positional_actions += 1"
+        ${root_prefix}_set_action ${positionals[completed_positional_actions]-0} true
+      fi
+    else
+      pos_only=1 # "--" delimeter encountered
+    fi
+
+    let "word_index+=1"
+  done
+
+  slice=(${${root_prefix}_options[state]})
+  current_option_strings=("${${root_prefix}_words[@]:slice[0]:slice[1]}")
+  current_action_compgen="${${root_prefix}_compgens[current_action]-}"
+  slice=(${${root_prefix}_choices[current_action]-0 0})
+  current_action_choices=("${${root_prefix}_words[@]:slice[0]:slice[1]}")
+  _shtab_compreply
+  return 0
+}
+
+complete -o filenames -F ${root_prefix} ${prog}""").safe_substitute(
+        words=format_array("words", words),
+        options=format_array("options", options),
+        positionals=format_array("positionals", positionals),
+        transitions=format_array("transitions", transitions, assoc=True),
+        nargs=format_array("nargs", nargs),
+        compgens=format_array("compgens", compgens),
+        choices=format_array("choices", choices),
+        preamble=("\n# Custom Preamble\n" + preamble +
+                  "\n# End Custom Preamble\n" if preamble else ""),
+        helpers=get_bash_helpers(command),
+        root_prefix=root_prefix,
+        prog=command.name,
+    )
+
+
+def complete_bash_assoc(parser, root_prefix=None, preamble="", choice_functions=None):
+    """
+    Returns bash syntax autocompletion script storing all data in a few
+    (`bash>=4.2`) associative arrays rather than one variable per
+    (sub)parser & action.
+
+    See `complete` for arguments.
+    """
+    command = index_choices(apply_limits(parser))
+    root_prefix = wordify(f"_shtab_{root_prefix or command.name}")
+    subparsers, options, option_strings, compgens, choices, nargs = get_bash_assoc(
+        command, choice_functions=choice_functions)
+
+    def format_assoc(name, mapping):
+        return f"declare -gA {root_prefix}_{name}=({format_bash_array(mapping)})"
+
+    return Template("""\
+# AUTOMATICALLY GENERATED by `shtab`
+
+${subparsers}
+${options}
+${option_strings}
+${compgens}
+${choices}
+${nargs}
+
+${preamble}
+${helpers}
+# $1=action (`pos_<index>` or first option string)
+# $2=positional action (bool)
+# set all parameters for an action
+${root_prefix}_set_action() {
+  current_action="$prefix/$1"
+  current_action_compgen="${${root_prefix}_compgens[$current_action]-}"
+  current_action_nargs="${${root_prefix}_nargs[$current_action]-1}"
+  current_action_args_start_index=$(( word_index + 1 - pos_only ))
+  current_action_is_positional=$2
+}
+
+# Notes:
+# `COMPREPLY`: what will be rendered after completion is triggered
+# `completing_word`: currently typed word to generate completions for
+# `prefix`: current (sub)parser ("" for the root parser)
+# `${root_prefix}_*["$prefix/..."]`: (sub)parser & action data
+${root_prefix}() {
+  local completing_word="${COMP_WORDS[COMP_CWORD]}"
+  local previous_word="${COMP_WORDS[COMP_CWORD-1]}"
+  local completed_positional_actions=0
+  local current_action
+  local current_action_args_start_index
+  local current_action_choices
+  local current_action_compgen
+  local current_action_is_positional
+  local current_action_nargs
+  local current_option_strings
+  local key
+  COMPREPLY=()
+
+  local prefix=""
+  local word_index=0
+  local pos_only=0 # "--" delimeter not encountered yet
+  ${root_prefix}_set_action pos_0 true
+  word_index=1
+
+  # determine what arguments are appropriate for the current state
+  # of the arg parser
+  while [ $word_index -ne $COMP_CWORD ]; do
+    local this_word="${COMP_WORDS[$word_index]}"
+    key="$prefix/$this_word"
+
+    if [[ $pos_only = 1 || " $this_word " != " -- " ]]; then
+      if [[ -n ${${root_prefix}_subparsers[$key]+set} ]]; then
+        # valid subcommand: change the prefix & reset the current action
+        prefix="${${root_prefix}_subparsers[$key]}"
+        key="$prefix/$this_word"
+        completed_positional_actions=0
+        ${root_prefix}_set_action pos_0 true
+      fi
+
+      if [[ -n ${${root_prefix}_options[$key]+set} ]]; then
+        # recognised option string
+        ${root_prefix}_set_action "${${root_prefix}_options[$key]}" false
+      fi
+
+      if [[ "$current_action_nargs" != "*" ]] && \\
+         [[ "$current_action_nargs" != "+" ]] && \\
+         [[ "$current_action_nargs" != "?" ]] && \\
+         [[ "$current_action_nargs" != *"..." ]] && \\
+         (( word_index + 1 - current_action_args_start_index - pos_only >= \\
+            current_action_nargs )); then
+        $current_action_is_positional && let "completed_positional_actions += 1"
+        ${root_prefix}_set_action "pos_${completed_positional_actions}" true
+      fi
+    else
+      pos_only=1 # "--" delimeter encountered
+    fi
+
+    let "word_index+=1"
+  done
+
+  # (trusted, pre-quoted) lists
+  declare -a "current_option_strings=(${${root_prefix}_option_strings[$prefix/]-})"
+  declare -a "current_action_choices=(${${root_prefix}_choices[$current_action]-})"
+  _shtab_compreply
+  return 0
+}
+
+complete -o filenames -F ${root_prefix} ${prog}""").safe_substitute(
+        subparsers=format_assoc("subparsers", subparsers),
+        options=format_assoc("options", options),
+        option_strings=format_assoc("option_strings", option_strings),
+        compgens=format_assoc("compgens", compgens),
+        choices=format_assoc("choices", choices),
+        nargs=format_assoc("nargs", nargs),
+        preamble=("\n# Custom Preamble\n" + preamble +
+                  "\n# End Custom Preamble\n" if preamble else ""),
+        helpers=get_bash_helpers(command),
+        root_prefix=root_prefix,
+        prog=command.name,
+    )
@@ -0,0 +1,405 @@
+"""
+Benchmarks for completion script generation & the generated scripts.
+
+Builds synthetic parsers of various shapes and reports, for each shell,
+generation wall time, peak `tracemalloc` memory & output size.
+
+Usage:
+  python -m shtab.bench [--shell SHELL] [--layout LAYOUT] [--save FILE] [--baseline FILE]
+
+See also `measure_latency` (`shtab --bench`) for the runtime cost of
+generated scripts (sourcing & per-keypress latency).
+"""
+import argparse
+import json
+import logging
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+from typing import Optional as Opt
+
+from . import SUPPORTED_LAYOUTS, SUPPORTED_SHELLS, build_model, complete, wordify
+
+log = logging.getLogger(__name__)
+METRICS = "time", "peak_memory", "bytes"
+
+
+def wide_parser(num_subcommands: int = 2000, num_options: int = 3) -> argparse.ArgumentParser:
+    """Thousands of subcommands, each with a few options."""
+    parser = argparse.ArgumentParser(prog="wide")
+    subparsers = parser.add_subparsers()
+    for i in range(num_subcommands):
+        sub = subparsers.add_parser(f"cmd{i}", help=f"command {i}")
+        for j in range(num_options):
+            sub.add_argument(f"--opt{j}", help=f"option {j}")
+        sub.add_argument("path", nargs="?", help="a path")
+    return parser
+
+
+def deep_parser(depth: int = 50) -> argparse.ArgumentParser:
+    """Nested subparsers."""
+    parser = sub = argparse.ArgumentParser(prog="deep")
+    for i in range(depth):
+        sub.add_argument("--verbose", action="count", help="verbosity")
+        sub = sub.add_subparsers().add_parser(f"level{i}", help=f"level {i}")
+    return parser
+
+
+def options_parser(num_options: int = 3000, num_subcommands: int = 10) -> argparse.ArgumentParser:
+    """Thousands of options shared between subcommands via `parents=`."""
+    common = argparse.ArgumentParser(add_help=False)
+    for i in range(num_options):
+        common.add_argument(f"--option-{i}", nargs="?" if i % 2 else None, help=f"option {i}")
+    parser = argparse.ArgumentParser(prog="options", parents=[common])
+    subparsers = parser.add_subparsers()
+    for i in range(num_subcommands):
+        subparsers.add_parser(f"cmd{i}", parents=[common], help=f"command {i}")
+    return parser
+
+
+def choices_parser(num_choices: int = 50000) -> argparse.ArgumentParser:
+    """Huge `choices` lists."""
+    choices = [f"choice-{i:06d}" for i in range(num_choices)]
+    parser = argparse.ArgumentParser(prog="choices")
+    parser.add_argument("--region", choices=choices, help="region name")
+    parser.add_argument("dataset", choices=choices, help="dataset ID")
+    return parser
+
+
+def cloud_parser(num_services: int = 300, num_operations: int = 30) -> argparse.ArgumentParser:
+    """Cloud CLI shape: `cloud <service> <operation> [options]`."""
+    parser = argparse.ArgumentParser(prog="cloud", description="cloud CLI")
+    parser.add_argument("--profile", help="credentials profile")
+    parser.add_argument("--region", choices=[f"region-{i}" for i in range(30)], help="region")
+    parser.add_argument("--output", choices=["json", "text", "table", "yaml"], help="format")
+    services = parser.add_subparsers(dest="service")
+    for i in range(num_services):
+        service = services.add_parser(f"service{i}", help=f"service {i} operations")
+        operations = service.add_subparsers(dest="operation")
+        for j in range(num_operations):
+            operation = operations.add_parser(f"describe-thing-{j}", help=f"operation {j}")
+            operation.add_argument("--id", help="resource ID")
+            operation.add_argument("--filters", nargs="+", help="filters")
+            operation.add_argument("--max-items", type=int, help="page size")
+            operation.add_argument("--dry-run", action="store_true", help="dry run")
+    return parser
+
+
+def vcs_parser(num_commands: int = 150) -> argparse.ArgumentParser:
+    """Version control shape: many commands, many flags, few choices."""
+    parser = argparse.ArgumentParser(prog="vcs")
+    parser.add_argument("-C", dest="directory", help="run as if started in <path>")
+    subparsers = parser.add_subparsers()
+    for i in range(num_commands):
+        sub = subparsers.add_parser(f"command{i}", aliases=[f"c{i}"], help=f"command {i}")
+        for j in range(20):
+            sub.add_argument(f"-{chr(65 + j)}", f"--flag-{j}", action="store_true",
+                             help=f"flag {j}")
+        sub.add_argument("--format", choices=["short", "medium", "full", "raw"], help="format")
+        sub.add_argument("paths", nargs="*", help="paths")
+    return parser
+
+
+#: {name: parser factory}
+SUITE: Dict[str, Callable[[], argparse.ArgumentParser]] = {
+    "wide": wide_parser, "wide-10k": partial(wide_parser, 10000), "deep": deep_parser,
+    "options": options_parser, "choices": choices_parser, "cloud": cloud_parser, "vcs": vcs_parser}
+
+
+def measure(parser, shell: str, repeat: int = 3, layout: Opt[str] = None) -> Dict[str, float]:
+    """Returns `{"time": seconds, "peak_memory": bytes, "bytes": output size}`."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        script = complete(parser, shell=shell, layout=layout)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        complete(parser, shell=shell, layout=layout)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"time": best, "peak_memory": peak, "bytes": len(script.encode())}
+
+
+def run(suite: Opt[Dict[str, Callable[[], argparse.ArgumentParser]]] = None,
+        shells: Opt[List[str]] = None, repeat: int = 3,
+        layout: Opt[str] = None) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """
+    Returns `{parser_name: {shell: measure(...)}}`.
+
+    layout  : if specified, `shells` defaults to those supporting it
+    """
+    if not shells:
+        shells = [
+            shell for shell in SUPPORTED_SHELLS
+            if layout is None or layout in SUPPORTED_LAYOUTS.get(shell, ("default",))]
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for name, factory in (SUITE if suite is None else suite).items():
+        parser = factory()
+        for shell in shells:
+            log.debug("measuring %s:%s", name, shell)
+            results.setdefault(name, {})[shell] = measure(parser, shell, repeat=repeat,
+                                                          layout=layout)
+    return results
+
+
+def compare(results, baseline, tolerance: float = 0.2) -> List[str]:
+    """
+    Returns descriptions of metrics in `results` which are more than
+    `tolerance` (fractionally) worse than in `baseline`.
+    """
+    regressions = []
+    for name, shells in results.items():
+        for shell, metrics in shells.items():
+            try:
+                base = baseline[name][shell]
+            except KeyError:
+                continue
+            for metric in METRICS:
+                if base.get(metric) and metrics[metric] > base[metric] * (1+tolerance):
+                    regressions.append(f"{name}:{shell}:{metric}:"
+                                       f" {metrics[metric]:.6g} > {base[metric]:.6g}")
+    return regressions
+
+
+def format_results(results) -> str:
+    lines = [f"{'parser':<10} {'shell':<6} {'time/s':>9} {'peak/MiB':>9} {'output/KiB':>10}"]
+    for name, shells in results.items():
+        for shell, metrics in shells.items():
+            lines.append(f"{name:<10} {shell:<6} {metrics['time']:>9.4f}"
+                         f" {metrics['peak_memory'] / 2**20:>9.2f}"
+                         f" {metrics['bytes'] / 2**10:>10.1f}")
+    return "\n".join(lines)
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Nearest-rank percentile of (non-empty) `values`."""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))]
+
+
+def default_lines(parser) -> List[str]:
+    """Representative command lines (the last word is being completed)."""
+    command = build_model(parser)
+    prog = command.name
+    lines = [f"{prog} ", f"{prog} -", f"{prog} --"]
+    for opt in command.options:
+        if opt.choices:
+            lines.append(f"{prog} {opt.option_strings[-1]} ")
+            break
+    path = []
+    while command.commands:
+        path.append(next(iter(command.commands)))
+        command = command.commands[path[-1]]
+        lines.extend((f"{prog} {' '.join(path)} ", f"{prog} {' '.join(path)} -"))
+    return list(dict.fromkeys(lines))
+
+
+_BASH_LATENCY = """\
+_shtab_bench_rss() {
+  REPLY=
+  [[ -r /proc/$$/status ]] || return 0
+  local key value unit
+  while read -r key value unit; do
+    [[ $key == VmRSS: ]] && REPLY=$value && return 0
+  done < /proc/$$/status
+}
+_shtab_bench_rss; rss_before=$REPLY
+start=${EPOCHREALTIME/[.,]/}
+source "$1"
+end=${EPOCHREALTIME/[.,]/}
+_shtab_bench_rss; rss_after=$REPLY
+echo "@source $((end - start))"
+echo "@rss ${rss_before:-0} ${rss_after:-0}"
+shift
+repeat=$1
+shift
+line_index=0
+for line in "$@"; do
+  read -r -a COMP_WORDS <<< "$line"
+  [[ $line == *" " ]] && COMP_WORDS+=("")
+  COMP_CWORD=$(( ${#COMP_WORDS[@]} - 1 ))
+  COMP_LINE=$line
+  COMP_POINT=${#line}
+  times=()
+  for ((i = 0; i < repeat; i++)); do
+    start=${EPOCHREALTIME/[.,]/}
+    ${function} "${COMP_WORDS[0]}" "${COMP_WORDS[COMP_CWORD]}" "${COMP_WORDS[COMP_CWORD-1]}"
+    end=${EPOCHREALTIME/[.,]/}
+    times+=($((end - start)))
+  done
+  echo "@line $line_index ${times[*]}"
+  let "line_index += 1"
+done
+"""
+_ZSH_LATENCY = """\
+zmodload zsh/datetime
+_shtab_bench_rss() {
+  REPLY=
+  [[ -r /proc/$$/status ]] || return 0
+  local key value unit
+  while read -r key value unit; do
+    [[ $key == VmRSS: ]] && REPLY=$value && return 0
+  done < /proc/$$/status
+}
+compdef() { : }
+_shtab_bench_rss; rss_before=$REPLY
+start=$EPOCHREALTIME
+eval "$(<$1)"
+end=$EPOCHREALTIME
+_shtab_bench_rss; rss_after=$REPLY
+echo "@source $(( int((end - start) * 1000000) ))"
+echo "@rss ${rss_before:-0} ${rss_after:-0}"
+shift
+repeat=$1
+shift
+# completion functions only run inside completion widgets, so type each line
+# (& TAB) into an interactive shell on a pseudo-terminal (`zpty`), which times
+# the (wrapped) completion function itself
+zmodload zsh/zpty
+zpty shtab_bench "TERM=vt100 ${(q)0} -fiV"
+zpty -w shtab_bench "source ./latency.zsh; print @rea''dy"
+zpty -r shtab_bench out '*@ready*'
+line_index=0
+for line in "$@"; do
+  for ((i = 0; i < repeat; i++)); do
+    zpty -w shtab_bench "$line"$'\\t\\x15'"print @do''ne" # TAB, ^U (kill-whole-line)
+    zpty -r shtab_bench out '*@done*'
+  done
+  zpty -w shtab_bench 'print -r -- $_shtab_bench_times > times; _shtab_bench_times=()'
+  zpty -w shtab_bench "print @do''ne"
+  zpty -r shtab_bench out '*@done*'
+  echo "@line $line_index $(<times)"
+  (( line_index += 1 ))
+done
+zpty -d shtab_bench
+"""
+# sourced by the interactive shell driven by `_ZSH_LATENCY`
+_ZSH_LATENCY_SETUP = """\
+bindkey -e
+unsetopt beep list_beep auto_list auto_menu
+zmodload zsh/datetime
+autoload -Uz compinit && compinit -u -D
+eval "$(<completion.zsh)"
+functions[_shtab_bench_orig]=$functions[${function}]
+_shtab_bench_times=()
+${function}() {
+  local start=$EPOCHREALTIME
+  _shtab_bench_orig "$@"
+  local ret=$?
+  _shtab_bench_times+=($(( int((EPOCHREALTIME - start) * 1000000) )))
+  return ret
+}
+"""
+
+
+def measure_latency(parser, shell: str = "bash", lines: Opt[List[str]] = None, repeat: int = 100,
+                    root_prefix: Opt[str] = None, preamble="", executable: Opt[str] = None,
+                    layout: Opt[str] = None) -> Dict[str, Any]:
+    """
+    Generate & source a completion script in a non-interactive `shell`, then
+    time the completion function for each of the command `lines` (the last
+    word of each line being completed; see `default_lines`).
+
+    Returns:
+      source  : seconds taken to source the script
+      memory  : shell resident memory increase (bytes) due to sourcing
+        (`None` if unavailable)
+      lines  : `{line: {"p50": seconds, "p99": seconds}}` per-keypress latency
+        (zsh: of the completion function called by `compsys`, in an
+        interactive shell on a pseudo-terminal)
+    """
+    if shell not in ("bash", "zsh"):
+        raise NotImplementedError(f"shell ({shell}) must be in bash,zsh")
+    command = build_model(parser)
+    if lines is None:
+        lines = default_lines(command)
+    function = wordify(f"_shtab_{root_prefix or command.name}")
+    driver = (_BASH_LATENCY if shell == "bash" else _ZSH_LATENCY).replace("${function}", function)
+    with tempfile.TemporaryDirectory() as tmp:
+        script = Path(tmp) / f"completion.{shell}"
+        script.write_text(
+            complete(command, shell=shell, root_prefix=root_prefix, preamble=preamble,
+                     layout=layout))
+        if shell == "zsh":
+            (Path(tmp) / "latency.zsh").write_text(
+                _ZSH_LATENCY_SETUP.replace("${function}", function))
+        argv = [executable or shell, "-c", driver, executable or shell, str(script), str(repeat)]
+        out = subprocess.run(argv + lines, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             cwd=tmp, check=True, universal_newlines=True).stdout
+
+    res: Dict[str, Any] = {"source": None, "memory": None, "lines": {}}
+    for row in out.splitlines():
+        key, *values = row.split()
+        if key == "@source":
+            res["source"] = int(values[0]) / 1e6
+        elif key == "@rss":
+            before, after = map(int, values)
+            if before and after:
+                res["memory"] = (after-before) * 1024
+        elif key == "@line":
+            times = [int(i) / 1e6 for i in values[1:]]
+            if not times:
+                log.warning("not completed:%r", lines[int(values[0])])
+                continue
+            res["lines"][lines[int(values[0])]] = {
+                "p50": percentile(times, 50), "p99": percentile(times, 99)}
+    return res
+
+
+def format_latency(results) -> str:
+    memory = results["memory"]
+    lines = [
+        f"source: {results['source'] * 1e3:.2f} ms",
+        f"memory: {'unknown' if memory is None else f'{memory / 2**10:.0f} KiB'} (resident)"]
+    if results["lines"]:
+        width = max(map(len, map(repr, results["lines"])))
+        lines.append(f"{'command line':<{width}} {'p50/ms':>8} {'p99/ms':>8}")
+        for line, latency in results["lines"].items():
+            lines.append(f"{line!r:<{width}} {latency['p50'] * 1e3:>8.3f}"
+                         f" {latency['p99'] * 1e3:>8.3f}")
+    return "\n".join(lines)
+
+
+def get_main_parser():
+    parser = argparse.ArgumentParser(prog="python -m shtab.bench",
+                                     description="benchmark completion script generation")
+    parser.add_argument("-s", "--shell", action="append", choices=SUPPORTED_SHELLS,
+                        help="shell(s) to benchmark (default: all)")
+    parser.add_argument("-p", "--parser", action="append", choices=list(SUITE),
+                        help="parser(s) to benchmark (default: all)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="timing repeats (best of)")
+    parser.add_argument("-l", "--layout", help="script structure (see `shtab.SUPPORTED_LAYOUTS`)")
+    parser.add_argument("--save", help="save results to JSON file")
+    parser.add_argument("--baseline", help="compare against results saved by `--save`")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fractional regression allowed w.r.t. `--baseline`")
+    return parser
+
+
+def main(argv=None):
+    args = get_main_parser().parse_args(argv)
+    suite = {k: SUITE[k] for k in args.parser} if args.parser else SUITE
+    results = run(suite, shells=args.shell, repeat=args.repeat, layout=args.layout)
+    print(format_results(results))
+    if args.save:
+        with open(args.save, "w") as fd:
+            json.dump(results, fd, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fd:
+            regressions = compare(results, json.load(fd), tolerance=args.tolerance)
+        for regression in regressions:
+            print("regression:", regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,1107 @@
+"""
+Parser model, transforms & backend registry shared by all shells (loaded on
+first use by `shtab.__getattr__`)
+"""
+import logging
+import math
+import os
+import re
+import sys
+import time
+from argparse import (
+    REMAINDER,
+    SUPPRESS,
+    ArgumentParser,
+    _AppendAction,
+    _AppendConstAction,
+    _CountAction,
+    _HelpAction,
+    _StoreConstAction,
+    _VersionAction,
+)
+from bisect import bisect_left
+from copy import copy
+from fnmatch import fnmatchcase
+from functools import wraps
+from hashlib import sha256
+from importlib import import_module
+from operator import is_not
+from shlex import quote
+from string import Template
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+from typing import Optional as Opt
+from typing import Tuple, Type, TypeVar, Union
+from weakref import WeakKeyDictionary
+
+from . import (
+    CHOICE_FUNCTIONS,
+    SHELL_BACKENDS,
+    SUPPORTED_SHELLS,
+    Choice,
+    FileMatching,
+    LazyParser,
+    _ShtabPrintCompletionAction,
+)
+
+log = logging.getLogger(__name__)
+T = TypeVar("T", bound=dict) # `.complete` value types (see `get_complete_values`)
+
+_SUPPORTED_COMPLETERS: Dict[str, Callable[..., str]] = {}
+# optional streaming versions of `_SUPPORTED_COMPLETERS`
+_SUPPORTED_ITER_COMPLETERS: Dict[str, Callable[..., Iterator[str]]] = {}
+# optional `complete(..., stats=True)` size breakdowns
+_SUPPORTED_BREAKDOWNS: Dict[str, Callable[..., Dict[str, Dict[str, int]]]] = {}
+# `timed` phases (during `complete(..., stats=True)`)
+_phase_times: Opt[Dict[str, float]] = None
+# default `externalize_choices` threshold
+CHOICES_THRESHOLD = 1000
+# bash `choices` longer than this are binary searched
+INDEX_THRESHOLD = 256
+# public helpers of the builtin backends, re-exported (lazily) as `shtab.<name>`
+BACKEND_EXPORTS = {
+    "get_bash_commands": "bash", "get_bash_assoc": "bash", "complete_bash": "bash",
+    "complete_bash_split": "bash", "escape_zsh": "zsh", "complete_zsh": "zsh",
+    "complete_zsh_split": "zsh", "complete_tcsh": "tcsh"}
+# script structure variants (first is the default)
+SUPPORTED_LAYOUTS = {"bash": ("default", "table", "assoc"), "zsh": ("default", "flat")}
+FLAG_OPTION = (
+    _StoreConstAction,
+    _HelpAction,
+    _VersionAction,
+    _AppendConstAction,
+    _CountAction,
+)
+OPTION_END = _HelpAction, _VersionAction, _ShtabPrintCompletionAction
+OPTION_MULTI = _AppendAction, _AppendConstAction, _CountAction
+
+
+def mark_completer(shell):
+    def wrapper(func):
+        if shell not in SHELL_BACKENDS:
+            SHELL_BACKENDS[shell] = f"{func.__module__}:{func.__qualname__}"
+            SUPPORTED_SHELLS.append(shell)
+        _SUPPORTED_COMPLETERS[shell] = func
+        return func
+
+    return wrapper
+
+
+def mark_iter_completer(shell):
+    """Register a streaming (chunk-yielding) version of `shell`'s completer"""
+    def wrapper(func):
+        _SUPPORTED_ITER_COMPLETERS[shell] = func
+        return func
+
+    return wrapper
+
+
+def mark_breakdown(shell):
+    """
+    Register a function returning the size breakdown of `shell`'s scripts
+    (see `complete(..., stats=True)`)
+    """
+    def wrapper(func):
+        _SUPPORTED_BREAKDOWNS[shell] = func
+        return func
+
+    return wrapper
+
+
+def timed(phase: str):
+    """
+    Decorator adding the time spent in the function to `phase` while
+    `complete(..., stats=True)` is running
+    """
+    def wrapper(func):
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            times = _phase_times
+            if times is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                times[phase] += time.perf_counter() - start
+
+        return timed_func
+
+    return wrapper
+
+
+# `shlex.quote` (timed as "escape")
+shell_quote = timed("escape")(quote)
+
+
+def get_completer(shell: str):
+    """Returns `shell`'s completer, importing its backend (`SHELL_BACKENDS`) if needed"""
+    if shell not in _SUPPORTED_COMPLETERS and shell in SUPPORTED_SHELLS:
+        load_backend(shell)
+    try:
+        return _SUPPORTED_COMPLETERS[shell]
+    except KeyError:
+        supported = ",".join(SUPPORTED_SHELLS)
+        raise NotImplementedError(f"shell ({shell}) must be in {supported}")
+
+
+def load_backend(shell: str) -> None:
+    """
+    Import `SHELL_BACKENDS[shell]`: a module (which registers its completer
+    using `mark_completer`) or "module:completer" (registered here).
+    """
+    module, _, qualname = SHELL_BACKENDS[shell].partition(":")
+    log.debug("backend:%s:%s", shell, SHELL_BACKENDS[shell])
+    obj: Any = import_module(module)
+    if qualname:
+        for name in qualname.split("."):
+            obj = getattr(obj, name)
+        _SUPPORTED_COMPLETERS.setdefault(shell, obj)
+
+
+def get_layout(shell: str, layout: Opt[str] = None) -> str:
+    """Returns `layout` (default: "default") if supported by `shell`"""
+    layouts = SUPPORTED_LAYOUTS.get(shell, ("default",))
+    if layout is None:
+        return layouts[0]
+    if layout not in layouts:
+        supported = ",".join(layouts)
+        raise NotImplementedError(f"{shell} layout ({layout}) must be in {supported}")
+    return layout
+
+
+class Cached(dict):
+    """
+    `.complete` value caching another `.complete` value's results (see
+    `cached`). Maps each shell to a generated wrapper function.
+    """
+    def __init__(self, complete: Dict[str, str], ttl: float = 60) -> None:
+        if not ttl > 0:
+            raise ValueError(f"cached: ttl ({ttl}) must be positive")
+        self.complete = complete
+        # whole seconds (shell arithmetic & glob qualifiers)
+        self.ttl = math.ceil(ttl)
+        super().__init__()
+        for shell, fn in complete.items():
+            if shell in ("bash", "zsh") and fn:
+                suffix = "_compreply" if shell == "bash" else ""
+                self[shell] = f"_shtab_cached_{self.ttl}_{wordify(fn)}{suffix}"
+            else:
+                self[shell] = fn
+
+
+def cached(complete: Dict[str, str], ttl: float = 60) -> Cached:
+    """
+    Cache the results of (slow) custom completions for `ttl` seconds, e.g.:
+
+    >>> parser.add_argument(...).complete = shtab.cached(
+    ...     {"bash": "_myprog_branches", "zsh": "_myprog_branches"}, ttl=60)
+
+    Results are stored under `$XDG_CACHE_HOME/shtab/<prog>/`, keyed by the
+    completion function and the word being completed. Expired results are
+    still used, while being refreshed in the background. Empty results are
+    also cached.
+
+    complete:
+      `{shell: function}` (like any `.complete` value).
+      bash functions either print completions or (if named `*_compreply`)
+      append to `COMPREPLY`.
+      zsh functions (unlike uncached zsh actions) must print completions
+      (one per line) given the word being completed as `$1`.
+      Other shells' (e.g. tcsh) values are used as-is (uncached).
+    ttl:
+      seconds before results are refreshed (rounded up to whole seconds)
+    """
+    return Cached(complete, ttl)
+
+
+class Served(dict):
+    """
+    `.complete` value for a Python callable (`.complete = callable`), whose
+    results are computed by the `shtab.serve` daemon. Maps each shell to a
+    generated client function.
+    """
+    def __init__(self, func: Opt[Callable[[str], Iterable[str]]] = None,
+                 key: Opt[str] = None) -> None:
+        """`key` (see `serve.get_key`) may be given instead of `func` (imported when called)"""
+        from .serve import get_key
+
+        super().__init__()
+        if func is None:
+
+            def func(prefix):
+                from .serve import resolve
+
+                return resolve(key)(prefix)
+
+        self.func = func
+        self.key: Opt[str]
+        try:
+            self.key = key or get_key(func)
+        except ValueError:
+            self.key = None # only usable by `resolve`
+        else:
+            name = f"_shtab_serve_{wordify(self.key)}"
+            self.update(bash=f"{name}_compreply", zsh=name)
+
+
+def get_cached(command: "Command") -> List[Cached]:
+    """Returns unique `Cached` `.complete` values used by `command` & its subcommands"""
+    return get_complete_values(command, Cached)
+
+
+def get_served(command: "Command") -> List[Served]:
+    """
+    Returns unique `Served` `.complete` values used by `command` & its
+    subcommands, raising `ValueError` for unimportable callables.
+    """
+    served = get_complete_values(command, Served)
+    for complete in served:
+        if complete.key is None:
+            from .serve import get_key
+
+            get_key(complete.func)
+    return served
+
+
+class ChoicesFile(dict):
+    """
+    `.complete` value loading `choices` from a newline-delimited file `path`
+    (see `externalize_choices`). Maps each shell to a generated loader.
+    """
+    def __init__(self, path: str, choices: tuple) -> None:
+        self.path = path
+        self.choices = choices
+        name = f"_shtab_choices_{sha256(path.encode()).hexdigest()[:16]}"
+        super().__init__(bash=f"{name}_compreply", zsh=name, tcsh=f"`cat {quote(path)}`")
+
+
+def get_choices_files(command: "Command") -> List[ChoicesFile]:
+    """Returns unique `ChoicesFile` `.complete` values used by `command` & its subcommands"""
+    return get_complete_values(command, ChoicesFile)
+
+
+def externalize_choices(parser: Union[ArgumentParser, "Command"], directory: str,
+                        threshold: int = CHOICES_THRESHOLD) -> Tuple["Command", Dict[str, str]]:
+    """
+    Move `choices` (longer than `threshold`) to newline-delimited files, shared
+    by all shells & loaded only when completing the corresponding argument.
+
+    directory  : where the files will be installed (used as-is in scripts)
+
+    Returns:
+      command  : `Command` to pass to `complete` (in place of `parser`)
+      files  : `{filename: content}` to write to `directory`
+    """
+    files: Dict[str, str] = {}
+
+    def copy_argument(arg):
+        if not is_plain_choices(arg, threshold):
+            return arg
+        # sorted for binary search (see `_shtab_sorted_compreply`)
+        content = "".join(f"{choice}\n" for choice in sorted(arg.choices))
+        filename = f"{sha256(content.encode()).hexdigest()[:16]}.choices"
+        files[filename] = content
+        log.debug("choices:%s:%s", arg.dest, filename)
+        arg = copy(arg)
+        arg.complete = ChoicesFile(f"{directory.rstrip('/')}/{filename}", arg.choices)
+        arg.choices = None
+        return arg
+
+    return map_arguments(parser, copy_argument), files
+
+
+class SortedChoices(dict):
+    """
+    bash `.complete` value matching (long) `choices` using binary search
+    (see `index_choices`).
+    """
+    def __init__(self, choices: tuple) -> None:
+        self.choices = tuple(sorted(choices))
+        name = f"_shtab_sorted_{sha256(repr(self.choices).encode()).hexdigest()[:16]}"
+        super().__init__(bash=f"{name}_compreply")
+
+
+def index_choices(parser: Union[ArgumentParser, "Command"],
+                  threshold: int = INDEX_THRESHOLD) -> "Command":
+    """
+    Returns a model (for bash scripts) in which `choices` longer than
+    `threshold` are replaced by `SortedChoices`.
+    """
+    def copy_argument(arg):
+        if not is_plain_choices(arg, threshold):
+            return arg
+        arg = copy(arg)
+        arg.complete = SortedChoices(arg.choices)
+        arg.choices = None
+        return arg
+
+    return map_arguments(parser, copy_argument)
+
+
+def get_sorted_choices(command: "Command") -> List[SortedChoices]:
+    """Returns unique `SortedChoices` `.complete` values used by `command` & its subcommands"""
+    return get_complete_values(command, SortedChoices)
+
+
+def is_plain_choices(arg: "Argument", threshold: int) -> bool:
+    """Whether `arg` only completes (more than `threshold`) `choices`"""
+    return not (arg.subcommands or arg.complete is not None or arg.choice_type is not None
+                or not arg.choices or len(arg.choices) <= threshold)
+
+
+def map_arguments(parser: Union[ArgumentParser, "Command"],
+                  func: Callable[["Argument"], "Argument"]) -> "Command":
+    """
+    Returns `build_model(parser)`, replacing each `Argument` with
+    `func(Argument)`. Only (sub)commands which change are copied.
+    """
+    mapped: Dict[int, Command] = {}
+
+    def map_command(command):
+        # aliases share a `Command`
+        if id(command) in mapped:
+            return mapped[id(command)]
+        options = tuple(map(func, command.options))
+        positionals = tuple(map(func, command.positionals))
+        commands = {name: map_command(sub) for name, sub in command.commands.items()}
+        if (any(map(is_not, options, command.options))
+                or any(map(is_not, positionals, command.positionals))
+                or any(commands[name] is not sub for name, sub in command.commands.items())):
+            res = Command(command.name, command.help, options, positionals)
+            res.commands = commands
+        else:
+            res = command
+        mapped[id(command)] = res
+        return res
+
+    root = map_command(build_model(parser))
+    mapped.clear() # free now rather than when the gc breaks the `map_command` cycle
+    return root
+
+
+def limit_completions(parser: Union[ArgumentParser, "Command"], limit: Opt[int] = None,
+                      min_prefix: Opt[int] = None) -> "Command":
+    """
+    Returns a model (to pass to `complete` in place of `parser`) with default
+    `limit` & `min_prefix` for arguments without their own
+    `.complete_limit`/`.complete_min_prefix`.
+    """
+    def copy_argument(arg):
+        arg = copy(arg)
+        if arg.limit is None:
+            arg.limit = limit
+        if arg.min_prefix is None:
+            arg.min_prefix = min_prefix
+        return arg
+
+    return map_arguments(parser, copy_argument)
+
+
+class Limited(dict):
+    """
+    bash & zsh `.complete` value producing at most `limit` candidates, and
+    none for words shorter than `min_prefix` (see `apply_limits`). Wraps an
+    argument's `choices` and/or `.complete`/`choice_type` shell function.
+    """
+    def __init__(self, limit: Opt[int], min_prefix: Opt[int], choices: tuple = (),
+                 complete: Opt[Dict[str, str]] = None) -> None:
+        self.limit = limit
+        self.min_prefix = min_prefix or 0
+        self.choices = tuple(sorted(choices))
+        self.complete = complete or {}
+        key = limit, self.min_prefix, self.choices, sorted(self.complete.items())
+        name = "_shtab_limited_" + sha256(repr(key).encode()).hexdigest()[:16]
+        super().__init__(bash=f"{name}_compreply", zsh=name)
+
+
+def apply_limits(parser: Union[ArgumentParser, "Command"]) -> "Command":
+    """Returns a model of `parser`, wrapping limited arguments' completions in `Limited`"""
+    def copy_argument(arg):
+        if (arg.limit is None and not arg.min_prefix) or arg.subcommands or arg.flag:
+            return arg
+        complete = arg.complete
+        if arg.choice_type is not None:
+            if arg.choice_type not in CHOICE_FUNCTIONS:
+                return arg # custom `choice_functions` are unknown here
+            complete = CHOICE_FUNCTIONS[arg.choice_type]
+        elif isinstance(complete, str):
+            complete = CHOICE_FUNCTIONS.get(complete)
+        if not (arg.choices or complete):
+            return arg
+        arg = copy(arg)
+        arg.complete = Limited(arg.limit, arg.min_prefix, arg.choices or (), complete)
+        arg.choices = arg.choice_type = None
+        return arg
+
+    return map_arguments(parser, copy_argument)
+
+
+def get_limited(command: "Command") -> List[Limited]:
+    """Returns unique `Limited` `.complete` values used by `command` & its subcommands"""
+    return get_complete_values(command, Limited)
+
+
+def get_file_matching(command: "Command") -> List[FileMatching]:
+    """Returns unique `FileMatching` `.complete` values used by `command` & its subcommands"""
+    return get_complete_values(command, FileMatching)
+
+
+def get_complete_values(command: "Command", cls: Type[T]) -> List[T]:
+    """
+    Returns unique `cls` `.complete` values used by `command` & its
+    subcommands (including those wrapped by e.g. `Cached` & `Limited`)
+    """
+    res: Dict[tuple, T] = {}
+    seen = set()
+    pending = [command]
+    while pending:
+        command = pending.pop()
+        if id(command) in seen:
+            continue
+        seen.add(id(command))
+        for arg in command.options + command.positionals:
+            complete = arg.complete
+            while isinstance(complete, dict):
+                if isinstance(complete, cls):
+                    res.setdefault(tuple(sorted(complete.items())), complete)
+                complete = getattr(complete, "complete", None)
+        pending.extend(command.commands.values())
+    return list(res.values())
+
+
+def complete2pattern(opt_complete, shell: str, choice_type2fn) -> str:
+    return (opt_complete.get(shell, "")
+            if isinstance(opt_complete, dict) else choice_type2fn[opt_complete])
+
+
+def iter_template(template: str, **mapping) -> Iterator[str]:
+    """
+    Lazy `Template(template).safe_substitute(**mapping)`, yielding chunks.
+    `mapping` values may be strings or iterables of strings (yielded in turn).
+    """
+    start = 0
+    for match in Template.pattern.finditer(template):
+        name = match.group("named") or match.group("braced")
+        if match.group("escaped") is None and name not in mapping:
+            continue # invalid or unknown: left as-is (like `safe_substitute`)
+        if start < match.start():
+            yield template[start:match.start()]
+        start = match.end()
+        if name is None:
+            yield Template.delimiter
+        elif isinstance(mapping[name], str):
+            yield mapping[name]
+        else:
+            yield from mapping[name]
+    if start < len(template):
+        yield template[start:]
+
+
+def iter_joined(strings: Iterable[str], sep: str = "\n") -> Iterator[str]:
+    """Lazy `sep.join(strings)`"""
+    for i, string in enumerate(strings):
+        if i:
+            yield sep
+        yield string
+
+
+def wordify(string: str) -> str:
+    """Replace non-word chars [\\W] with underscores [_]"""
+    return re.sub("\\W", "_", string)
+
+
+def get_public_subcommands(sub):
+    """Get all the publicly-visible subcommands for a given subparser."""
+    public_parsers = {id(sub.choices[i.dest]) for i in sub._get_subactions()}
+    return {k for k, v in sub.choices.items() if id(v) in public_parsers}
+
+
+class Argument:
+    """
+    Completion-relevant information about a (non-suppressed) `argparse.Action`.
+
+    dest  : destination name
+    option_strings  : tuple of option strings (empty for positionals)
+    nargs  : `argparse` number of args
+    help  : expanded help text ("" if none)
+    choices  : tuple of (non-`Choice`) choices, or `None`
+    choice_type  : `Choice.type` of the first `Choice` in `choices`, or `None`
+    complete  : shtab `.complete` attribute, or `None`
+    index  : position amongst all of the parser's positionals (`None` for optionals)
+    flag  : takes no arguments
+    end  : no further arguments are parsed (e.g. `--help`, `nargs=REMAINDER`)
+    multi  : may be repeated (e.g. `action="append"`)
+    subcommands  : is a subparsers action (see `Command.commands`)
+    limit  : shtab `.complete_limit` attribute (maximum number of candidates), or `None`
+    min_prefix  : shtab `.complete_min_prefix` attribute (minimum length of the
+      word being completed before any candidates are produced), or `None`
+    """
+    __slots__ = ("dest", "option_strings", "nargs", "help", "choices", "choice_type", "complete",
+                 "index", "flag", "end", "multi", "subcommands", "limit", "min_prefix")
+
+    def __init__(self, dest: str, option_strings=(), nargs=None, help: str = "", choices=None,
+                 choice_type: Opt[str] = None, complete=None, index: Opt[int] = None,
+                 flag: bool = False, end: bool = False, multi: bool = False,
+                 subcommands: bool = False, limit: Opt[int] = None,
+                 min_prefix: Opt[int] = None) -> None:
+        self.dest = dest
+        self.option_strings = option_strings
+        self.nargs = nargs
+        self.help = help
+        self.choices = choices
+        self.choice_type = choice_type
+        self.complete = complete
+        self.index = index
+        self.flag = flag
+        self.end = end
+        self.multi = multi
+        self.subcommands = subcommands
+        self.limit = limit
+        self.min_prefix = min_prefix
+
+    def __repr__(self) -> str:
+        return f"Argument({self.dest!r}, {self.option_strings!r})"
+
+
+class Command:
+    """
+    Completion-relevant information about an `ArgumentParser`.
+
+    name  : program or subcommand name
+    help  : first line of the description ("" if none)
+    options  : tuple of optional `Argument`s
+    positionals  : tuple of positional `Argument`s
+    commands  : `{name: Command}` of public subcommands (including aliases,
+      which share the same `Command`)
+    """
+    __slots__ = ("name", "help", "options", "positionals", "commands", "__weakref__")
+
+    def __init__(self, name: str, help: str = "", options=(), positionals=(),
+                 commands: Opt[Dict[str, "Command"]] = None) -> None:
+        self.name = name
+        self.help = help
+        self.options = options
+        self.positionals = positionals
+        self.commands = commands or {}
+
+    def __repr__(self) -> str:
+        return f"Command({self.name!r}, commands={list(self.commands)!r})"
+
+
+@timed("help")
+def format_help(formatter, action) -> str:
+    """Returns the expanded help text of `action` ("" if none)"""
+    return formatter._expand_help(action) if action.help else ""
+
+
+@timed("help")
+def format_description(formatter, parser) -> str:
+    """Returns the first line of `parser`'s description ("" if none)"""
+    formatter._width = 1234567 # large number to effectively disable wrapping
+    return formatter._format_text(parser.description or "").strip().split("\n")[0]
+
+
+def build_model(parser: Union[ArgumentParser, Command]) -> Command:
+    """
+    Walk `parser` (and its subparsers) once, returning the root `Command`.
+
+    The result may be passed to any `complete_<shell>` function (or `complete`)
+    in place of `parser` to avoid re-walking the tree for each shell.
+    If `parser` is already a `Command`, it is returned as-is.
+    """
+    if isinstance(parser, Command):
+        return parser
+    intern = sys.intern
+    built: Dict[int, Command] = {} # id(parser) -> Command (shared by aliases)
+
+    def build_argument(action, formatter, index=None):
+        complete = getattr(action, "complete", None)
+        if callable(complete):
+            complete = Served(complete)
+        choices = choice_type = None
+        if action.choices and not isinstance(action.choices, dict):
+            choices = []
+            for choice in action.choices:
+                if isinstance(choice, Choice):
+                    choice_type = choice_type or choice.type
+                else:
+                    choices.append(intern(str(choice)))
+            choices = tuple(choices)
+        option_strings = tuple(map(intern, action.option_strings))
+        end = isinstance(action, OPTION_END) or action.nargs == REMAINDER
+        return Argument(intern(action.dest), option_strings, action.nargs,
+                        format_help(formatter, action), choices, choice_type, complete, index,
+                        isinstance(action, FLAG_OPTION), end, isinstance(action, OPTION_MULTI),
+                        limit=getattr(action, "complete_limit", None),
+                        min_prefix=getattr(action, "complete_min_prefix", None))
+
+    def build(parser, name):
+        formatter = parser._get_formatter()
+        options = []
+        positionals = []
+        commands = {}
+        index = 0
+        for action in parser._actions:
+            if action.option_strings:
+                if action.help != SUPPRESS:
+                    options.append(build_argument(action, formatter))
+                continue
+            if action.help != SUPPRESS:
+                positional = build_argument(action, formatter, index)
+                if isinstance(action.choices, dict):
+                    positional.subcommands = True
+                    public_cmds = get_public_subcommands(action)
+                    public_choices = []
+                    for cmd, subparser in action.choices.items():
+                        if cmd not in public_cmds:
+                            log.debug("skip:subcommand:%s", cmd)
+                            continue
+                        cmd = intern(cmd)
+                        public_choices.append(cmd)
+                        try:
+                            commands[cmd] = built[id(subparser)]
+                        except KeyError:
+                            if (isinstance(subparser, LazyParser) and subparser.parser is None
+                                    and subparser.spec is not None):
+                                log.debug("spec:subcommand:%s", cmd)
+                                command = model_from_spec(subparser.spec, cmd)
+                            else:
+                                command = build(subparser, cmd)
+                            commands[cmd] = built[id(subparser)] = command
+                    positional.choices = tuple(public_choices)
+                positionals.append(positional)
+            index += 1
+
+        return Command(name, format_description(formatter, parser), tuple(options),
+                       tuple(positionals), commands)
+
+    return build(parser, parser.prog)
+
+
+def model_from_spec(spec: Union[Dict[str, Any], Command], name: Opt[str] = None) -> Command:
+    """
+    Returns the `Command` described by `spec` (e.g. a `LazyParser.spec`):
+
+    >>> {"name": "prog", "help": "description", "options": [{
+    ...     "option_strings": ["-o", "--output"], "complete": shtab.FILE}],
+    ...  "positionals": [{"dest": "level", "choices": ["debug", "info"]}],
+    ...  "commands": {"sub": {"help": ...}, "alias": "sub"}}
+
+    Each option & positional maps `Argument` attributes to values (only
+    `dest`, which defaults to the last option string without leading
+    dashes, & `option_strings` are required). A `str` command is an alias of
+    another. Unless `positionals` includes one with `"subcommands": true`,
+    a `command` positional listing `commands` is appended.
+    `name` overrides `spec["name"]`.
+    """
+    if isinstance(spec, Command):
+        return spec
+    unknown = set(spec) - {"name", "help", "options", "positionals", "commands"}
+    if unknown:
+        raise ValueError(f"unknown spec keys: {sorted(unknown)}")
+    intern = sys.intern
+
+    def build_argument(arg, index=None):
+        arg = dict(arg)
+        option_strings = tuple(map(intern, arg.pop("option_strings", ())))
+        if "dest" not in arg:
+            if not option_strings:
+                raise ValueError(f"positional without dest: {arg!r}")
+            arg["dest"] = option_strings[-1].lstrip("-").replace("-", "_")
+        if arg.get("choices") is not None:
+            arg["choices"] = tuple(map(intern, map(str, arg["choices"])))
+        if arg.get("complete") is not None:
+            arg["complete"] = complete_from_spec(arg["complete"])
+        arg.setdefault("index", index)
+        return Argument(option_strings=option_strings, **arg)
+
+    subspecs = spec.get("commands") or {}
+    built = {
+        cmd: model_from_spec(sub, cmd)
+        for cmd, sub in subspecs.items() if not isinstance(sub, str)}
+    commands = {
+        intern(cmd): built[sub if isinstance(sub, str) else cmd]
+        for cmd, sub in subspecs.items()}
+    options = tuple(map(build_argument, spec.get("options") or ()))
+    positionals = [
+        build_argument(arg, index) for index, arg in enumerate(spec.get("positionals") or ())]
+    if commands and not any(arg.subcommands for arg in positionals):
+        positionals.append(Argument("command", index=len(positionals), subcommands=True))
+    for arg in positionals:
+        if arg.subcommands:
+            arg.choices = tuple(commands)
+    return Command(name or spec.get("name", ""), spec.get("help", ""), options, tuple(positionals),
+                   commands)
+
+
+def model_to_spec(command: Union[ArgumentParser, Command]) -> Dict[str, Any]:
+    """
+    Returns the JSON-serialisable spec of `command` (or `build_model(parser)`),
+    the inverse of `model_from_spec`. Only non-default `Argument` attributes
+    are included, while aliases refer to the first name of their command.
+    """
+    command = build_model(command)
+    default = Argument("")
+
+    def get_argument(arg, position=None):
+        res = {"dest": arg.dest}
+        # (subcommand `choices` are implied by `commands`)
+        for key in Argument.__slots__[1:]:
+            value = getattr(arg, key)
+            if key == "index":
+                if value != position:
+                    res[key] = value
+            elif key == "choices" and arg.subcommands:
+                continue
+            elif value != getattr(default, key):
+                res[key] = complete_to_spec(value) if key == "complete" else (
+                    list(value) if isinstance(value, tuple) else value)
+        return res
+
+    def get_spec(command, root=False):
+        spec = {"name": command.name} if root else {}
+        if command.help:
+            spec["help"] = command.help
+        if command.options:
+            spec["options"] = list(map(get_argument, command.options))
+        if command.positionals:
+            spec["positionals"] = [
+                get_argument(arg, position) for position, arg in enumerate(command.positionals)]
+        if command.commands:
+            spec["commands"] = commands = {}
+            names = {} # id(sub) -> first name
+            for cmd, sub in command.commands.items():
+                if id(sub) in names:
+                    commands[cmd] = names[id(sub)]
+                else:
+                    names[id(sub)] = cmd
+                    commands[cmd] = get_spec(sub)
+        return spec
+
+    return get_spec(command, root=True)
+
+
+def complete_to_spec(complete: Any) -> Any:
+    """
+    Returns the JSON-serialisable form of a `.complete` value: strings &
+    `{shell: function}` mappings as-is, and shtab's own `.complete` types as
+    `{"type": name, ...attributes}`
+    """
+    if isinstance(complete, FileMatching):
+        return {"type": "FileMatching", "patterns": list(complete.patterns), "dirs": complete.dirs}
+    if isinstance(complete, Cached):
+        return {
+            "type": "Cached", "complete": complete_to_spec(complete.complete), "ttl": complete.ttl}
+    if isinstance(complete, Served):
+        # unimportable callables: raise `get_key`'s `ValueError`
+        if complete.key is None:
+            from .serve import get_key
+
+            get_key(complete.func)
+        return {"type": "Served", "key": complete.key}
+    if isinstance(complete, ChoicesFile):
+        return {"type": "ChoicesFile", "path": complete.path, "choices": list(complete.choices)}
+    if isinstance(complete, SortedChoices):
+        return {"type": "SortedChoices", "choices": list(complete.choices)}
+    if isinstance(complete, Limited):
+        return {
+            "type": "Limited", "limit": complete.limit, "min_prefix": complete.min_prefix,
+            "choices": list(complete.choices), "complete": complete_to_spec(complete.complete)}
+    if isinstance(complete, (str, dict)):
+        return complete if isinstance(complete, str) else dict(complete)
+    raise ValueError(f"cannot serialise .complete value: {complete!r}")
+
+
+def complete_from_spec(complete: Any) -> Any:
+    """Inverse of `complete_to_spec` (Python callables are also accepted)"""
+    if callable(complete):
+        return Served(complete)
+    if not isinstance(complete, dict) or "type" not in complete:
+        return complete
+    kwargs = dict(complete)
+    kind = kwargs.pop("type")
+    if kind == "FileMatching":
+        return FileMatching(*kwargs["patterns"], dirs=kwargs.get("dirs", True))
+    if kind == "Cached":
+        return Cached(complete_from_spec(kwargs["complete"]), kwargs.get("ttl", 60))
+    if kind == "Served":
+        return Served(key=kwargs["key"])
+    if kind == "ChoicesFile":
+        return ChoicesFile(kwargs["path"], tuple(kwargs["choices"]))
+    if kind == "SortedChoices":
+        return SortedChoices(tuple(kwargs["choices"]))
+    if kind == "Limited":
+        return Limited(kwargs["limit"], kwargs["min_prefix"], tuple(kwargs["choices"]),
+                       complete_from_spec(kwargs["complete"]))
+    raise ValueError(f"unknown .complete type: {kind}")
+
+
+class Resolver:
+    """
+    `resolve` lookup tables for a `Command`.
+
+    commands  : `{name: Resolver}` of subcommands
+    options  : `{option_string: action}`
+    option_strings  : sorted option strings
+    positionals  : `{index: action}`
+    (where each action is a `(nargs, sorted_choices, Argument)` tuple)
+    """
+    __slots__ = ("commands", "options", "option_strings", "positionals")
+
+    def __init__(self, command: Command, built: Opt[Dict[int, "Resolver"]] = None) -> None:
+        built = {} if built is None else built
+        built[id(command)] = self
+        self.options = {
+            option_string: self.get_action(opt, False)
+            for opt in command.options
+            for option_string in opt.option_strings}
+        self.option_strings = tuple(sorted(self.options))
+        self.positionals = {pos.index: self.get_action(pos, True) for pos in command.positionals}
+        self.commands = {
+            name: built.get(id(sub)) or Resolver(sub, built)
+            for name, sub in command.commands.items()}
+
+    @staticmethod
+    def get_action(arg: Argument, positional: bool) -> tuple:
+        nargs = arg.nargs
+        if nargs in ((None, "1", "?") if positional else (None, 1)):
+            nargs = 1 # bash template defaults
+        return nargs, tuple(sorted(arg.choices or ())), arg
+
+
+_RESOLVERS: "WeakKeyDictionary[Any, Resolver]" = WeakKeyDictionary()
+_RESOLVER_DEFAULT_ACTION = (1, (), None)
+_RESOLVER_FILE_FUNCTIONS = {
+    "_shtab_files_compreply": False, "_shtab_compgen_files": False, "_shtab_dirs_compreply": True,
+    "_shtab_compgen_dirs": True}
+
+
+def get_resolver(parser: Union[ArgumentParser, Command]) -> Resolver:
+    """
+    Returns the `Resolver` for `parser`, built once & cached (so `parser`
+    should not be modified afterwards).
+    """
+    try:
+        return _RESOLVERS[parser]
+    except KeyError:
+        resolver = _RESOLVERS[parser] = Resolver(build_model(parser))
+        return resolver
+
+
+def get_prefixed(strings: tuple, prefix: str) -> List[str]:
+    """Returns the `sorted` `strings` starting with `prefix` (using binary search)"""
+    if not prefix:
+        return list(strings)
+    start = bisect_left(strings, prefix)
+    if prefix[-1] == chr(sys.maxunicode):
+        return [string for string in strings[start:] if string.startswith(prefix)]
+    # strings starting with `prefix` sort before `prefix` with its last character incremented
+    return list(strings[start:bisect_left(strings, prefix[:-1] + chr(ord(prefix[-1]) + 1))])
+
+
+def get_paths(prefix: str, dirs: bool = False) -> List[str]:
+    """Returns (hidden) paths (`dirs` only) starting with `prefix`, like `_shtab_glob_compreply`"""
+    home = ""
+    path = prefix
+    if prefix.startswith("~/"):
+        home = os.path.expanduser("~")
+        path = home + prefix[1:]
+    head, tail = os.path.split(path)
+    try:
+        entries = sorted(os.scandir(head or os.curdir), key=lambda entry: entry.name)
+    except OSError:
+        return []
+    paths = [
+        os.path.join(head, entry.name) for entry in entries
+        if entry.name.startswith(tail) and (not dirs or entry.is_dir())]
+    return ["~" + path[len(home):] for path in paths] if home else paths
+
+
+def resolve(parser: Union[ArgumentParser, Command], words: List[str],
+            cword: Opt[int] = None) -> List[str]:
+    """
+    Returns completions for `words[cword]` (default: the last word), with the
+    same semantics as the (default) bash script.
+
+    parser  : `ArgumentParser` or `Command` (its lookup tables are cached,
+      see `get_resolver`)
+    words  : command line (including the program name), like `COMP_WORDS`
+    cword  : index of the word to complete, like `COMP_CWORD`
+
+    `.complete` values which are Python callables are called with the word
+    being completed, while other custom (shell) completion functions are
+    ignored (except for `shtab.FILE`, `shtab.DIRECTORY` & `FileMatching`).
+    Option strings & choices are returned in sorted order.
+    """
+    resolver = get_resolver(parser)
+    if cword is None:
+        cword = len(words) - 1
+    pos_only = 0   # "--" delimiter not encountered yet
+    completed_positionals = 0
+    action = resolver.positionals.get(0, _RESOLVER_DEFAULT_ACTION)
+    action_start, action_positional = 1, True
+    for i in range(1, cword):
+        word = words[i]
+        if not pos_only and word == "--":
+            pos_only = 1
+            continue
+        if word in resolver.commands:
+            resolver = resolver.commands[word]
+            completed_positionals = 0
+            action = resolver.positionals.get(0, _RESOLVER_DEFAULT_ACTION)
+            action_start, action_positional = i + 1 - pos_only, True
+        if word in resolver.options:
+            action = resolver.options[word]
+            action_start, action_positional = i + 1 - pos_only, False
+        nargs = action[0]
+        if isinstance(nargs, int) and i + 1 - action_start - pos_only >= nargs:
+            if action_positional:
+                completed_positionals += 1
+            action = resolver.positionals.get(completed_positionals, _RESOLVER_DEFAULT_ACTION)
+            action_start, action_positional = i + 1 - pos_only, True
+
+    word = words[cword] if cword < len(words) else ""
+    previous_word = words[cword - 1] if 0 < cword <= len(words) else ""
+    if not pos_only and word.startswith("-"):
+        return get_prefixed(resolver.option_strings, word)
+    if previous_word in (">", ">>") or previous_word[:2] in ("1>", "2>"):
+        return get_paths(word)
+    _, choices, arg = action
+    if arg is not None and arg.min_prefix and len(word) < arg.min_prefix:
+        return []
+    res = []
+    if arg is not None:
+        complete = arg.choice_type if arg.choice_type is not None else arg.complete
+        if isinstance(complete, Served):
+            candidates = map(str, complete.func(word) or ())
+            res = [candidate for candidate in candidates if candidate.startswith(word)]
+        elif isinstance(complete, (ChoicesFile, SortedChoices)):
+            res = [choice for choice in complete.choices if choice.startswith(word)]
+        elif isinstance(complete, FileMatching):
+            patterns = complete.patterns
+            res = [
+                path for path in get_paths(word)
+                if any(fnmatchcase(os.path.basename(path), pattern) for pattern in patterns)
+                or complete.dirs and os.path.isdir(os.path.expanduser(path))]
+        elif isinstance(complete, dict) and complete.get("bash") in _RESOLVER_FILE_FUNCTIONS:
+            res = get_paths(word, dirs=_RESOLVER_FILE_FUNCTIONS[complete["bash"]])
+        elif isinstance(complete, str) and complete in CHOICE_FUNCTIONS:
+            res = get_paths(word, dirs=complete == "directory")
+    res += get_prefixed(choices, word)
+    return res if arg is None or arg.limit is None else res[:arg.limit]
+
+
+def complete(parser: Union[ArgumentParser, Command], shell: str = "bash",
+             root_prefix: Opt[str] = None, preamble: Union[str, Dict[str, str]] = "",
+             choice_functions: Opt[Any] = None, layout: Opt[str] = None,
+             stats: bool = False) -> Union[str, Tuple[str, Dict[str, Any]]]:
+    """
+    parser:
+      `ArgumentParser` or (to avoid re-walking it for each shell) the result
+      of `build_model(parser)`
+    shell:
+      bash/zsh/tcsh
+    root_prefix:
+      prefix for shell functions to avoid clashes (default: "_{parser.prog}")
+    preamble:
+      mapping shell to text to prepend to generated script
+      (e.g. `{"bash": "_myprog_custom_function(){ echo hello }"}`)
+    choice_functions:
+      *deprecated*
+    layout:
+      script structure (default: "default"). See `SUPPORTED_LAYOUTS`.
+      bash also supports "table" (`bash>=4.2`): compile the parser into
+      flat arrays with an `O(1)` lookup per typed word, and "assoc"
+      (`bash>=4.2`): store data in a few associative arrays rather than
+      thousands of variables. zsh also supports "flat": resolve subcommands
+      with one lookup per word & call `_arguments` once
+    stats:
+      return `(script, stats)`, where `stats` is
+      `{"shell": shell, "layout": layout, "time": {"walk": seconds,
+      "help": seconds, "escape": seconds, "render": seconds},
+      "counts": get_counts(...), "bytes": {"total": size,
+      "sections": {section: size}, "commands": {"prog cmd": size}}}`.
+      "walk" is `build_model`'s parser traversal, "help" its help text
+      formatting, "escape" the shell quoting of strings & "render"
+      everything else (formatting & templates). "sections" & "commands"
+      (data size by top-level command, including its subcommands) are
+      reported by shells with a breakdown (bash & zsh, all layouts).
+
+    N.B. `parser.add_argument().complete = ...` can be used to define custom
+    completions (e.g. filenames). See <../examples/pathcomplete.py>.
+    """
+    if not stats:
+        return "".join(
+            iter_completion(parser, shell=shell, root_prefix=root_prefix, preamble=preamble,
+                            choice_functions=choice_functions, layout=layout))
+    global _phase_times
+    walk_times = _phase_times = {"help": 0.0, "escape": 0.0}
+    try:
+        start = time.perf_counter()
+        command = build_model(parser)
+        walked = time.perf_counter()
+        render_times = _phase_times = {"help": 0.0, "escape": 0.0}
+        script = "".join(
+            iter_completion(command, shell=shell, root_prefix=root_prefix, preamble=preamble,
+                            choice_functions=choice_functions, layout=layout))
+        rendered = time.perf_counter()
+    finally:
+        _phase_times = None
+    breakdown = _SUPPORTED_BREAKDOWNS.get(shell)
+    sizes = breakdown(command, root_prefix=root_prefix, choice_functions=choice_functions,
+                      layout=layout) if breakdown else {}
+    times = {
+        "walk": walked - start - sum(walk_times.values()),
+        "help": walk_times["help"] + render_times["help"],
+        "escape": walk_times["escape"] + render_times["escape"],
+        "render": rendered - walked - sum(render_times.values())}
+    return script, {
+        "shell": shell, "layout": get_layout(shell, layout), "time": times,
+        "counts": get_counts(command), "bytes": {"total": len(script.encode()), **sizes}}
+
+
+def get_counts(command: Command) -> Dict[str, int]:
+    """Returns the number of unique `commands`, `actions` & `choices` in `command`"""
+    commands: Dict[int, Command] = {}
+    arguments: Dict[int, Argument] = {}
+    todo = [command]
+    while todo:
+        command = todo.pop()
+        if id(command) not in commands:
+            commands[id(command)] = command
+            arguments.update((id(arg), arg) for arg in (*command.options, *command.positionals))
+            todo.extend(command.commands.values())
+    return {
+        "commands": len(commands), "actions": len(arguments),
+        "choices": sum(len(arg.choices or ()) for arg in arguments.values())}
+
+
+def iter_completion(parser: Union[ArgumentParser, Command], shell: str = "bash",
+                    root_prefix: Opt[str] = None, preamble: Union[str, Dict[str, str]] = "",
+                    choice_functions: Opt[Any] = None, layout: Opt[str] = None) -> Iterator[str]:
+    """
+    Yields the chunks of `complete(...)` in order, without building the whole
+    script in memory (for shells & layouts with a streaming completer; others
+    yield the script as a single chunk). See `complete` for arguments.
+    """
+    if isinstance(preamble, dict):
+        preamble = preamble.get(shell, "")
+    completer = get_completer(shell)
+    kwargs = {
+        "root_prefix": root_prefix, "preamble": preamble, "choice_functions": choice_functions,
+        "layout": layout}
+    if shell in _SUPPORTED_ITER_COMPLETERS:
+        return _SUPPORTED_ITER_COMPLETERS[shell](parser, **kwargs)
+    return iter((completer(parser, **kwargs),))
+
+
+def write_completion(parser: Union[ArgumentParser, Command], shell: str, fp,
+                     root_prefix: Opt[str] = None, preamble: Union[str, Dict[str, str]] = "",
+                     choice_functions: Opt[Any] = None, layout: Opt[str] = None) -> None:
+    """
+    Writes `complete(...)` to the text file object `fp` (e.g. `sys.stdout`)
+    as it is generated. See `complete` for arguments.
+    """
+    for chunk in iter_completion(parser, shell=shell, root_prefix=root_prefix, preamble=preamble,
+                                 choice_functions=choice_functions, layout=layout):
+        fp.write(chunk)
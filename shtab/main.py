@@ -1,26 +1,107 @@
 import argparse
+import json
 import logging
 import os
+import shutil
+import subprocess
 import sys
 from contextlib import contextmanager
 from importlib import import_module
 from pathlib import Path
 
-from . import SUPPORTED_SHELLS, __version__, add_argument_to, complete
+from . import (
+    CHOICES_THRESHOLD,
+    SUPPORTED_LAYOUTS,
+    SUPPORTED_SHELLS,
+    __version__,
+    add_argument_to,
+    complete,
+    externalize_choices,
+    limit_completions,
+    model_from_spec,
+    model_to_spec,
+    write_completion,
+)
 
 log = logging.getLogger(__name__)
+LAYOUTS = sorted({layout for layouts in SUPPORTED_LAYOUTS.values() for layout in layouts})
+SPEC_VERSION = 1   # `--dump-spec` format: {"shtab_spec": 1, "prefix": str, "command": spec}
 
 
 def get_main_parser():
     parser = argparse.ArgumentParser(prog="shtab")
-    parser.add_argument("parser", help="importable parser (or function returning parser)")
+    parser.add_argument("parser", nargs="?",
+                        help="importable parser (or function returning parser)")
     parser.add_argument("--version", action="version", version="%(prog)s " + __version__)
     parser.add_argument("-s", "--shell", default=SUPPORTED_SHELLS[0], choices=SUPPORTED_SHELLS)
     parser.add_argument("-o", "--output", default='-', help="output file (- for stdout)",
                         type=Path)
+    parser.add_argument(
+        "--split", action="store_true",
+        help="write lazily loaded files to the `--output` directory (bash: a script &"
+        " per-subcommand data files, zsh: an fpath directory of autoloadable functions)")
+    parser.add_argument("--zcompile", action="store_true",
+                        help="compile `--split` zsh functions to `.zwc` wordcode")
+    parser.add_argument(
+        "--choices-dir", type=Path,
+        help="write long `choices` lists to (shell-independent) files in this directory,"
+        " loaded when needed")
+    parser.add_argument("--choices-threshold", default=CHOICES_THRESHOLD, type=int,
+                        help="write `choices` lists longer than this to `--choices-dir`")
+    parser.add_argument(
+        "--limit", type=int, help="maximum number of candidates per argument (bash & zsh;"
+        " default for arguments without `.complete_limit`)")
+    parser.add_argument(
+        "--min-prefix", type=int, help="minimum length of words to complete (bash & zsh;"
+        " default for arguments without `.complete_min_prefix`)")
     parser.add_argument("--prefix", help="prepended to generated functions to avoid clashes")
     parser.add_argument("--preamble", help="prepended to generated script")
     parser.add_argument("--prog", help="custom program name (overrides `parser.prog`)")
+    parser.add_argument("--layout", choices=LAYOUTS,
+                        help="script structure (shell-dependent, default: default)")
+    spec = parser.add_mutually_exclusive_group()
+    spec.add_argument(
+        "--dump-spec", action="store_true",
+        help="write a (versioned JSON) description of `parser` for `--from-spec`"
+        " instead of a script")
+    spec.add_argument(
+        "--from-spec", metavar="FILE", type=Path,
+        help="generate the script from a `--dump-spec` file (- for stdin) instead of"
+        " importing `parser`")
+    parser.add_argument(
+        "--static", metavar="PATH:NAME",
+        help="read the parser returned by function (or the parser variable) NAME in source"
+        " file PATH without importing it (falling back to importing it if parts cannot be"
+        " read)")
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="print generation statistics (JSON: time per phase, counts & output size by"
+        " section & subcommand) to stderr (with --serve: print the daemon's counters)")
+    parser.add_argument(
+        "--bench", action="store_true",
+        help="measure source time, memory & per-keypress latency of the (bash or zsh) script"
+        " instead of writing it")
+    bench = parser.add_argument_group("--bench options")
+    bench.add_argument(
+        "-l", "--line", dest="lines", action="append",
+        help="command line to complete (last word is completed; may be repeated;"
+        " default: representative lines)")
+    bench.add_argument("-n", "--repeat", type=int,
+                       help="number of completions timed per line (default: 100)")
+    parser.add_argument(
+        "--serve", action="store_true",
+        help="run the daemon computing completions for Python `.complete` callables"
+        " (instead of generating a script)")
+    serve = parser.add_argument_group("--serve options")
+    serve.add_argument("--socket", help="Unix socket path (default: per user & interpreter)")
+    serve.add_argument("--idle", type=float,
+                       help="seconds without requests before exiting (default: 600)")
+    serve_mode = serve.add_mutually_exclusive_group()
+    serve_mode.add_argument("--start", action="store_true",
+                            help="start the daemon in the background (if not running)")
+    serve_mode.add_argument("--connect", action="store_true",
+                            help="relay requests from stdin (starting the daemon if needed)")
+    serve_mode.add_argument("--stop", action="store_true", help="stop the daemon")
     parser.add_argument(
         "-u",
         "--error-unimportable",
@@ -34,28 +115,126 @@ def get_main_parser():
     return parser
 
 
-def main(argv=None):
-    parser = get_main_parser()
-    args = parser.parse_args(argv)
-    logging.basicConfig(level=args.loglevel)
-    log.debug(args)
+def write_files(out_dir, files):
+    """
+    Write `{relative_path: content}` to `out_dir`, skipping unchanged files
+    and removing any other files in the subdirectories of `files` (or listed
+    in the previous version of a `*.manifest` file, along with their `.zwc`).
+    """
+    for name in files:
+        path = out_dir / name
+        if name.endswith(".manifest") and path.is_file():
+            for stale in set(path.read_text().splitlines()) - set(files):
+                for stale_path in (out_dir / stale, out_dir / f"{stale}.zwc"):
+                    if stale_path.is_file():
+                        log.debug("removing:%s", stale_path)
+                        stale_path.unlink()
+    for name, content in files.items():
+        path = out_dir / name
+        if path.is_file() and path.read_text() == content:
+            log.debug("unchanged:%s", path)
+            continue
+        log.debug("writing:%s", path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    for subdir in {Path(name).parent for name in files} - {Path(".")}:
+        for path in (out_dir / subdir).iterdir():
+            if path.is_file() and str(path.relative_to(out_dir).as_posix()) not in files:
+                log.debug("removing:%s", path)
+                path.unlink()
+
+
+def zcompile(out_dir, names):
+    """Compile zsh functions `out_dir/name` to (missing or outdated) `.zwc` wordcode"""
+    def outdated(name):
+        zwc = out_dir / f"{name}.zwc"
+        return not zwc.is_file() or zwc.stat().st_mtime < (out_dir / name).stat().st_mtime
+
+    names = [name for name in names if outdated(name)]
+    if names:
+        log.debug("zcompile:%s", names)
+        subprocess.check_call(["zsh", "-fc", "for f; do zcompile -Uz $f; done", "zsh", *names],
+                              cwd=out_dir)
 
-    module, other_parser = args.parser.rsplit(".", 1)
+
+def import_parser(path, error_unimportable=False):
+    """
+    Returns the parser at importable `path` (calling it if it is a function),
+    or `None` if it is not importable (and not `error_unimportable`).
+    """
+    module, other_parser = path.rsplit(".", 1)
     if sys.path and sys.path[0]:
         # not blank so not searching curdir
         sys.path.insert(1, os.curdir)
     try:
         module = import_module(module)
     except ImportError as err:
-        if args.error_unimportable:
+        if error_unimportable:
             raise
         log.debug(str(err))
-        return
+        return None
     other_parser = getattr(module, other_parser)
     if callable(other_parser):
         other_parser = other_parser()
-    if args.prog:
-        other_parser.prog = args.prog
+    return other_parser
+
+
+def static_parser(path, name, error_unimportable=False):
+    """
+    Returns the parser `name` read from source file `path` (see
+    `shtab.static.extract`), importing `path` instead if any parts are
+    unresolved (using the partially read parser if that fails, unless
+    `error_unimportable`).
+    """
+    from .serve import resolve
+    from .static import extract
+
+    other_parser, unresolved = extract(path, name)
+    if not unresolved:
+        return other_parser
+    for part in unresolved:
+        log.warning("static:unresolved:%s", part)
+    log.warning("static:importing:%s", path)
+    path_dir = os.path.dirname(os.path.abspath(path))
+    sys.path.insert(0, path_dir) # as if running `path`
+    try:                         # anything can happen while importing user code
+        imported = resolve(f"{os.path.abspath(path)}:{name}")
+        return imported() if callable(imported) else imported
+    except Exception as err:
+        if error_unimportable or other_parser is None:
+            raise
+        log.warning("static:using partially read parser (%r)", err)
+        return other_parser
+    finally:
+        sys.path.remove(path_dir)
+
+
+def serve(args):
+    from . import serve
+
+    idle = serve.IDLE if args.idle is None else args.idle
+    if args.connect:
+        serve.relay(args.socket, idle)
+    elif args.start:
+        serve.query(["stats"], args.socket, idle)
+    elif args.stats or args.stop:
+        try:
+            response = serve.query(["stats" if args.stats else "stop"], args.socket,
+                                   autostart=False)
+        except (FileNotFoundError, ConnectionRefusedError):
+            log.error("not running")
+            return 1
+        if args.stats:
+            print(response[0])
+    else:
+        serve.serve(args.socket, idle)
+
+
+def main(argv=None):
+    parser = get_main_parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+    log.debug(args)
 
     @contextmanager
     def _open(out_path):
@@ -65,7 +244,106 @@ def main(argv=None):
             with out_path.open('w') as fd:
                 yield fd
 
+    if args.bench and (args.shell not in ("bash", "zsh") or args.dump_spec or args.split
+                       or args.stats):
+        parser.error("--bench requires --shell=bash|zsh, and does not support --dump-spec,"
+                     " --split & --stats")
+    if not args.bench and (args.lines or args.repeat is not None):
+        parser.error("--line & --repeat require --bench")
+    if not args.serve and (args.socket or args.idle is not None or args.start or args.connect
+                           or args.stop):
+        parser.error("--socket, --idle, --start, --connect & --stop require --serve")
+    if args.serve:
+        if args.parser or args.from_spec or args.static or args.bench or args.dump_spec:
+            parser.error("--serve does not support `parser`, --from-spec, --static, --bench &"
+                         " --dump-spec")
+        return serve(args)
+
+    if sum(source is not None for source in (args.parser, args.from_spec, args.static)) != 1:
+        parser.error("exactly one of `parser`, --from-spec & --static is required")
+    if args.from_spec:
+        if str(args.from_spec) in ("-", "stdin"):
+            spec = json.load(sys.stdin)
+        else:
+            with args.from_spec.open() as fd:
+                spec = json.load(fd)
+        if spec.get("shtab_spec") != SPEC_VERSION:
+            parser.error(f"--from-spec: unsupported version {spec.get('shtab_spec')!r}"
+                         f" (expected {SPEC_VERSION})")
+        other_parser = model_from_spec(spec["command"])
+        if args.prog:
+            other_parser.name = args.prog
+        root_prefix = args.prefix or spec["prefix"]
+    elif args.static:
+        path, _, name = args.static.rpartition(":")
+        if not path or not name:
+            parser.error("--static: expected PATH:NAME")
+        other_parser = static_parser(path, name, args.error_unimportable)
+        if other_parser is None:
+            return
+        if args.prog:
+            other_parser.prog = args.prog
+        root_prefix = args.prefix or Path(path).stem
+    else:
+        other_parser = import_parser(args.parser, args.error_unimportable or args.bench)
+        if other_parser is None:
+            return
+        if args.prog:
+            other_parser.prog = args.prog
+        root_prefix = args.prefix or args.parser.split(".", 1)[0]
+    if args.dump_spec:
+        if (args.split or args.stats or args.choices_dir or args.limit is not None
+                or args.min_prefix is not None):
+            parser.error("--dump-spec does not support --split, --stats, --choices-dir,"
+                         " --limit & --min-prefix")
+        with _open(args.output) as fd:
+            dump = {
+                "shtab_spec": SPEC_VERSION, "prefix": root_prefix,
+                "command": model_to_spec(other_parser)}
+            json.dump(dump, fd, indent=2)
+            print(file=fd)
+        return
+    if args.limit is not None or args.min_prefix is not None:
+        other_parser = limit_completions(other_parser, args.limit, args.min_prefix)
+    if args.choices_dir:
+        other_parser, files = externalize_choices(other_parser, str(args.choices_dir.resolve()),
+                                                  args.choices_threshold)
+        write_files(args.choices_dir, files)
+    if args.bench:
+        from .bench import format_latency, measure_latency
+
+        latency = measure_latency(other_parser, shell=args.shell, lines=args.lines,
+                                  repeat=args.repeat or 100, root_prefix=root_prefix,
+                                  preamble=args.preamble or "", layout=args.layout)
+        with _open(args.output) as fd:
+            print(format_latency(latency), file=fd)
+        return
+
+    if args.split:
+        if args.shell not in ("bash", "zsh") or args.layout not in (None, "default") or str(
+                args.output) in ("-", "stdout"):
+            parser.error("--split requires --shell=bash|zsh, the default --layout & --output=DIR")
+        if args.stats:
+            parser.error("--stats does not support --split")
+        if args.zcompile and (args.shell != "zsh" or not shutil.which("zsh")):
+            parser.error("--zcompile requires --shell=zsh & zsh")
+        if args.shell == "bash":
+            from .bash import complete_bash_split as split
+        else:
+            from .zsh import complete_zsh_split as split
+        files = split(other_parser, root_prefix=root_prefix, preamble=args.preamble)
+        write_files(args.output, files)
+        if args.zcompile:
+            zcompile(args.output, [name for name in files if not name.endswith(".manifest")])
+        return
+
     with _open(args.output) as fd:
-        print(
-            complete(other_parser, shell=args.shell, root_prefix=args.prefix
-                     or args.parser.split(".", 1)[0], preamble=args.preamble), file=fd)
+        if args.stats:
+            script, stats = complete(other_parser, shell=args.shell, root_prefix=root_prefix,
+                                     preamble=args.preamble, layout=args.layout, stats=True)
+            print(script, file=fd)
+            print(json.dumps(stats, indent=2), file=sys.stderr)
+        else:
+            write_completion(other_parser, args.shell, fd, root_prefix=root_prefix,
+                             preamble=args.preamble, layout=args.layout)
+            print(file=fd)
@@ -0,0 +1,313 @@
+"""
+Persistent daemon computing completions for Python callables
+(`parser.add_argument(...).complete = callable`).
+
+Generated scripts query the daemon over a per-user Unix socket (bash via a
+`--connect` relay coprocess, zsh via its `zsocket` builtin), starting it on
+first use. The daemon keeps callables' modules imported, and exits after
+`idle` seconds without requests.
+
+Protocol: one tab-separated request per line (`complete<TAB>key<TAB>prefix`,
+`stats` or `stop`), answered by the number of result lines followed by the
+results (one per line).
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+from hashlib import sha256
+from importlib import import_module
+from importlib.util import module_from_spec, spec_from_file_location
+from typing import Any, Callable, Dict, List, Optional, TypedDict
+
+log = logging.getLogger(__name__)
+IDLE = 600    # seconds without requests before the daemon exits
+TIMEOUT = 5   # seconds to wait for the daemon to start (or respond)
+
+
+def get_key(func: Callable) -> str:
+    """
+    Returns the importable `module:qualname` (or `/path/to/script.py:qualname`)
+    of `func`, used by the daemon to find it. Raises `ValueError` if there is
+    none (e.g. lambdas, `functools.partial` or callable instances).
+    """
+    # instances (including `functools.partial`) have no `__qualname__`
+    module = getattr(func, "__module__", None)
+    qualname = getattr(func, "__qualname__", None)
+    if module is None or qualname is None or "<" in qualname:
+        raise ValueError(f"{func!r} is not importable (use a module-level function)")
+    if module == "__main__":
+        main = sys.modules["__main__"]
+        spec = getattr(main, "__spec__", None)
+        path = getattr(main, "__file__", None)
+        if spec is not None:
+            module = spec.name
+        elif path:
+            module = os.path.abspath(path)
+        else:      # interactive session
+            raise ValueError(f"{func!r} is not importable (use a module-level function)")
+    return f"{module}:{qualname}"
+
+
+def resolve(key: str) -> Callable:
+    """Inverse of `get_key`"""
+    module, qualname = key.rsplit(":", 1)
+    obj: Any
+    if module.endswith(".py"):
+        spec = spec_from_file_location(f"_shtab_serve_{sha256(module.encode()).hexdigest()}",
+                                       module)
+        if spec is None or spec.loader is None:
+            raise ImportError(f"cannot import {module}")
+        obj = module_from_spec(spec)
+        sys.modules[spec.name] = obj
+        spec.loader.exec_module(obj)
+    else:
+        obj = import_module(module)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    return obj
+
+
+def get_id(executable: Optional[str] = None) -> str:
+    """Returns an identifier for the daemon's Python `executable`"""
+    return sha256((executable or sys.executable).encode()).hexdigest()[:12]
+
+
+def get_socket_path(executable: Optional[str] = None) -> str:
+    """
+    Returns the daemon's Unix socket path (unique per user & Python
+    `executable`). N.B.: generated zsh scripts compute the same path.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or os.environ.get("TMPDIR") or "/tmp"
+    return os.path.join(runtime_dir, f"shtab-{os.getuid()}", f"serve-{get_id(executable)}.sock")
+
+
+def make_socket_dir(path: str) -> None:
+    """Create the private parent directory of the socket `path`"""
+    socket_dir = os.path.dirname(path)
+    os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+    if os.stat(socket_dir).st_uid != os.getuid():
+        raise PermissionError(f"{socket_dir} is not owned by the current user")
+
+
+class ServerStats(TypedDict):
+    """`Server.stats` (the response to a `stats` request also has "uptime")"""
+    pid: int
+    started: float
+    requests: int
+    errors: int
+    latency_total: float
+    latency_max: float
+    keys: Dict[str, int] # requests per key
+
+
+class Server:
+    """Daemon state: resolved callables, counters & connections"""
+    def __init__(self, path: str, idle: float = IDLE) -> None:
+        self.path = path
+        self.idle = idle
+        self.funcs: Dict[str, Callable] = {}
+        self.stats: ServerStats = {
+            "pid": os.getpid(), "started": time.time(), "requests": 0, "errors": 0,
+            "latency_total": 0.0, "latency_max": 0.0, "keys": {}}
+        # handler task -> writer
+        self.connections: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+        self.last = time.monotonic()
+        self.stopping: Optional[asyncio.Event] = None # set by `run`
+
+    def complete(self, key: str, prefix: str) -> List[str]:
+        """Returns the results of `.complete` callable `key` starting with `prefix`"""
+        try:
+            func = self.funcs[key]
+        except KeyError:
+            func = self.funcs[key] = resolve(key)
+        results = map(str, func(prefix) or ())
+        return [res for res in results if res.startswith(prefix) and "\n" not in res]
+
+    async def respond(self, request: List[str]) -> List[str]:
+        if request[0] == "complete" and len(request) == 3:
+            _, key, prefix = request
+            start = time.perf_counter()
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    None, self.complete, key, prefix)
+            except Exception:
+                log.exception("complete:%s:%r", key, prefix)
+                self.stats["errors"] += 1
+                results = []
+            latency = time.perf_counter() - start
+            self.stats["requests"] += 1
+            self.stats["latency_total"] += latency
+            self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+            self.stats["keys"][key] = self.stats["keys"].get(key, 0) + 1
+            return results
+        if request == ["stats"]:
+            return [json.dumps(dict(self.stats, uptime=time.time() - self.stats["started"]))]
+        if request == ["stop"]:
+            if self.stopping is not None:
+                self.stopping.set()
+            return []
+        log.warning("unknown request:%r", request)
+        self.stats["errors"] += 1
+        return []
+
+    async def handle(self, reader, writer) -> None:
+        # always run as a task by `asyncio.start_unix_server`
+        task = asyncio.current_task()
+        assert task is not None
+        self.connections[task] = writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.last = time.monotonic()
+                results = await self.respond(line.decode().rstrip("\n").split("\t"))
+                response = "".join(f"{res}\n" for res in results)
+                writer.write(f"{len(results)}\n{response}".encode())
+                await writer.drain()
+                self.last = time.monotonic()
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+
+    async def run(self) -> None:
+        stopping = self.stopping = asyncio.Event()
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        log.debug("serving:%s", self.path)
+        while not stopping.is_set():
+            remaining = self.idle - (time.monotonic() - self.last)
+            if remaining <= 0:
+                log.debug("idle")
+                break
+            try:
+                await asyncio.wait_for(stopping.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        server.close()
+        tasks = list(self.connections)
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await server.wait_closed()
+
+
+def serve(path: Optional[str] = None, idle: float = IDLE) -> bool:
+    """
+    Run the daemon (in the foreground) until `idle` seconds without requests.
+    Returns `False` if another daemon is still serving `path` after `TIMEOUT`.
+    """
+    path = path or get_socket_path()
+    make_socket_dir(path)
+    with open(f"{path}.lock", "w") as lock:
+        deadline = time.monotonic() + TIMEOUT
+        while True:         # wait for any exiting daemon
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    log.debug("already serving:%s", path)
+                    return False
+                time.sleep(0.01)
+        if os.path.exists(path):
+            os.unlink(path) # stale
+        try:
+            asyncio.run(Server(path, idle).run())
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+    return True
+
+
+def start(path: Optional[str] = None, idle: float = IDLE) -> None:
+    """Start the daemon in the background (logging to `<path>.log`)"""
+    path = path or get_socket_path()
+    make_socket_dir(path)
+    with open(f"{path}.log", "a") as log_file:
+        subprocess.Popen(
+            [sys.executable, "-m", "shtab.serve", "--socket", path, "--idle",
+             str(idle)], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log_file,
+            start_new_session=True)
+
+
+def connect(path: Optional[str] = None, idle: float = IDLE, timeout: float = TIMEOUT,
+            autostart: bool = True) -> socket.socket:
+    """Returns a socket connected to the daemon, starting it if needed"""
+    path = path or get_socket_path()
+    deadline = None
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if not autostart:
+                raise
+            if deadline is None:
+                start(path, idle)
+                deadline = time.monotonic() + timeout
+            elif time.monotonic() > deadline:
+                raise TimeoutError(f"could not connect to {path}")
+            time.sleep(0.01)
+        else:
+            sock.settimeout(timeout)
+            return sock
+
+
+def read_response(file) -> bytes:
+    """Returns a complete (binary) response read from `file`"""
+    count = file.readline()
+    if not count:
+        raise ConnectionError("connection closed")
+    return count + b"".join(file.readline() for _ in range(int(count)))
+
+
+def query(request: List[str], path: Optional[str] = None, idle: float = IDLE,
+          autostart: bool = True) -> List[str]:
+    """Returns the daemon's response to `request`, starting it if needed"""
+    with connect(path, idle, autostart=autostart) as sock, sock.makefile("rb") as file:
+        sock.sendall("\t".join(request).encode() + b"\n")
+        return read_response(file).decode().splitlines()[1:]
+
+
+def relay(path: Optional[str] = None, idle: float = IDLE, stdin=None, stdout=None) -> None:
+    """
+    Forward requests from `stdin` to the daemon (reconnecting & restarting it
+    as needed), writing responses to `stdout`. Used by bash, which cannot
+    connect to Unix sockets itself.
+    """
+    stdin = stdin or sys.stdin.buffer
+    stdout = stdout or sys.stdout.buffer
+    sock: Optional[socket.socket] = None
+    file: Any = None
+    for line in stdin:
+        response = b"0\n"
+        for _ in range(2):
+            try:
+                if sock is None:
+                    sock = connect(path, idle)
+                    file = sock.makefile("rb")
+                sock.sendall(line)
+                response = read_response(file)
+                break
+            except (OSError, ValueError) as exc:
+                log.debug("relay:%s", exc)
+                if sock is not None:
+                    file.close()
+                    sock.close()
+                sock = file = None
+        stdout.write(response)
+        stdout.flush()
+
+
+if __name__ == "__main__": # pragma: no cover
+    from .main import main
+    sys.exit(main(["--serve", *sys.argv[1:]]) or 0)
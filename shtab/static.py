@@ -0,0 +1,559 @@
+"""
+Static extraction of `argparse` parsers from source files (`extract`),
+without importing them (or their slow top-level dependencies).
+
+The function building the parser (or the module defining a parser variable)
+is interpreted using `ast`: calls to `argparse` & `shtab` (building a real
+`ArgumentParser`), constants, module-level constants, helper functions
+defined in the same file, loops & comprehensions over constants and
+`.complete = ...` assignments are evaluated. Statements which cannot be
+evaluated are skipped, and reported as unresolved if they involve a parser
+(or its arguments).
+"""
+import argparse
+import ast
+import builtins
+import logging
+import operator
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+log = logging.getLogger(__name__)
+# maximum number of nested function calls
+MAX_DEPTH = 32
+# objects (and their attributes & methods) which may be used
+SHTAB_NAMES = {
+    "FILE", "DIRECTORY", "DIR", "ENV_VAR", "USER", "GROUP", "HOSTNAME", "COMMAND", "SERVICE",
+    "JOB", "CHOICE_FUNCTIONS", "Choice", "Optional", "Required", "FileMatching", "cached",
+    "add_argument_to"}
+BUILTINS = {
+    "bool", "dict", "enumerate", "float", "frozenset", "int", "len", "list", "max", "min", "range",
+    "repr", "reversed", "set", "sorted", "str", "tuple", "zip"}
+LITERAL_TYPES = (str, bytes, int, float, complex, bool, type(None), list, tuple, dict, set,
+                 frozenset, range, slice)
+TRACKED_TYPES = (argparse._ActionsContainer, argparse.Action)
+# methods of `TRACKED_TYPES` which are called (or ignored, as irrelevant to completion)
+PARSER_METHODS = {
+    "add_argument", "add_argument_group", "add_mutually_exclusive_group", "add_subparsers",
+    "add_parser"}
+IGNORED_METHODS = {"set_defaults"}
+# `argparse` keyword arguments dropped if unresolved (irrelevant to completion)
+LENIENT_KWARGS = {"type", "default", "required", "metavar", "const", "version", "epilog", "usage"}
+# (Python) errors raised by evaluated code, treated as `Unresolved`
+ERRORS = (ArithmeticError, AttributeError, LookupError, TypeError, ValueError,
+          argparse.ArgumentError)
+OPERATORS: Dict[type, Callable[..., Any]] = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+    ast.BitOr: operator.or_, ast.BitAnd: operator.and_, ast.USub: operator.neg,
+    ast.UAdd: operator.pos, ast.Not: operator.not_, ast.Eq: operator.eq, ast.NotEq: operator.ne,
+    ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+    ast.Is: operator.is_, ast.IsNot: operator.is_not, ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b}
+# f-string `!s`, `!r` & `!a` conversions (-1: none)
+CONVERSIONS: Dict[int, Callable[[Any], Any]] = {
+    ord("s"): str, ord("r"): repr, ord("a"): ascii, -1: lambda x: x}
+
+
+class Unresolved(Exception):
+    """Raised for code which cannot be evaluated statically"""
+
+
+class Function:
+    """Function defined in the extracted source (called by interpreting it)"""
+    def __init__(self, node: ast.FunctionDef, scope: "Scope", module_level: bool) -> None:
+        self.node = node
+        self.scope = scope
+        self.module_level = module_level
+
+
+class Module:
+    """Imported (but not executed) module, or one of its attributes"""
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+
+class Scope(dict):
+    """Local variables (falling back to `parent`'s)"""
+    def __init__(self, parent: Optional["Scope"] = None) -> None:
+        super().__init__()
+        self.parent = parent
+
+
+class _Return(Exception):
+    def __init__(self, value: Any) -> None:
+        super().__init__(value)
+        self.value = value
+
+
+class _Break(Exception):
+    pass
+
+
+class _Continue(Exception):
+    pass
+
+
+class Extractor:
+    """
+    Interpreter for the source file `path`.
+
+    unresolved  : descriptions (`path:line: code (reason)`) of skipped code
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, encoding="utf-8") as fd:
+            self.tree = ast.parse(fd.read(), path)
+        self.unresolved: List[str] = []
+        self.depth = 0
+        self.globals = Scope()
+        # lazily evaluated module-level names
+        self.definitions: Dict[str, Union[ast.Import, ast.ImportFrom, ast.FunctionDef,
+                                          ast.ClassDef, ast.expr]] = {}
+        self.define(self.tree.body)
+
+    def define(self, body: List[ast.stmt]) -> None:
+        for stmt in body:
+            if isinstance(stmt, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)):
+                self.definitions.update(dict.fromkeys(self.get_bound_names(stmt), stmt))
+            elif isinstance(stmt, ast.Assign):
+                for target in stmt.targets:
+                    if isinstance(target, ast.Name):
+                        self.definitions[target.id] = stmt.value
+            elif isinstance(stmt, ast.AnnAssign):
+                if stmt.value is not None and isinstance(stmt.target, ast.Name):
+                    self.definitions[stmt.target.id] = stmt.value
+            elif isinstance(stmt, ast.Try):
+                self.define(stmt.body)
+
+    @staticmethod
+    def get_bound_names(
+            stmt: Union[ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef]) -> List[str]:
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            return [(alias.asname or alias.name).split(".", 1)[0] for alias in stmt.names]
+        return [stmt.name]
+
+    def extract(self, name: str) -> Optional[argparse.ArgumentParser]:
+        """Returns the parser returned by function `name` (or module-level parser `name`)"""
+        definition = self.definitions.get(name)
+        try:
+            if isinstance(definition, ast.FunctionDef):
+                parser = self.call(self.lookup(name, self.globals), [], {})
+            else:
+                self.run(self.tree.body, self.globals)
+                parser = self.lookup(name, self.globals)
+        except Unresolved as exc:
+            self.unresolved.append(f"{self.path}: {name} ({exc})")
+            return None
+        if not isinstance(parser, argparse.ArgumentParser):
+            self.unresolved.append(f"{self.path}: {name} (not an ArgumentParser: {parser!r})")
+            return None
+        return parser
+
+    # statements
+
+    def run(self, body: List[ast.stmt], scope: Scope) -> None:
+        for stmt in body:
+            try:
+                self.run_statement(stmt, scope)
+            except Unresolved as exc:
+                self.skip(stmt, scope, exc)
+            except ERRORS as exc:
+                self.skip(stmt, scope, Unresolved(f"{type(exc).__name__}: {exc}"))
+
+    def skip(self, stmt: ast.stmt, scope: Scope, exc: Unresolved) -> None:
+        reason = f"line {stmt.lineno}: {exc}"
+        targets = []
+        if isinstance(stmt, ast.Assign):
+            targets = stmt.targets
+        elif isinstance(stmt, (ast.AnnAssign, ast.AugAssign, ast.For)):
+            targets = [stmt.target]
+        for target in targets:
+            for node in ast.walk(target):
+                if isinstance(node, ast.Name):
+                    scope[node.id] = Unresolved(f"{node.id} unresolved ({reason})")
+        if isinstance(stmt, ast.Return) or self.is_relevant(stmt, scope):
+            code = ast.unparse(stmt).split("\n", 1)[0]
+            self.unresolved.append(f"{self.path}:{stmt.lineno}: {code} ({exc})")
+        else:
+            log.debug("skip:%s:%s", self.path, reason)
+
+    def is_relevant(self, stmt: ast.stmt, scope: Scope) -> bool:
+        """Whether `stmt` uses any parsers (or their arguments)"""
+        for node in ast.walk(stmt):
+            if isinstance(node, ast.Name):
+                try:
+                    if isinstance(self.lookup(node.id, scope), TRACKED_TYPES):
+                        return True
+                except Unresolved:
+                    pass
+        return False
+
+    def run_statement(self, stmt: ast.stmt, scope: Scope) -> None:
+        if isinstance(stmt, ast.Expr):
+            self.evaluate(stmt.value, scope)
+        elif isinstance(stmt, ast.Assign):
+            value = self.evaluate(stmt.value, scope)
+            for target in stmt.targets:
+                self.assign(target, value, scope)
+        elif isinstance(stmt, ast.AnnAssign):
+            if stmt.value is not None:
+                self.assign(stmt.target, self.evaluate(stmt.value, scope), scope)
+        elif isinstance(stmt, ast.AugAssign):
+            op = get_operator(stmt.op)
+            if not isinstance(stmt.target, ast.Name):
+                raise Unresolved(f"augmented assignment to {type(stmt.target).__name__}")
+            value = self.lookup(stmt.target.id, scope)
+            if isinstance(value, list) and op is operator.add:
+                value.extend(self.evaluate(stmt.value, scope)) # in place
+            else:
+                self.assign(stmt.target, op(value, self.evaluate(stmt.value, scope)), scope)
+        elif isinstance(stmt, ast.Return):
+            raise _Return(None if stmt.value is None else self.evaluate(stmt.value, scope))
+        elif isinstance(stmt, ast.If):
+            self.run(stmt.body if self.evaluate(stmt.test, scope) else stmt.orelse, scope)
+        elif isinstance(stmt, ast.For):
+            for item in self.evaluate(stmt.iter, scope):
+                self.assign(stmt.target, item, scope)
+                try:
+                    self.run(stmt.body, scope)
+                except _Break:
+                    break
+                except _Continue:
+                    continue
+            else:
+                self.run(stmt.orelse, scope)
+        elif isinstance(stmt, ast.With):
+            if any(item.optional_vars is not None for item in stmt.items):
+                raise Unresolved("with ... as")
+            self.run(stmt.body, scope)
+        elif isinstance(stmt, ast.Try):
+            self.run(stmt.body, scope)
+            self.run(stmt.orelse, scope)
+            self.run(stmt.finalbody, scope)
+        elif isinstance(stmt, ast.FunctionDef):
+            scope[stmt.name] = Function(stmt, scope, scope is self.globals)
+        elif isinstance(stmt, ast.ClassDef):
+            scope[stmt.name] = Unresolved(f"class {stmt.name}")
+        elif isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            for name in self.get_bound_names(stmt):
+                scope[name] = self.get_import(stmt, name)
+        elif isinstance(stmt, ast.Break):
+            raise _Break()
+        elif isinstance(stmt, ast.Continue):
+            raise _Continue()
+        elif not isinstance(stmt, (ast.Pass, ast.Assert, ast.Global, ast.Nonlocal)):
+            raise Unresolved(type(stmt).__name__)
+
+    def assign(self, target: ast.expr, value: Any, scope: Scope) -> None:
+        if isinstance(target, ast.Name):
+            scope[target.id] = value
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            values = list(value)
+            if len(values) != len(target.elts) or any(
+                    isinstance(elt, ast.Starred) for elt in target.elts):
+                raise Unresolved("unpacking")
+            for elt, item in zip(target.elts, values):
+                self.assign(elt, item, scope)
+        elif isinstance(target, ast.Attribute):
+            obj = self.evaluate(target.value, scope)
+            if not isinstance(obj, TRACKED_TYPES):
+                raise Unresolved(f"setting .{target.attr} of {type(obj).__name__}")
+            if isinstance(value, Function):
+                if target.attr != "complete" or not value.module_level:
+                    raise Unresolved(f"function {value.node.name}")
+                from .core import Served
+
+                value = Served(key=f"{os.path.abspath(self.path)}:{value.node.name}")
+            setattr(obj, target.attr, value)
+        elif isinstance(target, ast.Subscript):
+            obj = self.evaluate(target.value, scope)
+            if not isinstance(obj, (list, dict)):
+                raise Unresolved(f"setting item of {type(obj).__name__}")
+            obj[self.evaluate(target.slice, scope)] = value
+        else:
+            raise Unresolved(f"assignment to {type(target).__name__}")
+
+    # expressions
+
+    def lookup(self, name: str, scope: Scope) -> Any:
+        current: Optional[Scope] = scope
+        while current is not None:
+            if name in current:
+                value = current[name]
+                if isinstance(value, Unresolved):
+                    raise value
+                return value
+            current = current.parent
+        if name in self.definitions:
+            definition = self.definitions.pop(name) # avoid infinite recursion
+            try:
+                if isinstance(definition, (ast.Import, ast.ImportFrom)):
+                    value = self.get_import(definition, name)
+                elif isinstance(definition, ast.FunctionDef):
+                    value = Function(definition, self.globals, True)
+                elif isinstance(definition, ast.ClassDef):
+                    raise Unresolved(f"class {name}")
+                else:
+                    value = self.evaluate(definition, self.globals)
+            except Unresolved as exc:
+                value = exc
+            self.globals.setdefault(name, value)
+            return self.lookup(name, self.globals)
+        if name == "__name__":
+            return "__shtab_static__"
+        if name == "__file__":
+            return self.path
+        if name in BUILTINS:
+            return getattr(builtins, name)
+        raise Unresolved(f"unknown name {name}")
+
+    @staticmethod
+    def get_import(stmt: Union[ast.Import, ast.ImportFrom], name: str) -> Any:
+        for alias in stmt.names:
+            if (alias.asname or alias.name).split(".", 1)[0] != name:
+                continue
+            if isinstance(stmt, ast.Import):
+                return get_module_attribute(alias.name if alias.asname else name)
+            module = "." * stmt.level + (stmt.module or "")
+            return get_module_attribute(
+                f"{module}{'' if module.endswith('.') else '.'}{alias.name}")
+        raise Unresolved(f"import {name}")
+
+    def evaluate(self, node: ast.expr, scope: Scope) -> Any:
+        try:
+            return self.evaluate_node(node, scope)
+        except ERRORS as exc:
+            raise Unresolved(f"{type(exc).__name__}: {exc}") from exc
+
+    def evaluate_node(self, node: ast.expr, scope: Scope) -> Any:
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            return self.lookup(node.id, scope)
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            values = []
+            for elt in node.elts:
+                if isinstance(elt, ast.Starred):
+                    values.extend(self.evaluate(elt.value, scope))
+                else:
+                    values.append(self.evaluate(elt, scope))
+            return {ast.List: list, ast.Tuple: tuple, ast.Set: set}[type(node)](values)
+        if isinstance(node, ast.Dict):
+            res = {}
+            for key, item in zip(node.keys, node.values):
+                if key is None:
+                    res.update(self.evaluate(item, scope))
+                else:
+                    res[self.evaluate(key, scope)] = self.evaluate(item, scope)
+            return res
+        if isinstance(node, ast.Attribute):
+            value = self.evaluate(node.value, scope)
+            if isinstance(value, Module):
+                return get_module_attribute(f"{value.name}.{node.attr}")
+            if node.attr.startswith("_") or isinstance(value, (Function, Unresolved)):
+                raise Unresolved(f"attribute {node.attr}")
+            return getattr(value, node.attr)
+        if isinstance(node, ast.Call):
+            return self.evaluate_call(node, scope)
+        if isinstance(node, ast.JoinedStr):
+            return "".join(self.evaluate(value, scope) for value in node.values)
+        if isinstance(node, ast.FormattedValue):
+            value = self.evaluate(node.value, scope)
+            value = CONVERSIONS[node.conversion](value)
+            spec = "" if node.format_spec is None else self.evaluate(node.format_spec, scope)
+            return format(value, spec)
+        if isinstance(node, ast.UnaryOp):
+            return get_operator(node.op)(self.evaluate(node.operand, scope))
+        if isinstance(node, ast.BinOp):
+            op = get_operator(node.op)
+            return op(self.evaluate(node.left, scope), self.evaluate(node.right, scope))
+        if isinstance(node, ast.Compare):
+            ops = [get_operator(op) for op in node.ops]
+            left = self.evaluate(node.left, scope)
+            for op, comparator in zip(ops, node.comparators):
+                right = self.evaluate(comparator, scope)
+                if not op(left, right):
+                    return False
+                left = right
+            return True
+        if isinstance(node, ast.BoolOp):
+            value = None
+            for operand in node.values:
+                value = self.evaluate(operand, scope)
+                if bool(value) == isinstance(node.op, ast.Or):
+                    break
+            return value
+        if isinstance(node, ast.IfExp):
+            return self.evaluate(node.body if self.evaluate(node.test, scope) else node.orelse,
+                                 scope)
+        if isinstance(node, ast.Subscript):
+            value = self.evaluate(node.value, scope)
+            if not isinstance(value, (str, bytes, list, tuple, dict, range)):
+                raise Unresolved(f"item of {type(value).__name__}")
+            return value[self.evaluate(node.slice, scope)]
+        if isinstance(node, ast.Slice):
+            return slice(*(None if part is None else self.evaluate(part, scope)
+                           for part in (node.lower, node.upper, node.step)))
+        if isinstance(node, (ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp)):
+            return self.evaluate_comprehension(node, scope)
+        raise Unresolved(type(node).__name__)
+
+    def evaluate_comprehension(self, node: Union[ast.ListComp, ast.SetComp, ast.GeneratorExp,
+                                                 ast.DictComp], scope: Scope) -> Any:
+        results = []
+
+        def loop(generators, scope):
+            if not generators:
+                if isinstance(node, ast.DictComp):
+                    key = self.evaluate(node.key, scope)
+                    results.append((key, self.evaluate(node.value, scope)))
+                else:
+                    results.append(self.evaluate(node.elt, scope))
+                return
+            for item in self.evaluate(generators[0].iter, scope):
+                inner = Scope(scope)
+                self.assign(generators[0].target, item, inner)
+                if all(self.evaluate(cond, inner) for cond in generators[0].ifs):
+                    loop(generators[1:], inner)
+
+        loop(node.generators, scope)
+        return {ast.ListComp: list, ast.GeneratorExp: list, ast.SetComp: set,
+                ast.DictComp: dict}[type(node)](results)
+
+    def evaluate_call(self, node: ast.Call, scope: Scope) -> Any:
+        func = self.evaluate(node.func, scope)
+        owner = getattr(func, "__self__", None)
+        if isinstance(func, Module):
+            raise Unresolved(f"call to {func.name}")
+        if isinstance(owner, TRACKED_TYPES):
+            if func.__name__ in IGNORED_METHODS:
+                return None
+            if func.__name__ not in PARSER_METHODS:
+                raise Unresolved(f"method {func.__name__}")
+        elif not (isinstance(func, Function) or isinstance(owner, LITERAL_TYPES) or
+                  (isinstance(func, type) and func.__module__ == "argparse") or
+                  (getattr(func, "__module__", None) or "").startswith("shtab") or
+                  (getattr(func, "__name__", "") in BUILTINS
+                   and getattr(builtins, func.__name__) is func)):
+            raise Unresolved(f"call to {getattr(func, 'name', func)!r}")
+        lenient = getattr(func, "__module__", None) == "argparse"
+        dropped = set()
+        args = []
+        for arg in node.args:
+            if isinstance(arg, ast.Starred):
+                args.extend(self.evaluate(arg.value, scope))
+            else:
+                args.append(self.evaluate_argument(func, arg, scope))
+        kwargs = {}
+        for keyword in node.keywords:
+            try:
+                value = self.evaluate_argument(func, keyword.value, scope)
+            except Unresolved as exc:
+                if not (lenient and keyword.arg in LENIENT_KWARGS):
+                    raise
+                log.debug("drop:%s:%d:%s (%s)", self.path, keyword.value.lineno, keyword.arg, exc)
+                dropped.add(keyword.arg)
+                continue
+            if keyword.arg is None:
+                kwargs.update(value)
+            else:
+                kwargs[keyword.arg] = value
+        if "default" in dropped and "%(default)" in str(kwargs.get("help", "")):
+            raise Unresolved("default (used by help)")
+        if isinstance(func, Function):
+            return self.call(func, args, kwargs)
+        return func(*args, **kwargs)
+
+    def evaluate_argument(self, func: Any, node: ast.expr, scope: Scope) -> Any:
+        """Evaluates an argument of `func` (placeholders are only passed to `Function`s)"""
+        value = self.evaluate(node, scope)
+        if not isinstance(func, Function):
+            if isinstance(value, Module):
+                raise Unresolved(f"imported {value.name}")
+            if isinstance(value, Function):
+                raise Unresolved(f"function {value.node.name}")
+        return value
+
+    def call(self, func: Function, args: List[Any], kwargs: Dict[str, Any]) -> Any:
+        if self.depth >= MAX_DEPTH:
+            raise Unresolved("too many nested calls")
+        node = func.node
+        scope = Scope(func.scope)
+        params = node.args.posonlyargs + node.args.args
+        if len(args) > len(params) and node.args.vararg is None:
+            raise Unresolved(f"too many arguments for {node.name}")
+        defaults = dict(zip(params[len(params) - len(node.args.defaults):], node.args.defaults))
+        defaults.update((param, default)
+                        for param, default in zip(node.args.kwonlyargs, node.args.kw_defaults)
+                        if default is not None)
+        for param, value in zip(params, args):
+            scope[param.arg] = value
+        if node.args.vararg is not None:
+            scope[node.args.vararg.arg] = tuple(args[len(params):])
+        extra = {}
+        for key, value in kwargs.items():
+            if any(param.arg == key for param in params + node.args.kwonlyargs):
+                scope[key] = value
+            else:
+                extra[key] = value
+        if extra and node.args.kwarg is None:
+            raise Unresolved(f"unexpected arguments for {node.name}: {sorted(extra)}")
+        if node.args.kwarg is not None:
+            scope[node.args.kwarg.arg] = extra
+        for param in params + node.args.kwonlyargs:
+            if param.arg not in scope:
+                if param not in defaults:
+                    raise Unresolved(f"missing argument {param.arg} for {node.name}")
+                scope[param.arg] = self.evaluate(defaults[param], func.scope)
+        self.depth += 1
+        try:
+            self.run(node.body, scope)
+        except _Return as ret:
+            return ret.value
+        finally:
+            self.depth -= 1
+        return None
+
+
+def get_operator(op: Union[ast.operator, ast.unaryop, ast.cmpop]) -> Callable[..., Any]:
+    """Returns the Python function for `ast` operator `op`"""
+    try:
+        return OPERATORS[type(op)]
+    except KeyError:
+        raise Unresolved(f"operator {type(op).__name__}") from None
+
+
+def get_module_attribute(name: str) -> Any:
+    """Returns the `argparse` or (whitelisted) `shtab` object `name`, or a `Module`"""
+    module, _, attr = name.partition(".")
+    obj: Any
+    if module == "argparse" and attr:
+        obj = argparse
+        for part in attr.split("."):
+            if part.startswith("_") or not hasattr(obj, part):
+                raise Unresolved(f"unknown {name}")
+            obj = getattr(obj, part)
+        return obj
+    if module == "shtab" and attr:
+        if attr.split(".", 1)[0] not in SHTAB_NAMES:
+            raise Unresolved(f"unsupported {name}")
+        import shtab
+
+        obj = shtab
+        for part in attr.split("."):
+            obj = getattr(obj, part)
+        return obj
+    return Module(name)
+
+
+def extract(path: str, name: str) -> Tuple[Optional[argparse.ArgumentParser], List[str]]:
+    """
+    Returns `(parser, unresolved)`: the parser returned by function `name`
+    (or the module-level parser `name`) in the source file `path`, built
+    without importing `path`, and descriptions of code which could not be
+    evaluated (in which case `parser` may be incomplete, or `None`).
+    """
+    extractor = Extractor(path)
+    parser = extractor.extract(name)
+    return parser, extractor.unresolved
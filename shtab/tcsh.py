@@ -0,0 +1,124 @@
+"""tcsh backend (`complete_tcsh`)"""
+import logging
+from collections import defaultdict
+from string import Template
+
+from . import CHOICE_FUNCTIONS
+from .core import (
+    ChoicesFile,
+    build_model,
+    complete2pattern,
+    get_layout,
+    mark_completer,
+    shell_quote,
+)
+
+log = logging.getLogger(__name__)
+
+
+@mark_completer("tcsh")
+def complete_tcsh(parser, root_prefix=None, preamble="", choice_functions=None, layout=None):
+    """
+    Return tcsh syntax autocompletion script.
+
+    root_prefix:
+      ignored (tcsh has no support for functions)
+
+    See `complete` for other arguments.
+    """
+    get_layout("tcsh", layout)
+    optionals_single = set()
+    optionals_double = set()
+    specials = []
+    index_choices = defaultdict(dict)
+
+    choice_type2fn = {k: v["tcsh"] for k, v in CHOICE_FUNCTIONS.items()}
+    if choice_functions:
+        choice_type2fn.update(choice_functions)
+
+    def get_specials(arg, arg_type, arg_sel):
+        if arg.choices:
+            choice_strs = ' '.join(arg.choices)
+            yield f"'{arg_type}/{arg_sel}/({choice_strs})/'"
+        elif arg.complete is not None or arg.choice_type is not None:
+            complete_fn = (complete2pattern(arg.complete, 'tcsh', choice_type2fn)
+                           if arg.complete is not None else choice_type2fn[arg.choice_type])
+            if complete_fn:
+                sep = "@" if "/" in complete_fn else "/"
+                yield f"'{arg_type}{sep}{arg_sel}{sep}{complete_fn}{sep}'"
+
+    def recurse_parser(command, positional_idx, requirements=None):
+        log_prefix = "| " * positional_idx
+        log.debug("%sParser @ %d", log_prefix, positional_idx)
+        if requirements:
+            log.debug("%s- Requires: %s", log_prefix, requirements)
+        else:
+            requirements = []
+
+        for optional in command.options:
+            log.debug("%s| Optional: %s", log_prefix, optional.dest)
+            # Mingle all optional arguments for all subparsers
+            for optional_str in optional.option_strings:
+                log.debug("%s| | %s", log_prefix, optional_str)
+                if optional_str.startswith('--'):
+                    optionals_double.add(optional_str[2:])
+                elif optional_str.startswith('-'):
+                    optionals_single.add(optional_str[1:])
+                specials.extend(get_specials(optional, 'n', optional_str))
+
+        for positional in command.positionals:
+            positional_idx += 1
+            log.debug("%s| Positional #%d: %s", log_prefix, positional_idx, positional.dest)
+            index_choices[positional_idx][tuple(requirements)] = positional
+            if not requirements and positional.subcommands:
+                for subcmd, subcommand in command.commands.items():
+                    log.debug("%s| | SubParser: %s", log_prefix, subcmd)
+                    recurse_parser(subcommand, positional_idx, requirements + [subcmd])
+
+    command = build_model(parser)
+    recurse_parser(command, 0)
+
+    for idx, ndict in index_choices.items():
+        if len(ndict) == 1:
+            # Single choice, no requirements
+            arg = next(iter(ndict.values()))
+            specials.extend(get_specials(arg, 'p', str(idx)))
+        else:
+            # Multiple requirements
+            nlist = []
+            for nn, arg in ndict.items():
+                if arg.choices or isinstance(arg.complete, ChoicesFile):
+                    checks = [f'[ "$cmd[{iidx}]" == "{n}" ]' for iidx, n in enumerate(nn, start=2)]
+                    if arg.choices:
+                        choices_str = "' '".join(arg.choices)
+                        checks.append(f"echo '{choices_str}'")
+                    else:
+                        checks.append(f"cat {shell_quote(arg.complete.path)}")
+                    checks_str = ' && '.join(checks)
+                    nlist.append(f"( {checks_str} || false )")
+            # Ugly hack
+            nlist_str = ' || '.join(nlist)
+            specials.append(f"'p@{str(idx)}@`set cmd=($COMMAND_LINE); {nlist_str}`@'")
+
+    if optionals_double:
+        if optionals_single:
+            optionals_single.add('-')
+        else:
+            # Don't add a space after completing "--" from "-"
+            optionals_single = ('-', '-')
+
+    return Template("""\
+# AUTOMATICALLY GENERATED by `shtab`
+
+${preamble}
+
+complete ${prog} \\
+        'c/--/(${optionals_double_str})/' \\
+        'c/-/(${optionals_single_str})/' \\
+        ${optionals_special_str} \\
+        'p/*/()/'""").safe_substitute(
+        preamble=("\n# Custom Preamble\n" + preamble +
+                  "\n# End Custom Preamble\n" if preamble else ""), root_prefix=root_prefix,
+        prog=command.name, optionals_double_str=' '.join(sorted(optionals_double)),
+        optionals_single_str=' '.join(sorted(optionals_single)),
+        optionals_special_str=' \\\n        '.join(specials))
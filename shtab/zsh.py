@@ -0,0 +1,638 @@
+"""zsh backend (`complete_zsh`; layouts: default & flat)"""
+import logging
+import re
+import sys
+from argparse import ONE_OR_MORE, REMAINDER, ZERO_OR_MORE
+from itertools import starmap
+from string import Template
+
+from . import CHOICE_FUNCTIONS
+from .core import (
+    apply_limits,
+    build_model,
+    complete2pattern,
+    get_cached,
+    get_choices_files,
+    get_layout,
+    get_limited,
+    get_served,
+    iter_joined,
+    iter_template,
+    mark_breakdown,
+    mark_completer,
+    mark_iter_completer,
+    shell_quote,
+    timed,
+    wordify,
+)
+
+log = logging.getLogger(__name__)
+# per-(sub)command data of the default & flat layouts (see `get_zsh_breakdown`)
+ZSH_SECTIONS = "commands", "options", "cases"
+ZSH_FLAT_SECTIONS = "subcommands", "names", "commands", "options"
+
+
+def get_zsh_cached_functions(command):
+    """
+    Returns `{name: body}` of zsh wrapper functions for `get_cached(command)`
+    (using `_store_cache` & `_retrieve_cache`), as well as the `zstyle`s
+    enabling their cache (`name=""`).
+    """
+    prog = wordify(command.name)
+    functions = {}
+    for complete in get_cached(command):
+        fn = complete.complete.get("zsh")
+        if not fn:
+            continue
+        name = complete["zsh"]
+        functions[name] = Template("""\
+local curcontext="shtab:${prog}:" cache_dir id="${fn_word}:${${PREFIX//\\%/%25}//\\//%2F}"
+local -a results fresh
+zstyle -s ":completion:${curcontext}:" cache-path cache_dir
+if _retrieve_cache "$id"; then
+  # stale results are refreshed in the background
+  fresh=("$cache_dir/$id"(Nms-${ttl}))
+  (( $#fresh )) || {
+    results=(${(f)"$(${fn} "$PREFIX")"})
+    _store_cache "$id" results
+  } &>/dev/null &!
+else
+  results=(${(f)"$(${fn} "$PREFIX")"})
+  _store_cache "$id" results
+fi
+compadd "$@" -a results
+""").safe_substitute(prog=prog, fn=fn, fn_word=wordify(fn), ttl=complete.ttl)
+    if functions:
+        functions[""] = f"""\
+zstyle ':completion:shtab:{prog}:*' use-cache on
+zstyle ':completion:shtab:{prog}:*' cache-path "${{XDG_CACHE_HOME:-$HOME/.cache}}/shtab/{prog}"
+"""
+    return functions
+
+
+def get_zsh_served_functions(command):
+    """Returns `{name: body}` of zsh client functions for `get_served(command)`"""
+    served = get_served(command)
+    if not served:
+        return {}
+    from .serve import TIMEOUT, get_id
+
+    client = f"_shtab_serve_{get_id()}"
+    functions = {
+        client: Template("""\
+# $1=`.complete` callable key, $2=word being completed
+# set `reply` to the `shtab.serve` daemon's results (starting it if needed)
+local sock="${XDG_RUNTIME_DIR:-${TMPDIR:-/tmp}}/shtab-$UID/serve-${id}.sock" fd count line
+reply=()
+zmodload zsh/net/socket || return 0
+if ! zsocket "$sock" 2>/dev/null; then
+  ${python} -m shtab.serve --start 2>/dev/null && zsocket "$sock" 2>/dev/null || return 0
+fi
+fd=$REPLY
+print -r -u $fd -- "complete"$'\\t'"$1"$'\\t'"${2//[$'\\t\\n']/ }"
+if read -r -t ${timeout} -u $fd count; then
+  while (( count-- > 0 )) && read -r -u $fd line; do
+    reply+=("$line")
+  done
+fi
+exec {fd}>&-
+""").safe_substitute(id=get_id(), python=shell_quote(sys.executable), timeout=TIMEOUT)}
+    for complete in served:
+        functions[complete["zsh"]] = f"""\
+local -a reply
+{client} {shell_quote(complete.key)} "$PREFIX"
+compadd "$@" -a reply
+"""
+    return functions
+
+
+def get_zsh_choices_functions(command):
+    """Returns `{name: body}` of zsh loader functions for `get_choices_files(command)`"""
+    return {
+        complete["zsh"]: Template("""\
+# choices (loaded once from ${path})
+(( ${+${name}} )) || typeset -ga ${name}=(${(f)"$(<${quoted_path} 2>/dev/null)"})
+compadd "$@" -a ${name}
+""").safe_substitute(name=complete["zsh"], path=complete.path,
+                     quoted_path=shell_quote(complete.path))
+        for complete in get_choices_files(command)}
+
+
+def get_zsh_limited_functions(command):
+    """Returns `{name: body}` of zsh functions for `get_limited(command)`"""
+    functions = {}
+    for complete in get_limited(command):
+        name = complete["zsh"]
+        lines = []
+        if complete.min_prefix:
+            lines.append(f"(( $#PREFIX >= {complete.min_prefix} )) || return 1")
+        if complete.limit is not None:
+            lines.append(f"local -x SHTAB_LIMIT={complete.limit} # for custom functions")
+        if complete.complete.get("zsh"):
+            lines.append(f'{complete.complete["zsh"]} "$@"')
+        if complete.choices:
+            lines.extend([
+                f"(( ${{+{name}_choices}} )) ||"
+                f" typeset -ga {name}_choices=({' '.join(map(shell_quote, complete.choices))})",
+                f"compadd \"$@\" -- ${{${{(M){name}_choices:#${{(b)PREFIX}}*}}"
+                f"[1,{-1 if complete.limit is None else complete.limit}]}}"])
+        functions[name] = "".join(f"{line}\n" for line in lines)
+    return functions
+
+
+def get_zsh_helpers(command):
+    """
+    Returns `{name: body}` of zsh functions needed by `command`'s `.complete`
+    values (see `get_zsh_cached_functions`, `get_zsh_served_functions`,
+    `get_zsh_choices_functions` & `get_zsh_limited_functions`).
+    """
+    return {
+        **get_zsh_cached_functions(command), **get_zsh_served_functions(command),
+        **get_zsh_choices_functions(command), **get_zsh_limited_functions(command)}
+
+
+def format_zsh_cached_functions(functions):
+    """Returns `get_zsh_helpers` output as zsh function definitions"""
+    chunks = []
+    for name, body in functions.items():
+        if name:
+            body = "".join(f"  {line}" if line.strip() else line for line in body.splitlines(True))
+            chunks.append(f"\n{name}() {{\n{body}}}\n")
+        else:
+            chunks.append(f"\n{body}")
+    return "".join(chunks)
+
+
+@timed("escape")
+def escape_zsh(string):
+    # excessive but safe
+    return re.sub(r"([^\w\s.,()-])", r"\\\1", str(string))
+
+
+def get_zsh_commands(root_parser, root_prefix, choice_functions=None):
+    """
+    Recursive subcommand parser traversal, returning `_arguments` specs & help.
+
+    Returns:
+      {prefix: {"cmd": cmd, "name": "prog cmd...", "help": help,
+                "arguments": [arguments], "commands": {cmd: ...},
+                "owner": "prog cmd" (top-level command, or "prog")}}
+    """
+    choice_type2fn = {k: v["zsh"] for k, v in CHOICE_FUNCTIONS.items()}
+    if choice_functions:
+        choice_type2fn.update(choice_functions)
+
+    def get_pattern(opt):
+        if opt.complete is not None:
+            return complete2pattern(opt.complete, "zsh", choice_type2fn)
+        if opt.choice_type is not None:
+            return choice_type2fn[opt.choice_type]
+        return f"({' '.join(opt.choices)})" if opt.choices else ""
+
+    def format_optional(opt):
+        nargs = '"(- : *)"' if opt.end else '"*"' if opt.multi else ""
+        option_strings = ",".join(opt.option_strings)
+        options = f"{{{option_strings}}}" if len(opt.option_strings) > 1 else f'"{option_strings}"'
+        help_text = escape_zsh(opt.help)
+        spec = f"[{help_text}]" if opt.flag else f"[{help_text}]:{opt.dest}:{get_pattern(opt)}"
+        return f'{nargs}{options}"{spec}"'.replace('""', "")
+
+    def format_positional(opt):
+        return '"{nargs}:{help}:{pattern}"'.format(
+            nargs={ONE_OR_MORE: "(*)", ZERO_OR_MORE: "(*):", REMAINDER: "(-)*"}.get(opt.nargs, ""),
+            help=escape_zsh((opt.help or opt.dest).strip().split("\n")[0]),
+            pattern=get_pattern(opt),
+        )
+
+    def get_arguments(command):
+        return [format_optional(opt) for opt in command.options] + [
+            format_positional(opt) for opt in command.positionals if not opt.subcommands]
+
+    all_commands = {}
+
+    def recurse(command, prefix, cmd, name, owner=None):
+        options = all_commands[prefix] = {
+            "cmd": cmd, "name": name, "help": command.help, "arguments": get_arguments(command),
+            "commands": {}, "owner": owner or name}
+        for subcmd, subcommand in command.commands.items():
+            log.debug("subcommand:%s", subcmd)
+            new_pref = f"{prefix}_{wordify(subcmd)}"
+            options["commands"][subcmd] = recurse(subcommand, new_pref, subcmd, f"{name} {subcmd}",
+                                                  owner or f"{name} {subcmd}")
+        if options["commands"]:
+            log.debug("subcommands:%s:%s", cmd, options["commands"].keys())
+        return options
+
+    command = build_model(root_parser)
+    recurse(command, root_prefix, command.name, command.name)
+    return all_commands
+
+
+def format_zsh_case(prefix, options):
+    """Returns the (default layout) function completing `prefix`'s subcommands"""
+    name = options["cmd"]
+    commands = options["commands"]
+    case_fmt_on_no_sub = """{name}) _arguments -C -s ${prefix}_{name_wordify}_options ;;"""
+    case_fmt_on_sub = """{name}) {prefix}_{name_wordify} ;;"""
+
+    cases = []
+    for _, options in sorted(commands.items()):
+        fmt = case_fmt_on_sub if options.get("commands") else case_fmt_on_no_sub
+        cases.append(
+            fmt.format(name=options["cmd"], name_wordify=wordify(options["cmd"]), prefix=prefix))
+    cases = "\n\t".expandtabs(8).join(cases)
+
+    return f"""\
+{prefix}() {{
+  local context state line \
+curcontext="$curcontext" one_or_more='(*)' remainder='(-)*' default='*::: :->{name}'
+
+  # Add default positional/remainder specs only if none exist, and only once per session
+  if (( ! {prefix}_defaults_added )); then
+    if (( ${{{prefix}_options[(I)${{(q)one_or_more}}*]}} +\
+          ${{{prefix}_options[(I)${{(q)remainder}}*]}} +\
+          ${{{prefix}_options[(I)${{(q)default}}]}} == 0 )); then
+      {prefix}_options+=(': :{prefix}_commands' '*::: :->{name}')
+    fi
+    {prefix}_defaults_added=1
+  fi
+  _arguments -C -s ${prefix}_options
+
+  case $state in
+    {name})
+      words=($line[1] "${{words[@]}}")
+      (( CURRENT += 1 ))
+      curcontext="${{curcontext%:*:*}}:{prefix}-$line[1]:"
+      case $line[1] in
+        {cases}
+      esac
+  esac
+}}
+"""
+
+
+def format_zsh_options(prefix, options):
+    """Returns the (default layout) `_arguments` specs array of `prefix`"""
+    arguments = "\n  ".join(options["arguments"])
+    return f"""\
+{prefix}_options=(
+  {arguments}
+)
+
+# guard to ensure default positional specs are added only once per session
+{prefix}_defaults_added=0
+"""
+
+
+def format_zsh_commands(prefix, options):
+    """Returns the (default layout) function describing `prefix`'s subcommands"""
+    name = options["name"]
+    commands = "\n    ".join(f'"{escape_zsh(cmd)}:{escape_zsh(opt["help"])}"'
+                             for cmd, opt in sorted(options["commands"].items()))
+    return f"""
+{prefix}_commands() {{
+  local _commands=(
+    {commands}
+  )
+  _describe '{name} commands' _commands
+}}"""
+
+
+@mark_completer("zsh")
+def complete_zsh(parser, root_prefix=None, preamble="", choice_functions=None, layout=None):
+    """
+    Returns zsh syntax autocompletion script.
+
+    See `complete` for arguments.
+    """
+    if get_layout("zsh", layout) == "flat":
+        return complete_zsh_flat(parser, root_prefix=root_prefix, preamble=preamble,
+                                 choice_functions=choice_functions)
+    return "".join(
+        iter_complete_zsh(parser, root_prefix=root_prefix, preamble=preamble,
+                          choice_functions=choice_functions, layout=layout))
+
+
+@mark_breakdown("zsh")
+def get_zsh_breakdown(parser, root_prefix=None, choice_functions=None, layout=None):
+    """
+    Returns the data size (bytes) by section (`ZSH_SECTIONS`, or
+    `ZSH_FLAT_SECTIONS` for the flat layout) & by top-level command:
+    `{"sections": {section: size}, "commands": {"prog cmd": size}}`.
+    """
+    command = apply_limits(parser)
+    root_prefix = wordify(f"_shtab_{root_prefix or command.name}")
+    all_commands = get_zsh_commands(command, root_prefix, choice_functions=choice_functions)
+    if get_layout("zsh", layout) == "flat":
+        items = get_zsh_flat_sections(all_commands, root_prefix)
+    else:
+        subcommands = {
+            prefix: options
+            for prefix, options in all_commands.items() if options.get("commands")}
+        subcommands.setdefault(root_prefix, all_commands[root_prefix])
+        items = {
+            section: [(options["owner"], fmt(prefix, options))
+                      for prefix, options in sorted(prefixes.items())]
+            for section, fmt, prefixes in (("commands", format_zsh_commands, subcommands),
+                                           ("options", format_zsh_options, all_commands),
+                                           ("cases", format_zsh_case, subcommands))}
+    sections = dict.fromkeys(items, 0)
+    names = [command.name] + [f"{command.name} {cmd}" for cmd in command.commands]
+    commands = dict.fromkeys(names, 0)
+    for section, owned_items in items.items():
+        for owner, item in owned_items:
+            size = len(item.encode()) + 1 # separator
+            sections[section] += size
+            commands[owner] += size
+    return {"sections": sections, "commands": commands}
+
+
+@mark_iter_completer("zsh")
+def iter_complete_zsh(parser, root_prefix=None, preamble="", choice_functions=None, layout=None):
+    """
+    Yields chunks of `complete_zsh` (the default layout is streamed one
+    (sub)command at a time).
+    """
+    layout = get_layout("zsh", layout)
+    if layout != "default":
+        yield complete_zsh(parser, root_prefix=root_prefix, preamble=preamble,
+                           choice_functions=choice_functions, layout=layout)
+        return
+    command = apply_limits(parser)
+    prog = command.name
+    root_prefix = wordify(f"_shtab_{root_prefix or prog}")
+
+    # {prefix: {"cmd": cmd, "name": "prog cmd...", "help": help, "arguments": [arguments],
+    #           "commands": {cmd: ...}}}
+    all_commands = get_zsh_commands(command, root_prefix, choice_functions=choice_functions)
+    subcommands = {
+        prefix: options
+        for prefix, options in all_commands.items() if options.get("commands")}
+    subcommands.setdefault(root_prefix, all_commands[root_prefix])
+    log.debug("subcommands:%s:%s", root_prefix, all_commands.keys())
+
+    preamble = (f"""\
+# Custom Preamble
+{preamble.rstrip()}
+
+# End Custom Preamble
+""" if preamble else "")
+    # References:
+    #   - https://github.com/zsh-users/zsh-completions
+    #   - http://zsh.sourceforge.net/Doc/Release/Completion-System.html
+    #   - https://mads-hartmann.com/2017/08/06/
+    #     writing-zsh-completion-scripts.html
+    #   - http://www.linux-mag.com/id/1106/
+    yield from iter_template(
+        """\
+#compdef ${prog}
+
+# AUTOMATICALLY GENERATED by `shtab`
+
+${command_commands}
+
+${command_options}
+
+${command_cases}${cached_functions}
+${preamble}
+
+typeset -A opt_args
+
+if [[ $zsh_eval_context[-1] == eval ]]; then
+  # eval/source/. command, register function for later
+  compdef ${root_prefix} -N ${prog}
+else
+  # autoload from fpath, call function directly
+  ${root_prefix} "$@\"
+fi
+""",
+        prog=prog,
+        root_prefix=root_prefix,
+        command_cases=iter_joined(starmap(format_zsh_case, sorted(subcommands.items()))),
+        command_commands=iter_joined(starmap(format_zsh_commands, sorted(subcommands.items()))),
+        command_options=iter_joined(starmap(format_zsh_options, sorted(all_commands.items()))),
+        cached_functions=format_zsh_cached_functions(get_zsh_helpers(command)),
+        preamble=preamble,
+    )
+
+
+def get_zsh_flat_sections(all_commands, root_prefix):
+    """
+    Returns the flat layout's data (`ZSH_FLAT_SECTIONS`) for `get_zsh_commands`
+    output: `{section: [(owner, text)]}` (`owner` being the top-level command).
+    """
+    sections = {section: [] for section in ZSH_FLAT_SECTIONS}
+    for prefix, options in all_commands.items():
+        owner = options["owner"]
+        arguments = options["arguments"]
+        if options["commands"] and not any(arg.startswith(('"(*)', '"(-)*')) for arg in arguments):
+            arguments = arguments + [f"': :{root_prefix}_describe_commands'"]
+        arguments = "\n  ".join(arguments)
+        sections["options"].append((owner, f"{prefix}_options=(\n  {arguments}\n)"))
+        if not options["commands"]:
+            continue
+        sections["names"].append(
+            (owner, f"  {shell_quote(prefix)} {shell_quote(options['name'])}"))
+        commands = "\n  ".join(f'"{escape_zsh(cmd)}:{escape_zsh(opt["help"])}"'
+                               for cmd, opt in sorted(options["commands"].items()))
+        sections["commands"].append((owner, f"{prefix}_commands=(\n  {commands}\n)"))
+        for cmd in options["commands"]:
+            sections["subcommands"].append(
+                (owner, f"  {shell_quote(f'{prefix}/{cmd}')} {prefix}_{wordify(cmd)}"))
+    return sections
+
+
+def complete_zsh_flat(parser, root_prefix=None, preamble="", choice_functions=None):
+    """
+    Returns zsh syntax autocompletion script which resolves the subcommand
+    path with one associative array lookup per word, then calls `_arguments`
+    once (for the innermost subcommand).
+
+    See `complete` for arguments.
+    """
+    command = apply_limits(parser)
+    prog = command.name
+    root_prefix = wordify(f"_shtab_{root_prefix or prog}")
+    all_commands = get_zsh_commands(command, root_prefix, choice_functions=choice_functions)
+    sections = get_zsh_flat_sections(all_commands, root_prefix)
+
+    preamble = (f"""\
+# Custom Preamble
+{preamble.rstrip()}
+
+# End Custom Preamble
+""" if preamble else "")
+    return Template("""\
+#compdef ${prog}
+
+# AUTOMATICALLY GENERATED by `shtab`
+
+# {"prefix/subcommand": subcommand prefix}
+typeset -gA ${root_prefix}_subcommands
+${root_prefix}_subcommands=(
+${subcommands}
+)
+
+# {prefix: "prog subcommand..."}
+typeset -gA ${root_prefix}_names
+${root_prefix}_names=(
+${names}
+)
+
+${command_lists}
+
+${command_options}
+${cached_functions}${preamble}
+typeset -A opt_args
+
+# describe the current `prefix`'s subcommands
+${root_prefix}_describe_commands() {
+  _describe "${${root_prefix}_names[$prefix]} commands" ${prefix}_commands
+}
+
+${root_prefix}() {
+  local prefix=${root_prefix} parent next options
+  local -i index=2 start=1
+  # find the innermost subcommand
+  while (( index < CURRENT )); do
+    next=${${root_prefix}_subcommands[$prefix/$words[index]]}
+    if [[ -n $next ]]; then
+      parent=$prefix
+      prefix=$next
+      start=$index
+    fi
+    (( index++ ))
+  done
+  if (( start > 1 )); then
+    # complete as if the innermost subcommand was the command
+    words=("${(@)words[start,-1]}")
+    (( CURRENT -= start - 1 ))
+    curcontext="${curcontext%:*:*}:$parent-$words[1]:"
+  fi
+
+  local context state line
+  options=${prefix}_options
+  _arguments -C -s "${(@P)options}"
+}
+
+if [[ $zsh_eval_context[-1] == eval ]]; then
+  # eval/source/. command, register function for later
+  compdef ${root_prefix} -N ${prog}
+else
+  # autoload from fpath: skip re-sourcing for subsequent completions
+  compdef ${root_prefix} ${prog}
+  ${root_prefix} "$@\"
+fi
+""").safe_substitute(
+        prog=prog,
+        root_prefix=root_prefix,
+        **{
+            name: "\n".join(text for _, text in sections[section])
+            for name, section in (("subcommands", "subcommands"), ("names", "names"),
+                                  ("command_lists", "commands"), ("command_options", "options"))},
+        cached_functions=format_zsh_cached_functions(get_zsh_helpers(command)),
+        preamble=preamble,
+    )
+
+
+def complete_zsh_split(parser, root_prefix=None, preamble="", choice_functions=None):
+    """
+    Returns `{filename: content}` for an `fpath` directory: the `#compdef`
+    file `_<prog>` plus one autoloadable function per (sub)command (and
+    subcommand list), so that zsh only parses the functions it needs. Also
+    includes a `<root_prefix>.manifest` listing all other files.
+
+    See `complete` for arguments.
+    """
+    command = apply_limits(parser)
+    prog = command.name
+    root_prefix = wordify(f"_shtab_{root_prefix or prog}")
+    all_commands = get_zsh_commands(command, root_prefix, choice_functions=choice_functions)
+    header = "# AUTOMATICALLY GENERATED by `shtab`\n\n"
+
+    files = {}
+    for prefix, options in all_commands.items():
+        arguments = "\n  ".join(options["arguments"])
+        if prefix != root_prefix and not options["commands"]:
+            files[prefix] = f"""\
+{header}local -a options
+options=(
+  {arguments}
+)
+_arguments -C -s $options
+"""
+            continue
+
+        name = options["cmd"]
+        if not any(arg.startswith(('"(*)', '"(-)*')) for arg in options["arguments"]):
+            arguments += f"\n  ': :{prefix}_commands' '*::: :->{name}'"
+        functions = [f"{prefix}_commands"]
+        cases = []
+        for cmd in sorted(options["commands"]):
+            functions.append(f"{prefix}_{wordify(cmd)}")
+            cases.append(f"{cmd}) {functions[-1]} ;;")
+        cases = "\n      ".join(cases)
+        files[prefix] = f"""\
+{header}local context state line curcontext="$curcontext"
+local -a options
+options=(
+  {arguments}
+)
+autoload -Uz {" ".join(functions)}
+_arguments -C -s $options
+
+case $state in
+  {name})
+    words=($line[1] "${{words[@]}}")
+    (( CURRENT += 1 ))
+    curcontext="${{curcontext%:*:*}}:{prefix}-$line[1]:"
+    case $line[1] in
+      {cases}
+    esac
+esac
+"""
+        commands = "\n  ".join(f'"{escape_zsh(cmd)}:{escape_zsh(opt["help"])}"'
+                               for cmd, opt in sorted(options["commands"].items()))
+        files[f"{prefix}_commands"] = f"""\
+{header}local _commands=(
+  {commands}
+)
+_describe '{options["name"]} commands' _commands
+"""
+
+    cached_functions = get_zsh_helpers(command)
+    for name, body in cached_functions.items():
+        if name:
+            files[name] = header + body
+    preamble = (f"""\
+# Custom Preamble
+{preamble.rstrip()}
+
+# End Custom Preamble
+""" if preamble else "")
+    files[f"_{prog}"] = Template("""\
+#compdef ${prog}
+
+# AUTOMATICALLY GENERATED by `shtab`
+# (requires this directory to be in `fpath`)
+
+${preamble}
+typeset -A opt_args
+${cache_styles}autoload -Uz ${functions}
+
+if [[ $zsh_eval_context[-1] == eval ]]; then
+  # eval/source/. command, register function for later
+  compdef ${root_prefix} -N ${prog}
+else
+  # autoload from fpath, call function directly
+  ${root_prefix} "$@\"
+fi
+""").safe_substitute(
+        prog=prog,
+        root_prefix=root_prefix,
+        preamble=preamble,
+        cache_styles=cached_functions.pop("", ""),
+        functions=" ".join([root_prefix] + list(cached_functions)),
+    )
+    files[f"{root_prefix}.manifest"] = "".join(f"{name}\n" for name in sorted(files))
+    return files
@@ -1,15 +1,26 @@
 """
 Tests for `shtab`.
 """
+import functools
+import io
+import json
 import logging
 import os
+import shutil
 import subprocess
-from argparse import ArgumentParser
+import sys
+import time
+import tracemalloc
+from argparse import SUPPRESS, ArgumentParser
+from string import Template
 
 import pytest
 
 import shtab
-from shtab.main import get_main_parser, main
+import shtab.bash
+import shtab.zsh
+from shtab import bench, serve
+from shtab.main import get_main_parser, main, write_files
 
 fix_shell = pytest.mark.parametrize("shell", shtab.SUPPORTED_SHELLS)
 
@@ -332,6 +343,62 @@ def test_add_argument_to_positional(shell, caplog, capsys):
     assert not caplog.record_tuples
 
 
+IMPORT_BUDGET = 10_000 # microseconds (`python -X importtime`) for `import shtab`
+
+
+def test_import_time():
+    """`import shtab` & `add_argument_to` must not load generators, logging, etc."""
+    code = ("import argparse, sys; loaded = set(sys.modules); import shtab;"
+            " shtab.add_argument_to(argparse.ArgumentParser()).parse_args([]);"
+            " print(*sorted(set(sys.modules) - loaded))")
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    times = []
+    # the first run may write bytecode
+    for _ in range(3):
+        res = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env,
+                             capture_output=True, text=True, check=True)
+        times.append(
+            min(
+                int(line.split("|")[1]) for line in res.stderr.splitlines()
+                if line.split("|")[-1].strip() == "shtab"))
+    assert min(times) < IMPORT_BUDGET
+    heavy = {
+        "logging", "typing", "hashlib", "string", "importlib.metadata", "shtab.core", "shtab.bash"}
+    assert not heavy & set(res.stdout.split())
+
+
+def test_shell_entry_points(tmp_path, monkeypatch):
+    module = tmp_path / "shtab_myshell.py"
+    module.write_text("def complete_myshell(parser, **kwargs):\n    return f'# {parser.prog}'\n")
+    dist = tmp_path / "shtab_myshell-1.0.dist-info"
+    dist.mkdir()
+    (dist / "METADATA").write_text("Metadata-Version: 2.1\nName: shtab-myshell\nVersion: 1.0\n")
+    entry_points = dist / "entry_points.txt"
+    entry_points.write_text("[shtab.shells]\nmyshell = shtab_myshell:complete_myshell\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    # rediscover into copies of the registries
+    backends = dict(shtab.SHELL_BACKENDS)
+    monkeypatch.setattr(shtab, "SHELL_BACKENDS", backends)
+    monkeypatch.setattr(shtab.core, "SHELL_BACKENDS", backends)
+    monkeypatch.setattr(shtab.core, "_SUPPORTED_COMPLETERS", {})
+    monkeypatch.setattr(shtab.SUPPORTED_SHELLS, "_data", shtab.SUPPORTED_SHELLS._data[:])
+    monkeypatch.setattr(shtab.SUPPORTED_SHELLS, "discovered", False)
+
+    assert "myshell" in shtab.SUPPORTED_SHELLS
+    assert backends["myshell"] == "shtab_myshell:complete_myshell"
+    assert "shtab_myshell" not in sys.modules
+    assert shtab.complete(ArgumentParser(prog="test"), shell="myshell") == "# test"
+    assert "shtab_myshell" in sys.modules
+    monkeypatch.delitem(sys.modules, "shtab_myshell")
+
+    assert "tcsh" not in shtab.core._SUPPORTED_COMPLETERS
+    monkeypatch.delitem(sys.modules, "shtab.tcsh", raising=False)
+    shtab.get_completer("tcsh")
+    assert "tcsh" in shtab.core._SUPPORTED_COMPLETERS
+    with pytest.raises(NotImplementedError):
+        shtab.get_completer("fish")
+
+
 @fix_shell
 def test_get_completer(shell):
     shtab.get_completer(shell)
@@ -369,3 +436,990 @@ def test_path_completion_after_redirection(caplog, change_dir):
         shell.test('"${COMPREPLY[@]}" = "test_file.txt"', f"Redirection {redirection} failed")
 
     assert not caplog.record_tuples
+
+
+def test_build_model():
+    parser = ArgumentParser(prog="test", description="test description")
+    parser.add_argument("--opt", choices=["x", "y"], help="some %(prog)s help")
+    parser.add_argument("--hidden", help=SUPPRESS)
+    parser.add_argument("posA", choices=shtab.Required.FILE)
+    subparsers = parser.add_subparsers()
+    sub = subparsers.add_parser("sub", aliases=["xsub"], help="help message")
+    sub.add_argument("-v", action="count")
+    subparsers.add_parser("private")
+
+    model = shtab.build_model(parser)
+    assert shtab.build_model(model) is model
+    assert model.name == "test"
+    assert model.help == "test description"
+    assert [opt.option_strings for opt in model.options] == [("-h", "--help"), ("--opt",)]
+    assert model.options[0].end and model.options[0].flag
+    assert model.options[1].choices == ("x", "y")
+    assert model.options[1].help == "some test help"
+    posA, subcommands = model.positionals
+    assert posA.choices == () and posA.choice_type == "file"
+    assert subcommands.subcommands and subcommands.choices == ("sub", "xsub")
+    assert list(model.commands) == ["sub", "xsub"]
+    assert model.commands["sub"] is model.commands["xsub"]
+    assert model.commands["sub"].options[-1].multi
+
+
+@fix_shell
+def test_complete_model(shell):
+    parser = get_main_parser()
+    model = shtab.build_model(parser)
+    assert shtab.complete(model, shell=shell) == shtab.complete(parser, shell=shell)
+
+
+def test_lazy_parser(caplog):
+    def load():
+        loaded.append(True)
+        parser = ArgumentParser(prog="test heavy")
+        parser.add_argument("-j", "--jobs", type=int)
+        parser.add_argument("target", choices=["all", "docs"])
+        return parser
+
+    loaded = []
+    parser = ArgumentParser(prog="test")
+    subparsers = parser.add_subparsers()
+    subparsers.add_parser("light", help="light command")
+    shtab.add_lazy_parser(
+        subparsers, "heavy", load, help="heavy command", aliases=["hv"], spec={
+            "help": "heavy command", "options": [{"option_strings": ["-j", "--jobs"]}],
+            "positionals": [{"dest": "target", "choices": ["all", "docs"]}]})
+    shtab.add_lazy_parser(subparsers, "private", load) # no help: not public
+    with caplog.at_level(logging.INFO):
+        for shell in shtab.SUPPORTED_SHELLS:
+            shtab.complete(parser, shell)
+        model = shtab.build_model(parser)
+        assert list(model.commands) == ["light", "heavy", "hv"]
+        assert model.commands["heavy"] is model.commands["hv"]
+        assert model.commands["heavy"].help == "heavy command"
+        assert shtab.resolve(parser, ["test", "hv", "--j"]) == ["--jobs"]
+        assert shtab.resolve(parser, ["test", "heavy", "d"]) == ["docs"]
+        assert not loaded
+
+        assert parser.parse_args(["hv", "-j", "2", "docs"]).target == "docs"
+        assert loaded == [True]
+        # walked once loaded
+        heavy = shtab.build_model(parser).commands["heavy"]
+        assert heavy.options[0].option_strings == ("-h", "--help")
+
+    spec = {
+        "name": "x", "commands": {"a": {"options": [{"option_strings": ["--b-c"]}]}, "alias": "a"}}
+    model = shtab.model_from_spec(spec)
+    assert model.positionals[0].subcommands and model.positionals[0].choices == ("a", "alias")
+    assert model.commands["alias"].options[0].dest == "b_c"
+    with pytest.raises(ValueError):
+        shtab.model_from_spec({"unknown": 1})
+    with pytest.raises(ValueError):
+        shtab.model_from_spec({"positionals": [{"choices": ["x"]}]})
+
+    assert not caplog.record_tuples
+
+
+def test_zsh_nested_subcommands():
+    parser = ArgumentParser(prog="test")
+    sub = parser.add_subparsers().add_parser("sub", help="sub")
+    subsub = sub.add_subparsers().add_parser("subsub", help="subsub")
+    subsub.add_subparsers().add_parser("leaf", help="leaf")
+    completion = shtab.complete(parser, shell="zsh")
+    print(completion)
+    assert "leaf) _arguments -C -s $_shtab_test_sub_subsub_leaf_options ;;" in completion
+    assert "$_shtab_test_sub_leaf_options" not in completion
+
+
+def test_zsh_flat(caplog):
+    parser = ArgumentParser(prog="test")
+    sub = parser.add_subparsers().add_parser("sub", help="sub")
+    subsub = sub.add_subparsers().add_parser("sub-sub", help="subsub")
+    subsub.add_argument("--leaf")
+    with caplog.at_level(logging.INFO):
+        completion = shtab.complete(parser, shell="zsh", layout="flat")
+    print(completion)
+    assert "  _shtab_test/sub _shtab_test_sub\n" in completion
+    assert "  _shtab_test_sub/sub-sub _shtab_test_sub_sub_sub\n" in completion
+    assert '"--leaf[]:leaf:"' in completion
+    assert completion.count("_arguments") == 1
+    if shutil.which("zsh"):
+        subprocess.check_call(["zsh", "-n", "-c", completion])
+
+    assert not caplog.record_tuples
+
+
+def get_wide_parser(num_subcommands):
+    parser = ArgumentParser(prog="wide")
+    subparsers = parser.add_subparsers()
+    for i in range(num_subcommands):
+        sub = subparsers.add_parser(f"cmd{i}", help=f"command {i}", add_help=False)
+        sub.add_argument("--opt", choices=["a", "b"], help="option")
+    return parser
+
+
+def get_deep_parser(depth):
+    parser = sub = ArgumentParser(prog="deep")
+    for i in range(depth):
+        sub = sub.add_subparsers().add_parser(f"lvl{i}", help=f"level {i}", add_help=False)
+        sub.add_argument("--opt", help="option")
+    return parser
+
+
+@pytest.fixture(scope="module")
+def wide_parsers():
+    return get_wide_parser(200), get_wide_parser(2_000)
+
+
+def _generation_time(parser, shell):
+    start = time.perf_counter()
+    shtab.complete(parser, shell=shell)
+    return time.perf_counter() - start
+
+
+def _generation_peak_memory(parser, shell):
+    tracemalloc.start()
+    try:
+        shtab.complete(parser, shell=shell)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@fix_shell
+def test_scaling_wide_time(shell, wide_parsers, caplog):
+    small, large = wide_parsers
+    with caplog.at_level(logging.INFO):
+        small_time = min(_generation_time(small, shell) for _ in range(3))
+        large_time = min(_generation_time(large, shell) for _ in range(3))
+    # 10x subcommands: linear ~10x, quadratic ~100x
+    assert large_time < 30 * small_time
+
+
+@fix_shell
+def test_scaling_wide_memory(shell, wide_parsers, caplog):
+    small, large = wide_parsers
+    with caplog.at_level(logging.INFO):
+        small_peak = _generation_peak_memory(small, shell)
+        large_peak = _generation_peak_memory(large, shell)
+    assert large_peak < 20 * small_peak
+
+
+@fix_shell
+def test_scaling_deep(shell, caplog):
+    shallow, deep = get_deep_parser(25), get_deep_parser(50)
+    with caplog.at_level(logging.INFO):
+        shallow_time = min(_generation_time(shallow, shell) for _ in range(3))
+        deep_time = min(_generation_time(deep, shell) for _ in range(3))
+        shallow_peak = _generation_peak_memory(shallow, shell)
+        deep_peak = _generation_peak_memory(deep, shell)
+    # 2x depth: output variable names grow with depth, so allow up to ~quadratic
+    assert deep_time < 8 * shallow_time
+    assert deep_peak < 5 * shallow_peak
+
+
+@fix_shell
+def test_write_completion(shell, caplog):
+    parser = get_main_parser()
+    preamble = {shell: "# custom $preamble"}
+    with caplog.at_level(logging.INFO):
+        chunks = list(shtab.iter_completion(parser, shell=shell, preamble=preamble))
+        fd = io.StringIO()
+        shtab.write_completion(parser, shell, fd, preamble=preamble)
+        script = shtab.complete(parser, shell=shell, preamble=preamble)
+    assert "".join(chunks) == fd.getvalue() == script
+    if shell in ("bash", "zsh"):
+        assert len(chunks) > 1
+    assert not caplog.record_tuples
+
+
+@fix_shell
+def test_complete_stats(shell, caplog):
+    parser = get_wide_parser(5)
+    with caplog.at_level(logging.INFO):
+        script, stats = shtab.complete(parser, shell=shell, stats=True)
+        assert script == shtab.complete(parser, shell=shell)
+    assert stats["shell"] == shell
+    assert set(stats["time"]) == {"walk", "help", "escape", "render"}
+    assert stats["time"]["help"] > 0
+    # root (with subparsers positional) & 5 subcommands (with `--opt {a,b}`)
+    assert stats["counts"] == {"commands": 6, "actions": 7, "choices": 5 + 2*5}
+    assert stats["bytes"]["total"] == len(script.encode())
+    assert not caplog.record_tuples
+
+
+@pytest.mark.parametrize("shell,layout,section_names",
+                         [("bash", "default", shtab.bash.BASH_SECTIONS),
+                          ("bash", "table", shtab.bash.BASH_TABLE_SECTIONS),
+                          ("bash", "assoc", shtab.bash.BASH_ASSOC_SECTIONS),
+                          ("zsh", "default", shtab.zsh.ZSH_SECTIONS),
+                          ("zsh", "flat", shtab.zsh.ZSH_FLAT_SECTIONS)])
+def test_complete_stats_breakdown(shell, layout, section_names, caplog):
+    parser = get_wide_parser(5)
+    with caplog.at_level(logging.INFO):
+        _, stats = shtab.complete(parser, shell=shell, layout=layout, stats=True)
+    sections, commands = stats["bytes"]["sections"], stats["bytes"]["commands"]
+    assert set(sections) == set(section_names)
+    assert set(commands) == {"wide"} | {f"wide cmd{i}" for i in range(5)}
+    assert sum(sections.values()) == sum(commands.values()) < stats["bytes"]["total"]
+    assert commands["wide cmd0"] > 0
+    if layout == "default":
+        assert commands["wide cmd0"] == commands["wide cmd4"]
+    assert not caplog.record_tuples
+
+
+def test_main_stats(caplog, capsys):
+    with caplog.at_level(logging.INFO):
+        main(["--stats", "shtab.main.get_main_parser"])
+    captured = capsys.readouterr()
+    assert "complete -o filenames -F _shtab_shtab shtab" in captured.out
+    stats = json.loads(captured.err)
+    assert stats["bytes"]["total"] == len(captured.out.encode()) - 1 # trailing newline
+    assert stats["bytes"]["commands"] == {"shtab": sum(stats["bytes"]["sections"].values())}
+    assert not caplog.record_tuples
+
+
+def test_main_modes(caplog, capsys):
+    with caplog.at_level(logging.INFO):
+        main(["shtab.main.get_main_parser"])
+    script = capsys.readouterr().out
+    for option in ("--bench", "--line", "--repeat", "--serve", "--socket", "--stop"):
+        assert option in get_main_parser().format_help()
+        assert option in script
+
+    with caplog.at_level(logging.INFO):
+        for argv in (["--serve", "shtab.main.get_main_parser"], ["--stop"], ["-n", "2", "prog"],
+                     ["--bench", "-s", "tcsh", "shtab.main.get_main_parser"]):
+            with pytest.raises(SystemExit):
+                main(argv)
+    assert not caplog.record_tuples
+
+
+@fix_shell
+def test_main_spec(shell, caplog, capsys, tmp_path):
+    spec_path = tmp_path / "spec.json"
+    with caplog.at_level(logging.INFO):
+        main(["--dump-spec", "-o", str(spec_path), "shtab.main.get_main_parser"])
+        main(["-s", shell, "shtab.main.get_main_parser"])
+        expected = capsys.readouterr().out
+        main(["-s", shell, "--from-spec", str(spec_path)])
+        assert capsys.readouterr().out == expected
+        spec = json.loads(spec_path.read_text())
+        assert spec["shtab_spec"] == 1 and spec["prefix"] == "shtab"
+        assert spec["command"]["name"] == "shtab"
+        with pytest.raises(SystemExit):
+            main(["--from-spec", str(spec_path), "shtab.main.get_main_parser"])
+    assert not caplog.record_tuples
+
+
+def test_model_spec():
+    parser = ArgumentParser(prog="test")
+    parser.add_argument("--txt").complete = shtab.FileMatching("*.txt", dirs=False)
+    parser.add_argument("--cached").complete = shtab.cached({"bash": "_f"}, ttl=5)
+    parser.add_argument("--served").complete = get_main_parser
+    parser.add_argument("--hidden", help=SUPPRESS)
+    subparsers = parser.add_subparsers()
+    subparsers.add_parser("sub", aliases=["s"], help="sub help")
+    model = shtab.limit_completions(parser, limit=3)
+    spec = json.loads(json.dumps(shtab.model_to_spec(model)))
+    assert list(spec["commands"]) == ["sub", "s"] and spec["commands"]["s"] == "sub"
+    assert "hidden" not in {arg["dest"] for arg in spec["options"]}
+    assert shtab.model_to_spec(shtab.model_from_spec(spec)) == spec
+    loaded = shtab.model_from_spec(spec)
+    assert loaded.commands["s"] is loaded.commands["sub"]
+    assert loaded.options[-1].complete.key == "shtab.main:get_main_parser"
+    for shell in ("bash", "zsh"):
+        assert shtab.complete(loaded, shell) == shtab.complete(model, shell)
+
+    parser.add_argument("--local").complete = lambda prefix: [prefix]
+    with pytest.raises(ValueError):
+        shtab.model_to_spec(parser)
+
+
+STATIC_CLI = """
+import argparse
+import json
+
+import shtab
+from heavy_unimportable_dependency import CONFIG  # not imported by `--static`
+
+COMMANDS = ["build", "test"]
+
+
+def add_common(parser, *names):
+    for name in names:
+        parser.add_argument(f"--{name}", default=CONFIG.get(name)).complete = shtab.FILE
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="cli")
+    subparsers = parser.add_subparsers(dest="command")
+    for command in COMMANDS:
+        add_common(subparsers.add_parser(command, help=f"{command} things"), "config")
+    parser.add_argument("--level", choices=[str(i) for i in range(3)])
+    parser.add_argument("--format", choices=LEVELS)
+    return parser
+"""
+
+
+@fix_shell
+def test_static(shell, caplog, capsys, tmp_path):
+    from shtab.static import extract
+
+    path = os.path.join(os.path.dirname(__file__), "..", "examples", "customcomplete.py")
+    get_example_parser = serve.resolve(f"{os.path.abspath(path)}:get_main_parser")
+    cli = tmp_path / "cli.py"
+    with caplog.at_level(logging.INFO):
+        expected = shtab.complete(get_example_parser(), shell, root_prefix="customcomplete")
+        main(["-s", shell, "--static", f"{path}:get_main_parser"])
+        assert capsys.readouterr().out == expected + "\n"
+
+        cli.write_text(STATIC_CLI.replace("LEVELS", '["json", "csv"]'))
+        parser, unresolved = extract(str(cli), "get_parser")
+        assert not unresolved
+        assert parser._subparsers._group_actions[0].choices.keys() == {"build", "test"}
+        main(["-s", shell, "--static", f"{cli}:get_parser"])
+        assert "--config" in capsys.readouterr().out
+    assert not caplog.record_tuples
+
+    cli.write_text(STATIC_CLI.replace("LEVELS", 'json.loads("[]")'))
+    parser, unresolved = extract(str(cli), "get_parser")
+    assert len(unresolved) == 1 and "--format" in unresolved[0]
+    assert "--level" in parser._option_string_actions
+    with caplog.at_level(logging.INFO):
+        main(["-s", shell, "--static", f"{cli}:get_parser"]) # falls back to partial parser
+        assert "--level" in capsys.readouterr().out
+    warnings = [msg for name, _, msg in caplog.record_tuples if name == "shtab.main"]
+    assert len(warnings) == 3 and warnings[0].startswith("static:unresolved:")
+    assert "heavy_unimportable_dependency" in warnings[-1]
+    with pytest.raises(ImportError):
+        main(["--static", f"{cli}:get_parser", "-u"])
+
+    source = STATIC_CLI.replace("LEVELS", 'json.loads("[]")')
+    cli.write_text(
+        source.replace("from heavy_unimportable_dependency import CONFIG",
+                       'raise RuntimeError("no config")'))
+    sys_path = list(sys.path)
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        main(["-s", shell, "--static", f"{cli}:get_parser"])
+        assert "--level" in capsys.readouterr().out
+    warnings = [msg for name, _, msg in caplog.record_tuples if name == "shtab.main"]
+    assert "RuntimeError('no config')" in warnings[-1]
+    with pytest.raises(RuntimeError):
+        main(["--static", f"{cli}:get_parser", "-u"])
+    assert sys.path == sys_path
+
+
+def test_write_completion_memory(wide_parsers, caplog):
+    model = shtab.build_model(wide_parsers[1])
+    with caplog.at_level(logging.INFO), open(os.devnull, "w") as fd:
+        complete_peak = _generation_peak_memory(model, "bash")
+        tracemalloc.start()
+        try:
+            shtab.write_completion(model, "bash", fd)
+            write_peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    assert write_peak < complete_peak / 2
+
+
+def test_iter_template():
+    template = "$a ${b}$$c $unknown ${d} $ $1 $$"
+    mapping = {"a": "A", "b": iter(["B", "b"]), "d": ""}
+    expected = Template(template).safe_substitute(a="A", b="Bb", d="")
+    assert "".join(shtab.iter_template(template, **mapping)) == expected
+
+
+def test_bench(caplog, tmp_path, capsys):
+    suite = {
+        "wide": lambda: bench.wide_parser(20), "deep": lambda: bench.deep_parser(5),
+        "choices": lambda: bench.choices_parser(100)}
+    with caplog.at_level(logging.INFO):
+        results = bench.run(suite, repeat=1)
+    assert set(results) == set(suite)
+    for shells in results.values():
+        assert set(shells) == set(shtab.SUPPORTED_SHELLS)
+        for metrics in shells.values():
+            assert set(metrics) == set(bench.METRICS)
+            assert all(value > 0 for value in metrics.values())
+
+    assert not bench.compare(results, results)
+    worse = {"wide": {"bash": dict(results["wide"]["bash"], bytes=1)}}
+    expected = [f"wide:bash:bytes: {results['wide']['bash']['bytes']} > 1"]
+    assert bench.compare(results, worse) == expected
+
+    baseline = tmp_path / "baseline.json"
+    with caplog.at_level(logging.INFO):
+        argv = ["-p", "deep", "-s", "bash", "-r", "1"]
+        assert bench.main([*argv, "--save", str(baseline)]) == 0
+        assert bench.main([*argv, "--baseline", str(baseline), "--tolerance", "1000"]) == 0
+    assert "deep       bash" in capsys.readouterr().out
+
+
+def test_bench_latency(caplog, capsys):
+    parser = bench.cloud_parser(3, 2)
+    assert bench.default_lines(parser) == [
+        "cloud ", "cloud -", "cloud --", "cloud --region ", "cloud service0 ", "cloud service0 -",
+        "cloud service0 describe-thing-0 ", "cloud service0 describe-thing-0 -"]
+    with caplog.at_level(logging.INFO):
+        results = bench.measure_latency(parser, lines=["cloud ", "cloud service1 -"], repeat=3)
+    assert results["source"] > 0
+    assert list(results["lines"]) == ["cloud ", "cloud service1 -"]
+    for latency in results["lines"].values():
+        assert 0 < latency["p50"] <= latency["p99"]
+
+    with caplog.at_level(logging.INFO):
+        main(["--bench", "shtab.main.get_main_parser", "-n", "2", "-l", "shtab -"])
+    out = capsys.readouterr().out
+    assert "source:" in out
+    assert "'shtab -'" in out
+
+    assert not caplog.record_tuples
+
+
+@pytest.mark.skipif(not shutil.which("zsh"), reason="requires zsh")
+def test_bench_latency_zsh(caplog):
+    parser = bench.cloud_parser(3, 2)
+    with caplog.at_level(logging.INFO):
+        results = bench.measure_latency(parser, shell="zsh", lines=["cloud ", "cloud service1 -"],
+                                        repeat=3)
+    assert results["source"] > 0
+    assert list(results["lines"]) == ["cloud ", "cloud service1 -"]
+    for latency in results["lines"].values():
+        assert 0 < latency["p50"] <= latency["p99"]
+    assert not caplog.record_tuples
+
+
+def test_bench_latency_unsupported():
+    with pytest.raises(NotImplementedError):
+        bench.measure_latency(ArgumentParser(), shell="tcsh")
+
+
+def test_bash_no_fork_completions(caplog, change_dir):
+    parser = ArgumentParser(prog="test")
+    parser.add_argument("--file").complete = shtab.FILE
+    parser.add_argument("--dir").complete = shtab.DIRECTORY
+    parser.add_argument("--choice", choices=["a b", "a c", "z"])
+    with caplog.at_level(logging.INFO):
+        completion = shtab.complete(parser, shell="bash")
+    print(completion)
+    # only custom (printing) `.complete` functions (& builtin `compgen -A`
+    # types on bash<5.3) are called in a subshell
+    assert completion.count("$(") - completion.count("$((") == 2
+
+    (change_dir / "sub").mkdir()
+    (change_dir / "sub" / "file.txt").touch()
+    (change_dir / "space file").touch()
+    (change_dir / ".hidden").touch()
+    cases = {
+        "test --file ''": "'.hidden' 'space file' 'sub'", "test --file s": "'space file' 'sub'",
+        "test --file sub/": "'sub/file.txt'", "test --file none": "", "test --dir ''": "'sub'",
+        "test --choice a": "'a b' 'a c'", "test --ch": "'--choice'"}
+    for words, expected in cases.items():
+        shell = Bash(completion + f"""
+shopt -s failglob
+COMP_WORDS=({words}); COMP_CWORD=$((${{#COMP_WORDS[@]}} - 1)); _shtab_test
+shopt -q failglob && ! shopt -q nullglob && ! shopt -q dotglob
+completions="${{COMPREPLY[*]@Q}}"
+""")
+        shell.test(f'"$completions" = "{expected}"', f"{words} failed")
+
+    assert not caplog.record_tuples
+
+
+@pytest.mark.skipif(not shutil.which("strace"), reason="requires strace")
+def test_bash_no_fork_strace(caplog, change_dir):
+    parser = get_main_parser()
+    with caplog.at_level(logging.INFO):
+        completion = shtab.complete(parser, shell="bash")
+    (change_dir / "completion.sh").write_text(completion + """
+for line in "shtab " "shtab -" "shtab -o " "shtab --shell z" "shtab -s bash shtab.main.get_"; do
+  read -r -a COMP_WORDS <<< "$line"
+  [[ $line == *" " ]] && COMP_WORDS+=("")
+  COMP_CWORD=$(( ${#COMP_WORDS[@]} - 1 ))
+  _shtab_shtab
+done
+""")
+    trace = change_dir / "trace.txt"
+    strace = ["strace", "-f", "-e", "trace=fork,vfork,clone,clone3", "-o", str(trace)]
+    script = str(change_dir / "completion.sh")
+    subprocess.check_call(strace + ["bash", "--norc", "--noprofile", script])
+    forks = [line for line in trace.read_text().splitlines() if "clone" in line or "fork" in line]
+    assert not forks
+
+    assert not caplog.record_tuples
+
+
+def get_layout_parser():
+    parser = ArgumentParser(prog="test")
+    parser.add_argument("--choice", choices=["one", "two"])
+    parser.add_argument("--pair", nargs=2, choices=["x", "y"])
+    parser.add_argument("--file").complete = shtab.FILE
+    parser.add_argument("-v", "--verbose", action="store_true")
+    subparsers = parser.add_subparsers()
+    sub = subparsers.add_parser("sub", aliases=["alias"], help="help message")
+    sub.add_argument("--level", choices=["low", "high"])
+    sub.add_argument("posA", choices=["a1", "a2"])
+    sub.add_argument("posB", nargs="+", choices=["b1", "b2"])
+    other = subparsers.add_parser("other", help="help message")
+    other.add_argument("posA", nargs=2).complete = {"bash": "_shtab_test_some_func"}
+    other.add_argument("posB", choices=["c1", "c2"])
+    return parser
+
+
+LAYOUT_PREAMBLE = "_shtab_test_some_func() { compgen -W 'f1 f2' -- $1 ;}"
+LAYOUT_LINES = [
+    "test ", "test -", "test --ch", "test --choice ", "test --choice o", "test --pair ",
+    "test --pair x ", "test --pair x y ", "test s", "test -v sub ", "test sub -",
+    "test sub --level ", "test sub a1 ", "test sub a1 b1 ", "test alias a1 b1 b", "test other ",
+    "test other f1 f2 ", "test other -- ", "test -- -", "test sub -- -", "test ] -",
+    "test @ sub -", "test $(false) "]
+
+
+def complete_bash_lines(init_script, lines=LAYOUT_LINES):
+    """Returns `"{line}:{completions}"` for each of `lines` (using `_shtab_test`)."""
+    script = "\nlines=(" + " ".join(f"'{line}'" for line in lines) + ")" + """
+for line in "${lines[@]}"; do
+  read -r -a COMP_WORDS <<< "$line"
+  [[ $line == *" " ]] && COMP_WORDS+=("")
+  COMP_CWORD=$(( ${#COMP_WORDS[@]} - 1 ))
+  _shtab_test
+  echo "$line:${COMPREPLY[*]}"
+done
+"""
+    return subprocess.check_output(["bash", "-euc", init_script + script], text=True)
+
+
+@pytest.mark.parametrize("layout", shtab.SUPPORTED_LAYOUTS["bash"][1:])
+def test_bash_layout(layout, caplog):
+    parser = get_layout_parser()
+    outputs = []
+    for lay in (None, layout):
+        with caplog.at_level(logging.INFO):
+            completion = shtab.complete(parser, "bash", preamble=LAYOUT_PREAMBLE, layout=lay)
+        outputs.append(complete_bash_lines(completion))
+    assert outputs[0] == outputs[1]
+    assert "test --pair x :x y\n" in outputs[0]
+
+    assert not caplog.record_tuples
+
+
+def test_externalize_choices(caplog, tmp_path):
+    parser = get_layout_parser()
+    parser.add_argument("--region", choices=[f"region-{i}" for i in range(10)])
+    parser._subparsers._group_actions[0].choices["other"].add_argument(
+        "posC", choices=[f"c{i}" for i in range(10)] + ["region-1"])
+    lines = LAYOUT_LINES + ["test --region ", "test --region region-1", "test other f1 f2 c1 "]
+    with caplog.at_level(logging.INFO):
+        command, files = shtab.externalize_choices(parser, str(tmp_path), threshold=5)
+        write_files(tmp_path, files)
+        bash = shtab.complete(command, "bash", preamble=LAYOUT_PREAMBLE)
+        outputs = [
+            complete_bash_lines(shtab.complete(parser, "bash", preamble=LAYOUT_PREAMBLE), lines),
+            complete_bash_lines(bash, lines)]
+        zsh = shtab.complete(command, "zsh")
+        tcsh = shtab.complete(command, "tcsh")
+    assert len(files) == 2
+    assert "region-9" not in bash
+    print(outputs[0])
+    assert outputs[0] == outputs[1]
+    assert "test --region region-1:region-1\n" in outputs[0]
+    assert "region-9" not in zsh
+    assert "region-9" not in tcsh
+    assert f"cat {tmp_path}/" in tcsh
+    for line in lines:
+        words = line.split() + ([""] if line.endswith(" ") else [])
+        assert shtab.resolve(command, words) == shtab.resolve(parser, words)
+
+    assert not caplog.record_tuples
+
+
+@pytest.mark.parametrize("layout", shtab.SUPPORTED_LAYOUTS["bash"])
+def test_bash_sorted_choices(layout, caplog):
+    parser = ArgumentParser(prog="test")
+    ids = [f"id-{i}" for i in range(shtab.INDEX_THRESHOLD)]
+    parser.add_argument("--id", choices=ids + ["with space", "it's", "ünï", "Upper", "id-"])
+    parser.add_argument("pos", choices=["b", "a"])
+    with caplog.at_level(logging.INFO):
+        completion = shtab.complete(parser, "bash", layout=layout)
+    # not inline
+    assert "'id-99'" not in completion
+    lines = [
+        "test --id ", "test --id id-2", "test --id id-", "test --id i", "test --id w",
+        "test --id ü", "test --id U", "test --id x", "test a"]
+    for output in complete_bash_lines(completion, lines).splitlines():
+        line, expected = output.split(":", 1)
+        words = line.split() + ([""] if line.endswith(" ") else [])
+        resolved = " ".join(shtab.resolve(parser, words)).split()
+        assert sorted(resolved) == sorted(expected.split()), line
+    assert "test --id id-2:id-2 id-20 " in complete_bash_lines(completion, ["test --id id-2"])
+
+    assert not caplog.record_tuples
+
+
+@pytest.mark.parametrize("layout", shtab.SUPPORTED_LAYOUTS["bash"])
+def test_bash_limits(layout, caplog):
+    parser = ArgumentParser(prog="test")
+    action = parser.add_argument("--id", choices=[f"id-{i}" for i in range(10)])
+    action.complete_limit, action.complete_min_prefix = 3, 1
+    parser.add_argument("--other", choices=["a", "ab", "abc"])
+    parser.add_argument("pos").complete = {"bash": "_shtab_test_limit"}
+    preamble = "_shtab_test_limit() { printf '%s\\n' limit=${SHTAB_LIMIT-} x{1..9} ;}"
+    lines = [
+        "test --id ", "test --id i", "test --id id-5", "test --other ", "test --other a", "test "]
+    with caplog.at_level(logging.INFO):
+        command = shtab.limit_completions(parser, limit=2)
+        completion = shtab.complete(command, "bash", preamble=preamble, layout=layout)
+        zsh = shtab.complete(command, "zsh")
+    assert complete_bash_lines(completion, lines) == """\
+test --id :
+test --id i:id-0 id-1 id-2
+test --id id-5:id-5
+test --other :a ab
+test --other a:a ab
+test :limit=2 x1
+"""
+    for line in lines[:-1]:
+        words = line.split() + ([""] if line.endswith(" ") else [])
+        expected = complete_bash_lines(completion, [line]).split(":", 1)[1].strip()
+        assert " ".join(shtab.resolve(command, words)) == expected
+    assert "(( $#PREFIX >= 1 )) || return 1" in zsh
+
+    assert not caplog.record_tuples
+
+
+def test_resolve(caplog, tmp_path, monkeypatch):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "file").touch()
+    (tmp_path / ".hidden").touch()
+    monkeypatch.chdir(tmp_path)
+    lines = LAYOUT_LINES + ["test --file ", "test --file d", "test sub > ", "test sub 2>> ."]
+    parser = get_layout_parser()
+    with caplog.at_level(logging.INFO):
+        completion = shtab.complete(parser, "bash", preamble=LAYOUT_PREAMBLE)
+    for output in complete_bash_lines(completion, lines).splitlines():
+        line, expected = output.split(":", 1)
+        words = line.split() + ([""] if line.endswith(" ") else [])
+        if "f1" in expected:
+            expected = "" # shell functions are ignored
+        assert shtab.resolve(parser, words) == sorted(expected.split()), line
+
+    assert shtab.get_resolver(parser) is shtab.get_resolver(parser)
+    parser = ArgumentParser(prog="test")
+    parser.add_argument("--opt").complete = lambda prefix: [prefix + "1", "x"]
+    assert shtab.resolve(shtab.build_model(parser), ["test", "--opt", "a"]) == ["a1"]
+    assert shtab.resolve(parser, ["test", "--opt", "a", "--o"], 2) == ["a1"]
+
+    class Suffixer:
+        def __call__(self, prefix):
+            return [prefix + "2"]
+
+    parser = ArgumentParser(prog="test")
+    parser.add_argument("--partial").complete = functools.partial(
+        lambda suffix, prefix: [prefix + suffix], "3")
+    parser.add_argument("--instance").complete = Suffixer()
+    with caplog.at_level(logging.INFO):
+        for shell in shtab.SUPPORTED_SHELLS:
+            if shell != "tcsh":
+                with pytest.raises(ValueError, match="not importable"):
+                    shtab.complete(parser, shell)
+        assert "(help instance partial)" in shtab.complete(parser, "tcsh")
+    assert shtab.resolve(parser, ["test", "--partial", "a"]) == ["a3"]
+    assert shtab.resolve(parser, ["test", "--instance", "a"]) == ["a2"]
+
+    assert not caplog.record_tuples
+
+
+def test_file_matching(caplog, tmp_path, monkeypatch):
+    for name in ("a.txt", "B.TXT", "c.csv", ".d.txt", "sub/e.txt", "sub/f.md"):
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).touch()
+    monkeypatch.chdir(tmp_path)
+    parser = ArgumentParser(prog="test")
+    parser.add_argument("--txt").complete = shtab.FileMatching("*.txt", "*.TXT")
+    parser.add_argument("--csv").complete = shtab.FileMatching("*.csv", dirs=False)
+    lines = ["test --txt ", "test --txt s", "test --txt sub/", "test --csv ", "test --csv s"]
+    with caplog.at_level(logging.INFO):
+        completion = shtab.complete(parser, "bash")
+        zsh = shtab.complete(parser, "zsh")
+        tcsh = shtab.complete(parser, "tcsh")
+    outputs = complete_bash_lines(completion, lines)
+    print(outputs)
+    assert outputs.splitlines() == [
+        "test --txt :.d.txt B.TXT a.txt sub", "test --txt s:sub", "test --txt sub/:sub/e.txt",
+        "test --csv :c.csv", "test --csv s:"]
+    for output in outputs.splitlines():
+        line, expected = output.split(":", 1)
+        words = line.split() + [""] * line.endswith(" ")
+        assert shtab.resolve(parser, words) == sorted(expected.split()), line
+
+    assert ":_files -g '(*.txt|*.TXT)'\"" in zsh
+    assert ":_path_files -g '*.csv'\"" in zsh
+    assert "'n/--txt/f:{*.txt,*.TXT}/'" in tcsh and "'n/--csv/f:*.csv/'" in tcsh
+    with pytest.raises(ValueError):
+        shtab.FileMatching()
+
+    assert not caplog.record_tuples
+
+
+def test_builtin_choice_types(caplog, tmp_path):
+    parser = ArgumentParser(prog="test")
+    parser.add_argument("--env").complete = shtab.ENV_VAR
+    parser.add_argument("--user").complete = shtab.USER
+    parser.add_argument("--cmd", choices=[shtab.Choice("command")])
+    parser.add_argument("--host").complete = shtab.HOSTNAME
+    with caplog.at_level(logging.INFO):
+        completion = shtab.complete(parser, "bash")
+        zsh = shtab.complete(parser, "zsh")
+        tcsh = shtab.complete(parser, "tcsh")
+    outputs = complete_bash_lines(
+        f"export SHTAB_TEST_VAR=1 XDG_RUNTIME_DIR={tmp_path}\n" + completion,
+        ["test --env SHTAB_TEST_V", "test --user root", "test --cmd shtab_test_c"])
+    print(outputs)
+    assert outputs.splitlines() == [
+        "test --env SHTAB_TEST_V:SHTAB_TEST_VAR", "test --user root:root",
+        "test --cmd shtab_test_c:"]
+    # bash<5.3: `compgen` results are written to a private directory
+    runtime_dir = tmp_path / f"shtab-{os.getuid()}"
+    assert not runtime_dir.exists() or runtime_dir.stat().st_mode & 0o777 == 0o700
+
+    assert ":_parameters -g '*export*'\"" in zsh and ":_users\"" in zsh
+    assert ":_command_names\"" in zsh and ":_hosts\"" in zsh
+    assert "'n/--env/e/'" in tcsh and "'n/--user/u/'" in tcsh and "'n/--cmd/c/'" in tcsh
+    assert "--host/" not in tcsh # unsupported
+
+    assert not caplog.record_tuples
+
+
+def test_resolve_large():
+    parser = bench.cloud_parser(num_services=50, num_operations=100)
+    words = ["cloud", "--region", "region-1", "service4", "describe-thing-1"]
+    expected = shtab.resolve(parser, words)
+    assert expected
+    start = time.perf_counter()
+    for _ in range(1000):
+        assert shtab.resolve(parser, words) == expected
+    assert time.perf_counter() - start < 1 # < 1ms per query
+
+
+def test_layout_unsupported():
+    with pytest.raises(NotImplementedError):
+        shtab.complete(ArgumentParser(), "bash", layout="unknown")
+    with pytest.raises(NotImplementedError):
+        shtab.complete(ArgumentParser(), "zsh", layout="table")
+
+
+def test_bash_assoc_shared_prefixes():
+    parser = bench.cloud_parser(num_services=3, num_operations=4)
+    subparsers, options, _, _, choices, _ = shtab.get_bash_assoc(parser)
+    # all services (& all of their operations) complete identically
+    assert len(set(subparsers.values())) == 2
+    service = subparsers["/service0"]
+    operation = subparsers[f"{service}/describe-thing-0"]
+    assert {key for key in choices if key.endswith("/pos_0")} == {"/pos_0", f"{service}/pos_0"}
+    assert options[f"{operation}/--dry-run"] == "--dry-run"
+
+
+def test_bash_split(caplog, tmp_path):
+    parser = get_layout_parser()
+    with caplog.at_level(logging.INFO):
+        completion = shtab.complete(parser, "bash", preamble=LAYOUT_PREAMBLE)
+        files = shtab.complete_bash_split(parser, preamble=LAYOUT_PREAMBLE)
+        write_files(tmp_path, files)
+    # script + sub, alias & other
+    assert len(files) == 4
+    script = tmp_path / "test"
+    assert complete_bash_lines(f"source {script}") == complete_bash_lines(completion)
+    # data files are only sourced when needed
+    assert subprocess.check_output([
+        "bash", "-euc", f"""source {script}
+COMP_WORDS=(test sub ''); COMP_CWORD=2; _shtab_test
+echo "${{_shtab_test_sub_DATA-unset}}:${{_shtab_test_other_DATA:+set}}"
+"""], text=True) == "unset:set\n"
+
+    # only changed subtrees are rewritten
+    mtimes = {path: path.stat().st_mtime_ns for path in tmp_path.rglob("*.bash")}
+    parser._actions[-1].choices["other"].add_argument("--new")
+    with caplog.at_level(logging.INFO):
+        new_files = shtab.complete_bash_split(parser, preamble=LAYOUT_PREAMBLE)
+        write_files(tmp_path, new_files)
+    assert set(tmp_path.rglob("*.bash")) == {tmp_path / i for i in new_files} - {script}
+    assert len([name for name in new_files if name not in files]) == 1 # other
+    for path, mtime in mtimes.items():
+        if path.exists():
+            assert path.stat().st_mtime_ns == mtime
+
+    assert not caplog.record_tuples
+
+
+def test_zsh_split(caplog, tmp_path):
+    parser = get_layout_parser()
+    with caplog.at_level(logging.INFO):
+        files = shtab.complete_zsh_split(parser)
+        write_files(tmp_path, files)
+    assert files["_test"].startswith("#compdef test\n")
+    assert files["_shtab_test.manifest"].split() == sorted(set(files) - {"_shtab_test.manifest"})
+    # all autoloaded functions are defined
+    for content in files.values():
+        for line in content.splitlines():
+            if line.startswith("autoload -Uz "):
+                assert set(line.split()[2:]) <= set(files)
+    assert "_arguments -C -s $options" in files["_shtab_test_other"]
+    assert '"other:"' in files["_shtab_test_commands"]
+
+    # stale functions are removed
+    (tmp_path / "_shtab_test_other.zwc").touch()
+    parser._actions[-1].choices.pop("other")
+    parser._actions[-1]._choices_actions.pop()
+    with caplog.at_level(logging.INFO):
+        write_files(tmp_path, shtab.complete_zsh_split(parser))
+    assert not (tmp_path / "_shtab_test_other").exists()
+    assert not (tmp_path / "_shtab_test_other.zwc").exists()
+    assert (tmp_path / "_shtab_test_sub").exists()
+
+    assert not caplog.record_tuples
+
+
+@pytest.mark.skipif(not shutil.which("zsh"), reason="requires zsh")
+def test_main_zcompile(caplog, tmp_path):
+    with caplog.at_level(logging.INFO):
+        out = str(tmp_path)
+        main(["-s", "zsh", "--split", "--zcompile", "-o", out, "shtab.main.get_main_parser"])
+    assert (tmp_path / "_shtab.zwc").is_file()
+    assert (tmp_path / "_shtab_shtab.zwc").is_file()
+
+
+def test_bash_cached(caplog, tmp_path):
+    parser = ArgumentParser(prog="test")
+    parser.add_argument("posA").complete = shtab.cached({"bash": "_shtab_test_slow"}, ttl=60)
+    parser.add_argument("--empty").complete = shtab.cached({"bash": "_shtab_test_none"})
+    parser.add_argument("--fast").complete = shtab.cached({"bash": "_shtab_test_slow"}, ttl=0.5)
+    preamble = f"""
+_shtab_test_slow() {{ echo . >> {tmp_path}/calls; compgen -W 'one two "t h"' -- "$1"; }}
+_shtab_test_none() {{ echo . >> {tmp_path}/calls; }}
+"""
+    with caplog.at_level(logging.INFO):
+        completion = shtab.complete(parser, "bash", preamble=preamble)
+    print(completion)
+    cache = tmp_path / "cache" / "shtab" / "test"
+
+    def run(words):
+        proc = subprocess.run([
+            "bash", "-euc", f"""{completion}
+export XDG_CACHE_HOME={tmp_path}/cache
+COMP_WORDS=({words}); COMP_CWORD=$((${{#COMP_WORDS[@]}} - 1)); _shtab_test
+echo "${{COMPREPLY[*]@Q}}" """], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                              check=True)
+        assert not proc.stderr
+        return proc.stdout
+
+    def calls():
+        path = tmp_path / "calls"
+        return len(path.read_text().splitlines()) if path.exists() else 0
+
+    assert run("test t") == "'two' 't h'\n"
+    assert calls() == 1
+    assert (cache / "_shtab_test_slow:t").read_text().split("\n")[1:] == ["two", "t h", ""]
+    assert run("test t") == "'two' 't h'\n"
+    assert run("test ''") == "'one' 'two' 't h'\n"
+    assert calls() == 2
+    # empty results are cached
+    assert run("test --empty ''") == "\n"
+    assert run("test --empty ''") == "\n"
+    assert calls() == 3
+
+    # stale results are used while being refreshed
+    (cache / "_shtab_test_slow:t").write_text("0\nstale\n")
+    assert run("test t") == "'stale'\n"
+    for _ in range(50):
+        if (cache / "_shtab_test_slow:t").read_text().startswith("0\n"):
+            time.sleep(0.01)
+    assert run("test t") == "'two' 't h'\n"
+    assert calls() == 4
+    # (atomically) replaced, without leftover temporary files
+    assert sorted(path.name for path in cache.iterdir()) == [
+        "_shtab_test_none:", "_shtab_test_slow:", "_shtab_test_slow:t"]
+    # non-integer ttl (rounded up)
+    assert "(( now - results[0] < 1 ))" in completion
+    assert run("test --fast t") == "'two' 't h'\n"
+
+    assert not caplog.record_tuples
+
+
+def test_zsh_cached(caplog):
+    parser = ArgumentParser(prog="test")
+    slow = shtab.cached({"zsh": "_shtab_test_slow", "tcsh": "f"}, ttl=30)
+    parser.add_argument("posA").complete = slow
+    with caplog.at_level(logging.INFO):
+        completion = shtab.complete(parser, "zsh")
+        files = shtab.complete_zsh_split(parser)
+        tcsh = shtab.complete(parser, "tcsh")
+    print(completion)
+    assert ':posA:_shtab_cached_30__shtab_test_slow"' in completion
+    assert "_shtab_cached_30__shtab_test_slow() {" in completion
+    assert "(Nms-30)" in completion
+    # rounded up to whole seconds, consistently for all shells
+    assert shtab.cached({"bash": "_f", "zsh": "_f"}, ttl=0.5) == {
+        "bash": "_shtab_cached_1__f_compreply", "zsh": "_shtab_cached_1__f"}
+    with pytest.raises(ValueError):
+        shtab.cached({"zsh": "_f"}, ttl=0)
+    assert "_store_cache" in files["_shtab_cached_30__shtab_test_slow"]
+    assert "autoload -Uz _shtab_test _shtab_cached_30__shtab_test_slow" in files["_test"]
+    assert "'p/1/f/'" in tcsh # no cache layer
+    if shutil.which("zsh"):
+        subprocess.check_call(["zsh", "-n", "-c", completion])
+
+    assert not caplog.record_tuples
+
+
+def test_serve(caplog, tmp_path, monkeypatch):
+    module = tmp_path / "shtab_test_serve.py"
+    module.write_text(
+        "def branches(prefix):\n    return ['main', 'master', 'dev', 'multi\\nline']\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setenv("PYTHONPATH", str(tmp_path))
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    branches = serve.resolve("shtab_test_serve:branches")
+
+    parser = ArgumentParser(prog="test")
+    parser.add_argument("branch").complete = branches
+    with caplog.at_level(logging.INFO):
+        completion = shtab.complete(parser, "bash")
+        zsh = shtab.complete(parser, "zsh")
+    print(completion)
+    assert "_shtab_serve_shtab_test_serve_branches() {" in zsh
+    assert "zsocket" in zsh
+    path = serve.get_socket_path()
+    try:
+        assert subprocess.check_output([
+            "bash", "-euc", f"""{completion}
+COMP_WORDS=(test ma); COMP_CWORD=1; _shtab_test; echo "${{COMPREPLY[*]@Q}}"
+COMPREPLY=(); COMP_WORDS=(test ''); _shtab_test; echo "${{COMPREPLY[*]@Q}}" """],
+                                       text=True) == "'main' 'master'\n'main' 'master' 'dev'\n"
+        stats = json.loads(serve.query(["stats"], path, autostart=False)[0])
+        assert stats["requests"] == 2
+        assert stats["errors"] == 0
+        assert stats["keys"] == {"shtab_test_serve:branches": 2}
+        assert serve.query(["complete", "shtab_test_serve:missing", ""], path) == []
+        assert json.loads(serve.query(["stats"], path)[0])["errors"] == 1
+    finally:
+        with caplog.at_level(logging.INFO):
+            main(["--serve", "--stop"])
+    for _ in range(500):
+        if not os.path.exists(path):
+            break
+        time.sleep(0.01)
+    assert not os.path.exists(path)
+
+    # idle shutdown
+    assert serve.query(["complete", "shtab_test_serve:branches", "d"], path, idle=0.1) == ["dev"]
+    for _ in range(500):
+        if not os.path.exists(path):
+            break
+        time.sleep(0.01)
+    assert not os.path.exists(path)
+
+    parser.add_argument("--bad").complete = lambda prefix: []
+    with pytest.raises(ValueError, match="not importable"):
+        shtab.complete(parser, "bash")
+
+    assert not caplog.record_tuples